@@ -0,0 +1,170 @@
+#! /bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Benchmarks check_serverview against simulated agents
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Measures the plugin against serverview_sim.py agents, offline.
+
+Every measurement runs in a new python process, like nagios starts the
+plugin, so the import and snmp setup are part of it. Reported per run:
+    rt/check    requests received by the simulated agents per check
+    wall        seconds from process start to exit
+    cpu         user + system seconds of the process
+    maxrss      peak resident set size in KB
+and the wall and cpu time per check.
+
+Cases:
+    problem_list  get_problem_list against one agent
+    table         SnmpClient.get_table of the subsystem table
+    batch         serverview_task for all hosts over one SnmpDispatcher,
+                  like check_serverview.py --hostfile
+
+    serverview_bench.py                       # all cases, 1/100/1000 hosts
+    serverview_bench.py -c batch -n 100 -s many -p 2 -l 0.020 -L 0.01
+    serverview_bench.py -k pysnmp             # without the BER codec'''
+
+import os
+import sys
+import time
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from serverview_sim import AgentServer, build_agents, raise_file_limit, \
+                           SCENARIOS
+
+CASES = ('problem_list', 'table', 'batch')
+OID_SUBSYSTEM_ENTRY = '.1.3.6.1.4.1.231.2.10.2.11.3.1.1'
+
+
+def run_case(case, hosts, port, protocol, concurrency, codec):
+    '''The measured work, run in the child process'''
+    from schau_snmp import SnmpClient, SnmpDispatcher
+    from check_serverview import get_problem_list, serverview_task
+    if case == 'problem_list':
+        client = SnmpClient('127.0.0.1', protocol, community='public',
+                            port=port, codec=codec)
+        get_problem_list(client, [])
+    elif case == 'table':
+        client = SnmpClient('127.0.0.1', protocol, community='public',
+                            port=port, codec=codec)
+        client.get_table(OID_SUBSYSTEM_ENTRY)
+    else:
+        dispatcher = SnmpDispatcher()
+        results = []
+        def tasks():
+            for offset in range(hosts):
+                options = {'host': '127.0.0.1', 'port': port + offset,
+                           'protocol': protocol, 'community': 'public',
+                           'timeout': 25, 'ignore': '', 'cache': None,
+                           'codec': codec, 'deep': 0, 'state': None,
+                           'maxage': 300}
+                yield offset, serverview_task(options, dispatcher)
+        dispatcher.run(tasks(), lambda key, result, error:
+                       results.append(result), concurrency)
+        statusses = [result and result[0] for result in results]
+        if statusses.count('UNKNOWN') or statusses.count(None):
+            sys.stderr.write('%d checks failed\n' % (
+                statusses.count('UNKNOWN') + statusses.count(None)))
+
+
+def measure(case, hosts, port, protocol, concurrency, codec, counter):
+    '''Runs case in a new process, returns (round trips, wall seconds,
+    cpu seconds, maxrss KB)'''
+    before = counter.value
+    start = time.time()
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              '--child', case, str(hosts), str(port),
+                              str(protocol), str(concurrency), codec])
+    pid, status, usage = os.wait4(child.pid, 0)
+    child.returncode = status
+    wall = time.time() - start
+    if status:
+        raise RuntimeError('%s with %d hosts failed' % (case, hosts))
+    # the last responses may still be counted
+    time.sleep(0.1)
+    return (counter.value - before, wall, usage.ru_utime + usage.ru_stime,
+            usage.ru_maxrss)
+
+
+def serve(scenario, hosts, port, latency, loss, max_varbinds, counter):
+    '''Runs the simulated agents, in a process of their own'''
+    raise_file_limit(hosts)
+    server = AgentServer(build_agents(scenario, hosts, latency=latency,
+                                      loss=loss, max_varbinds=max_varbinds),
+                         port=port)
+    server.serve(counter=counter)
+
+
+def main():
+    parser = OptionParser(usage='%prog [-c case] [-n hosts] [-s scenario]')
+    parser.add_option('-c', '--case', action='append',
+                      help='%s (default all)' % ', '.join(CASES))
+    parser.add_option('-n', '--hosts', type='int', action='append',
+                      help='hosts for the batch case (default 1, 100, 1000)')
+    parser.add_option('-s', '--scenario', default='degraded',
+                      help='%s or a fixture filename' % ', '.join(SCENARIOS))
+    parser.add_option('-p', '--protocol', type='int', default=2)
+    parser.add_option('-P', '--port', type='int', default=17100,
+                      help='udp port of the first simulated host')
+    parser.add_option('-l', '--latency', type='float', default=0.0)
+    parser.add_option('-L', '--loss', type='float', default=0.0)
+    parser.add_option('-m', '--max-varbinds', type='int', default=0)
+    parser.add_option('-C', '--concurrency', type='int', default=50)
+    parser.add_option('-k', '--codec', default='ber',
+                      help='ber or pysnmp, for snmpv1/v2c (default ber)')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='runs per measurement, the fastest is reported')
+    options, args = parser.parse_args()
+    cases = options.case or CASES
+    host_counts = options.hosts or [1, 100, 1000]
+    counter = multiprocessing.Value('l', 0)
+    server = multiprocessing.Process(target=serve, args=(options.scenario,
+                    max(host_counts), options.port, options.latency,
+                    options.loss, options.max_varbinds, counter))
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+    print '%-13s %6s %9s %8s %8s %8s %12s %11s' % ('case', 'hosts',
+            'rt/check', 'wall', 'cpu', 'maxrss', 'wall/check', 'cpu/check')
+    try:
+        for case in cases:
+            counts = host_counts
+            if case != 'batch':
+                counts = [1]
+            for hosts in counts:
+                runs = [measure(case, hosts, options.port, options.protocol,
+                                options.concurrency, options.codec,
+                                counter)
+                        for nr in range(options.repeat)]
+                runs.sort(key=lambda run: run[1])
+                round_trips, wall, cpu, maxrss = runs[0]
+                print '%-13s %6d %9.1f %7.3fs %7.3fs %6dKB %10.2fms %9.2fms' % (
+                        case, hosts, float(round_trips) / hosts, wall, cpu,
+                        maxrss, 1000 * wall / hosts, 1000 * cpu / hosts)
+                sys.stdout.flush()
+    finally:
+        server.terminate()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        case, hosts, port, protocol, concurrency, codec = sys.argv[2:8]
+        run_case(case, int(hosts), int(port), int(protocol), int(concurrency),
+                 codec)
+    else:
+        main()
@@ -0,0 +1,314 @@
+#! /bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Simulated FSC ServerView SNMP agent for offline testing
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Serves a ServerView MIB subtree over SNMPv1/v2c from a fixture file.
+
+Fixtures are plain "snmpwalk -On" dumps, see the fixtures directory:
+    healthy.snmpwalk    all subsystems ok
+    degraded.snmpwalk   environment and massstorage subsystems failing
+    many.snmpwalk       64 subsystems, 6 of them failing
+
+Every simulated host listens on its own udp port, starting at --port.
+Latency, packet loss and a "tooBig" limit (maximum number of varbinds
+in a response) can be configured to mimic slow or small agents.
+
+    serverview_sim.py -s degraded -P 16100 -n 100 -l 0.030 -L 0.01'''
+
+import os
+import sys
+import time
+import heapq
+import random
+import select
+import socket
+import bisect
+import resource
+from optparse import OptionParser
+
+from pyasn1.codec.ber import encoder, decoder
+from pysnmp.proto import api
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fixtures')
+SCENARIOS = ('healthy', 'degraded', 'many')
+
+# fixture type name -> (snmpv1 type, snmpv2c type)
+_TYPES = {
+    'INTEGER':   ('Integer', 'Integer'),
+    'STRING':    ('OctetString', 'OctetString'),
+    'OID':       ('ObjectIdentifier', 'ObjectIdentifier'),
+    'Timeticks': ('TimeTicks', 'TimeTicks'),
+    'Gauge32':   ('Gauge', 'Gauge32'),
+    'Counter32': ('Counter', 'Counter32'),
+    }
+
+
+def oid2tuple(oid):
+    return tuple([int(x) for x in oid.strip('.').split('.')])
+
+def load_fixture(filename):
+    '''Reads a "snmpwalk -On" dump, returns a sorted list of
+    (oid tuple, (type name, python value))'''
+    if not os.path.sep in filename and not os.path.exists(filename):
+        filename = os.path.join(FIXTURE_DIR, filename + '.snmpwalk')
+    varbinds = []
+    for line in open(filename):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        oid, value = line.split(' = ', 1)
+        kind, value = value.split(': ', 1)
+        if kind == 'STRING':
+            value = value[1:-1]
+        elif kind == 'OID':
+            value = oid2tuple(value)
+        elif kind == 'Timeticks':
+            value = int(value[1:value.index(')')])
+        else:
+            value = int(value)
+        varbinds.append((oid2tuple(oid), (kind, value)))
+    varbinds.sort()
+    return varbinds
+
+
+class SimulatedAgent(object):
+    '''One simulated SNMP agent: answers GET, GETNEXT and GETBULK
+
+    * varbinds:     sorted list as returned by load_fixture
+    * community:    requests with another community are silently dropped
+    * latency:      seconds added before every response
+    * loss:         fraction (0-1) of requests that is dropped
+    * max_varbinds: more varbinds in a GET(NEXT) response is answered
+                    with tooBig, GETBULK responses are truncated'''
+
+    def __init__(self, varbinds, community='public', latency=0.0, loss=0.0,
+                 max_varbinds=0):
+        self.oids = [oid for oid, value in varbinds]
+        self.values = [value for oid, value in varbinds]
+        self.community = community
+        self.latency = latency
+        self.loss = loss
+        self.max_varbinds = max_varbinds
+        self.requests = 0
+        self.responses = 0
+
+    def _value(self, pMod, idx):
+        kind, value = self.values[idx]
+        v1name, v2name = _TYPES[kind]
+        if pMod is api.protoModules[api.protoVersion1]:
+            return getattr(pMod, v1name)(value)
+        return getattr(pMod, v2name)(value)
+
+    def _get(self, oid):
+        idx = bisect.bisect_left(self.oids, oid)
+        if idx < len(self.oids) and self.oids[idx] == oid:
+            return idx
+        return None
+
+    def _next(self, oid):
+        idx = bisect.bisect_right(self.oids, oid)
+        if idx < len(self.oids):
+            return idx
+        return None
+
+    def handle(self, wholeMsg):
+        '''Returns the encoded response for a request, None to drop it'''
+        self.requests = self.requests + 1
+        if self.loss and random.random() < self.loss:
+            return None
+        try:
+            msgVer = int(api.decodeMessageVersion(wholeMsg))
+            pMod = api.protoModules[msgVer]
+            reqMsg, rest = decoder.decode(wholeMsg, asn1Spec=pMod.Message())
+        except Exception:
+            return None
+        if str(pMod.apiMessage.getCommunity(reqMsg)) != self.community:
+            return None
+        reqPDU = pMod.apiMessage.getPDU(reqMsg)
+        rspMsg = pMod.apiMessage.getResponse(reqMsg)
+        rspPDU = pMod.apiMessage.getPDU(rspMsg)
+        reqVarBinds = [(tuple(oid), val)
+                       for oid, val in pMod.apiPDU.getVarBinds(reqPDU)]
+        varBinds, errors, tooBig = [], [], False
+        if reqPDU.isSameTypeWith(pMod.GetRequestPDU()):
+            for oid, val in reqVarBinds:
+                varBinds.append((oid, self._get(oid)))
+        elif reqPDU.isSameTypeWith(pMod.GetNextRequestPDU()):
+            for oid, val in reqVarBinds:
+                idx = self._next(oid)
+                if idx is None:
+                    varBinds.append((oid, None))
+                else:
+                    varBinds.append((self.oids[idx], idx))
+        elif msgVer == api.protoVersion2c and \
+             reqPDU.isSameTypeWith(pMod.GetBulkRequestPDU()):
+            nonRepeaters = int(pMod.apiBulkPDU.getNonRepeaters(reqPDU))
+            maxRepetitions = int(pMod.apiBulkPDU.getMaxRepetitions(reqPDU))
+            for oid, val in reqVarBinds[:nonRepeaters]:
+                idx = self._next(oid)
+                varBinds.append((idx is None and oid or self.oids[idx], idx))
+            repeaters = [oid for oid, val in reqVarBinds[nonRepeaters:]]
+            for repetition in range(maxRepetitions):
+                if not repeaters:
+                    break
+                row = []
+                for oid in repeaters:
+                    idx = self._next(oid)
+                    if idx is None:
+                        row.append((oid, None))
+                    else:
+                        row.append((self.oids[idx], idx))
+                varBinds.extend(row)
+                if [idx for oid, idx in row if idx is not None] == []:
+                    break
+                repeaters = [oid for oid, idx in row]
+            if self.max_varbinds and len(varBinds) > self.max_varbinds:
+                varBinds = varBinds[:max(self.max_varbinds,
+                                         len(reqVarBinds))]
+        else:
+            return None
+        if self.max_varbinds and len(varBinds) > self.max_varbinds:
+            tooBig = True
+        if tooBig:
+            pMod.apiPDU.setErrorStatus(rspPDU, 1)
+            pMod.apiPDU.setErrorIndex(rspPDU, 0)
+            if msgVer == api.protoVersion1:
+                pMod.apiPDU.setVarBinds(rspPDU, reqVarBinds)
+            else:
+                pMod.apiPDU.setVarBinds(rspPDU, [])
+        else:
+            rspVarBinds = []
+            for oid, idx in varBinds:
+                if idx is None:
+                    errors.append(len(rspVarBinds) + 1)
+                    rspVarBinds.append((oid, None))
+                else:
+                    rspVarBinds.append((oid, self._value(pMod, idx)))
+            if errors and msgVer == api.protoVersion1:
+                # v1 reports the first missing variable only
+                pMod.apiPDU.setErrorStatus(rspPDU, 2)
+                pMod.apiPDU.setErrorIndex(rspPDU, errors[0])
+                pMod.apiPDU.setVarBinds(rspPDU, reqVarBinds)
+            else:
+                pMod.apiPDU.setVarBinds(rspPDU, rspVarBinds)
+                getnext = not reqPDU.isSameTypeWith(pMod.GetRequestPDU())
+                for errorIndex in errors:
+                    if getnext:
+                        pMod.apiPDU.setEndOfMibError(rspPDU, errorIndex)
+                    else:
+                        pMod.apiPDU.setNoSuchInstanceError(rspPDU, errorIndex)
+        self.responses = self.responses + 1
+        return encoder.encode(rspMsg)
+
+
+class AgentServer(object):
+    '''Runs many SimulatedAgents in one process, one udp port per agent'''
+
+    def __init__(self, agents, address='127.0.0.1', port=16100):
+        self.agents = {}
+        self.sockets = {}
+        self.poller = select.poll()
+        for offset in range(len(agents)):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((address, port + offset))
+            sock.setblocking(0)
+            self.sockets[sock.fileno()] = sock
+            self.agents[sock.fileno()] = agents[offset]
+            self.poller.register(sock.fileno(), select.POLLIN)
+        self.pending = []
+
+    def serve(self, duration=None, counter=None):
+        '''Serves requests until duration seconds passed (None: forever)
+        counter is an optional multiprocessing.Value counting requests'''
+        stop = duration and time.time() + duration or None
+        while stop is None or time.time() < stop:
+            timeout = 500
+            if self.pending:
+                timeout = max(0, (self.pending[0][0] - time.time()) * 1000)
+            for fd, event in self.poller.poll(timeout):
+                sock = self.sockets[fd]
+                try:
+                    data, peer = sock.recvfrom(65535)
+                except socket.error:
+                    continue
+                if counter is not None:
+                    counter.value = counter.value + 1
+                agent = self.agents[fd]
+                response = agent.handle(data)
+                if response is not None:
+                    heapq.heappush(self.pending, (time.time() + agent.latency,
+                                                  response, sock, peer))
+            now = time.time()
+            while self.pending and self.pending[0][0] <= now:
+                due, response, sock, peer = heapq.heappop(self.pending)
+                try:
+                    sock.sendto(response, peer)
+                except socket.error:
+                    pass
+
+    def close(self):
+        for sock in self.sockets.values():
+            sock.close()
+
+
+def raise_file_limit(sockets):
+    '''Allows the process to open sockets udp sockets and some more'''
+    needed = sockets + 64
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+
+def build_agents(scenario, count=1, community='public', latency=0.0,
+                 loss=0.0, max_varbinds=0):
+    varbinds = load_fixture(scenario)
+    agents = []
+    for nr in range(count):
+        agents.append(SimulatedAgent(varbinds, community, latency, loss,
+                                     max_varbinds))
+    return agents
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [-s scenario] [-n hosts] [-P port]')
+    parser.add_option('-s', '--scenario', default='healthy',
+                      help='healthy, degraded, many or a fixture filename')
+    parser.add_option('-n', '--hosts', type='int', default=1,
+                      help='number of simulated hosts (one port each)')
+    parser.add_option('-a', '--address', default='127.0.0.1')
+    parser.add_option('-P', '--port', type='int', default=16100,
+                      help='udp port of the first host')
+    parser.add_option('-C', '--community', default='public')
+    parser.add_option('-l', '--latency', type='float', default=0.0,
+                      help='seconds of latency per response')
+    parser.add_option('-L', '--loss', type='float', default=0.0,
+                      help='fraction of requests to drop')
+    parser.add_option('-m', '--max-varbinds', type='int', default=0,
+                      help='answer tooBig above this many varbinds')
+    options, args = parser.parse_args()
+    raise_file_limit(options.hosts)
+    server = AgentServer(build_agents(options.scenario, options.hosts,
+                                      options.community, options.latency,
+                                      options.loss, options.max_varbinds),
+                         options.address, options.port)
+    print 'serving %s on %s:%d-%d' % (options.scenario, options.address,
+                             options.port, options.port + options.hosts - 1)
+    sys.stdout.flush()
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        server.close()
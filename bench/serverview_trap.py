@@ -0,0 +1,113 @@
+#! /bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Sends ServerView-like traps, to test check_serverview.py -r
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Sends a trap (snmpv1/v2c) or an inform (snmpv3) like a ServerView agent,
+with the server name and a message, to a trap listener.
+
+    serverview_trap.py -P 16162 -p 2 -m "Fan 2 (FAN2 SYS) failed"
+    serverview_trap.py -P 16162 -p 3 -u nagios -A s3cret
+    serverview_trap.py -P 16162 -p 1 -o .1.3.6.1.6.3.1.1.5.1  # coldStart'''
+
+import sys
+import socket
+from optparse import OptionParser
+
+from pyasn1.codec.ber import encoder
+from pysnmp.entity.rfc3413.oneliner import cmdgen, ntforg
+from pysnmp.proto import api, rfc1155, rfc1902
+
+# a trap under the server control mib, and its server name and message
+TRAP_OID = '.1.3.6.1.4.1.231.2.10.2.2.10.0.1'
+OID_SYSNAME = (1, 3, 6, 1, 2, 1, 1, 5, 0)
+OID_MESSAGE = (1, 3, 6, 1, 4, 1, 231, 2, 10, 2, 11, 2, 2, 0)
+
+
+def oid2tuple(oid):
+    return tuple([int(x) for x in oid.strip('.').split('.')])
+
+def send_v1_trap(host, port, community, trap_oid, varbinds):
+    '''Sends an snmpv1 trap built by hand, pysnmp fails to convert a
+    notification to one. The trap oid maps back as in RFC 2576'''
+    v1 = api.protoModules[api.protoVersion1]
+    pdu = v1.TrapPDU()
+    v1.apiTrapPDU.setDefaults(pdu)
+    v1.apiTrapPDU.setAgentAddr(pdu, v1.IpAddress(host))
+    # the default is an INTEGER, receivers reject it
+    v1.apiTrapPDU.setTimeStamp(pdu, rfc1155.TimeTicks(0))
+    if trap_oid[:-1] == (1, 3, 6, 1, 6, 3, 1, 1, 5):
+        # coldStart(0) .. enterpriseSpecific(6)
+        v1.apiTrapPDU.setGenericTrap(pdu, trap_oid[-1] - 1)
+    else:
+        enterprise = trap_oid[:-1]
+        if enterprise[-1:] == (0,):
+            enterprise = enterprise[:-1]
+        v1.apiTrapPDU.setEnterprise(pdu, enterprise)
+        v1.apiTrapPDU.setGenericTrap(pdu, 6)
+        v1.apiTrapPDU.setSpecificTrap(pdu, trap_oid[-1])
+    v1.apiTrapPDU.setVarBinds(pdu, varbinds)
+    message = v1.Message()
+    v1.apiMessage.setDefaults(message)
+    v1.apiMessage.setCommunity(message, community)
+    v1.apiMessage.setPDU(message, pdu)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto(encoder.encode(message), (host, port))
+    sock.close()
+
+def main():
+    parser = OptionParser(usage='%prog [-H host] [-P port] [-p 1|2|3] ...')
+    parser.add_option('-H', '--host', default='127.0.0.1')
+    parser.add_option('-P', '--port', type='int', default=162)
+    parser.add_option('-p', '--protocol', type='int', default=2)
+    parser.add_option('-C', '--community', default='public')
+    parser.add_option('-u', '--user')
+    parser.add_option('-a', '--authprotocol', default='md5')
+    parser.add_option('-A', '--authkey')
+    parser.add_option('-X', '--privkey')
+    parser.add_option('-o', '--oid', default=TRAP_OID,
+                      help='trap oid (default %s)' % TRAP_OID)
+    parser.add_option('-s', '--server', default='rx300-degraded')
+    parser.add_option('-m', '--message', default='Fan 2 (FAN2 SYS) failed')
+    options, args = parser.parse_args()
+    varbinds = [(OID_SYSNAME, rfc1902.OctetString(options.server)),
+                (OID_MESSAGE, rfc1902.OctetString(options.message))]
+    if options.protocol == 1:
+        send_v1_trap(socket.gethostbyname(options.host), options.port,
+                     options.community, oid2tuple(options.oid), varbinds)
+        return
+    if options.protocol == 3:
+        authprot, privprot = cmdgen.usmNoAuthProtocol, cmdgen.usmNoPrivProtocol
+        if options.authkey:
+            authprot = cmdgen.usmHMACMD5AuthProtocol
+            if options.authprotocol == 'sha':
+                authprot = cmdgen.usmHMACSHAAuthProtocol
+        if options.privkey:
+            privprot = cmdgen.usmDESPrivProtocol
+        auth = cmdgen.UsmUserData(options.user, options.authkey,
+                                  options.privkey, authprot, privprot)
+        kind = 'inform'
+    else:
+        auth = cmdgen.CommunityData('trap-sender', options.community)
+        kind = 'trap'
+    error = ntforg.NotificationOriginator().sendNotification(auth,
+                cmdgen.UdpTransportTarget((options.host, options.port)),
+                kind, oid2tuple(options.oid), *varbinds)
+    if error:
+        sys.stderr.write('%s\n' % error)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#! /bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Measures the start of check_serverview.py, fails when slow
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Measures what starting the plugin costs, in new python processes like
+nagios starts it, and exits 1 when a case takes more than --max
+milliseconds beyond the start of a bare python, or loads pysnmp's engine
+or pyasn1 where it shouldn't.
+
+Cases:
+    import       python -c "import check_serverview"
+    help         check_serverview.py --help
+    version      check_serverview.py -V
+    usage_error  check_serverview.py with an unknown option
+    ber_check    an SNMPv2c check of a serverview_sim.py agent, with the
+                 built-in BER codec
+
+    startup_bench.py                          # all cases
+    startup_bench.py -m 50 -r 20              # stricter, more runs
+    startup_bench.py -z ../check_serverview.pyz   # the bundle.py zip'''
+
+import os
+import sys
+import time
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(BENCH_DIR)
+
+CASES = ('import', 'help', 'version', 'usage_error', 'ber_check')
+# modules none of the cases needs, pysnmp.proto.errind is a small one
+HEAVY_MODULES = ('pysnmp.entity', 'pysnmp.smi', 'pyasn1.type',
+                 'schau_pysnmp')
+
+
+def command(case, plugin, port):
+    '''The arguments to run case with'''
+    if case == 'import':
+        path = plugin
+        if not plugin.endswith('.pyz'):
+            path = os.path.dirname(os.path.abspath(plugin))
+        return ['-c', 'import sys; sys.path.insert(0, %r); '
+                      'import check_serverview' % path]
+    if case == 'help':
+        return [plugin, '--help']
+    if case == 'version':
+        return [plugin, '-V']
+    if case == 'usage_error':
+        return [plugin, '--no-such-option']
+    return [plugin, '-H', '127.0.0.1', '-P', str(port), '-p', '2']
+
+def measure(args):
+    '''Wall seconds of a python process with args'''
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        subprocess.call([sys.executable] + args, stdout=devnull,
+                        stderr=devnull)
+    finally:
+        devnull.close()
+    return time.time() - start
+
+def heavy_modules(args):
+    '''The HEAVY_MODULES a python process with args has loaded at exit'''
+    devnull = open(os.devnull, 'w')
+    try:
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  '--child'] + args, stdout=devnull,
+                                 stderr=subprocess.PIPE)
+        output = child.communicate()[1]
+    finally:
+        devnull.close()
+    # after whatever the plugin wrote to stderr
+    return output.splitlines()[-1].split()
+
+def child(args):
+    '''Runs args like python would, then writes the heavy modules loaded
+    to stderr. Nothing else is imported here before'''
+    import runpy
+    try:
+        if args[0] == '-c':
+            sys.argv = ['-c']
+            exec args[1] in {'__name__': '__main__'}
+        else:
+            sys.argv = args
+            sys.path[0] = args[0]
+            if not args[0].endswith('.pyz'):
+                sys.path[0] = os.path.dirname(os.path.abspath(args[0]))
+            runpy.run_path(args[0], run_name='__main__')
+    except SystemExit:
+        pass
+    sys.stderr.write('\n' + ' '.join([name for name in HEAVY_MODULES
+                                   if name in sys.modules]) + '\n')
+
+def serve(port):
+    '''Runs a simulated agent, in a process of its own'''
+    sys.path.insert(0, BENCH_DIR)
+    from serverview_sim import AgentServer, build_agents
+    AgentServer(build_agents('healthy', 1), port=port).serve()
+
+def main():
+    parser = OptionParser(usage='%prog [-c case] [-r runs] [-m ms] [-z pyz]')
+    parser.add_option('-c', '--case', action='append',
+                      help='%s (default all)' % ', '.join(CASES))
+    parser.add_option('-r', '--repeat', type='int', default=10,
+                      help='runs per case, the fastest is reported')
+    parser.add_option('-m', '--max', type='float', default=60.0,
+                      help='milliseconds a case may take beyond a bare '
+                           'python start (default 60)')
+    parser.add_option('-P', '--port', type='int', default=17050,
+                      help='udp port of the simulated agent')
+    parser.add_option('-z', '--zip',
+                      help='measure this check_serverview.pyz instead')
+    options, args = parser.parse_args()
+    cases = options.case or CASES
+    plugin = options.zip or os.path.join(PLUGIN_DIR, 'check_serverview.py')
+    server = multiprocessing.Process(target=serve, args=(options.port,))
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+    failed = False
+    try:
+        bare = min([measure(['-c', 'pass'])
+                    for nr in range(options.repeat)])
+        print '%-12s %9s %9s  %s' % ('case', 'wall', 'startup', 'heavy modules')
+        print '%-12s %8.1fms' % ('python', 1000 * bare)
+        for case in cases:
+            args = command(case, plugin, options.port)
+            wall = min([measure(args) for nr in range(options.repeat)])
+            startup = 1000 * (wall - bare)
+            heavy = heavy_modules(args)
+            print '%-12s %8.1fms %8.1fms  %s' % (case, 1000 * wall, startup,
+                                                 ' '.join(heavy) or '-')
+            sys.stdout.flush()
+            if startup > options.max or heavy:
+                failed = True
+    finally:
+        server.terminate()
+    if failed:
+        print 'FAILED: slower than %.0fms or heavy modules loaded' % \
+              options.max
+        sys.exit(1)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2:])
+    else:
+        main()
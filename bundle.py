@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Builds check_serverview.pyz, the plugin in one file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Builds check_serverview.pyz: the plugin and its modules compiled to
+bytecode in one executable zip file, run like check_serverview.py
+
+    bundle.py                     # ./check_serverview.pyz
+    bundle.py -o /usr/lib/nagios/plugins/check_serverview.pyz -s
+    check_serverview.pyz -H rx300-01 -p 2
+
+python imports the bytecode from the zip as it is: no source to read and
+compile on every start, and no writable .pyc files needed next to the
+plugin. The bytecode is only good for the python version that builds the
+zip, so build it with the python that runs the checks (the #! line points
+to that one).
+
+With -s the pysnmp and pyasn1 packages (for SNMPv3, -k pysnmp and the trap
+listener) go into the zip too, pysnmp reads its mibs from there. PyCrypto
+can't be imported from a zip, -X still needs it installed.'''
+
+import os
+import sys
+import imp
+import time
+import struct
+import marshal
+import zipfile
+import cStringIO
+from optparse import OptionParser
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+# check_serverview itself is also __main__, for the python that runs the zip
+MODULES = ('check_serverview', 'schau_utils', 'schau_snmp', 'schau_pysnmp',
+           'schau_cache', 'schau_daemon', 'schau_traps', 'schau_scheduler',
+           'schau_exporter', 'schau_state', 'schau_shard',
+           'serverview_mib')
+PACKAGES = ('pysnmp', 'pyasn1')
+
+
+def compiled(path, name):
+    '''The .pyc file contents of the source in path, name shows in the
+    tracebacks'''
+    source = open(path, 'rU').read()
+    code = compile(source + '\n', name, 'exec')
+    mtime = int(os.stat(path).st_mtime)
+    return imp.get_magic() + struct.pack('<L', mtime) + marshal.dumps(code)
+
+def package_sources(package):
+    '''(path, name in the zip without .py) of every module of an installed
+    package'''
+    top = os.path.dirname(__import__(package).__file__)
+    base = os.path.dirname(top)
+    sources = []
+    for directory, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.py'):
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, base)[:-3]
+                sources.append((path, name.replace(os.sep, '/')))
+    return sources
+
+def build(output, interpreter, with_packages):
+    '''Writes the zip to output, returns the number of modules in it'''
+    sources = []
+    for module in MODULES:
+        sources.append((os.path.join(PLUGIN_DIR, module + '.py'), module))
+    sources.append((os.path.join(PLUGIN_DIR, 'check_serverview.py'),
+                    '__main__'))
+    if with_packages:
+        for package in PACKAGES:
+            sources.extend(package_sources(package))
+    archive = cStringIO.StringIO()
+    bundle = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED)
+    for path, name in sources:
+        info = zipfile.ZipInfo(name + '.pyc',
+                               time.localtime(os.stat(path).st_mtime)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16
+        bundle.writestr(info, compiled(path, os.path.basename(path)))
+    bundle.close()
+    # written next to it and renamed, a check starting meanwhile runs the
+    # old or the new one
+    temp_path = output + '.tmp'
+    f = open(temp_path, 'wb')
+    try:
+        f.write('#!%s\n' % interpreter)
+        f.write(archive.getvalue())
+    finally:
+        f.close()
+    os.chmod(temp_path, 0755)
+    os.rename(temp_path, output)
+    return len(sources)
+
+def main():
+    parser = OptionParser(usage='%prog [-o output] [-s] [-i interpreter]')
+    parser.add_option('-o', '--output', default='check_serverview.pyz')
+    parser.add_option('-s', '--with-pysnmp', action='store_true',
+                      help='bundle pysnmp and pyasn1 too')
+    parser.add_option('-i', '--interpreter', default=sys.executable,
+                      help='#! line of the zip, a python %d.%d '
+                           '(default %s)' % (sys.version_info[:2] +
+                                             (sys.executable,)))
+    options, args = parser.parse_args()
+    modules = build(options.output, options.interpreter, options.with_pysnmp)
+    print '%s: %d modules, %d bytes' % (options.output, modules,
+                                        os.path.getsize(options.output))
+
+if __name__ == '__main__':
+    main()
@@ -16,22 +16,103 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from schau_utils import NagiosPlugin
-from schau_snmp import SnmpClient, SnmpError
+import time
+_imports_started = time.time()
+import sys
+import socket
+
+from schau_utils import NagiosPlugin, CheckResultSpool, CommandPipe
+from schau_cache import ResultCache, UsmStateCache, PollState, \
+                        CircuitBreaker, CacheError
+from schau_snmp import SnmpClient, SnmpClientPool, SnmpDispatcher, \
+                       SnmpError, SnmpNoInstanceError, SnmpBadArgumentError, \
+                       SnmpTimeoutError, Return, run_task
+from serverview_mib import STATUS, GLOBAL_STATUS, SUBSYSTEM_NAMES, \
+                           SUBSYSTEM_COUNT, SUBSYSTEM_TABLE, SYS_UPTIME, \
+                           COMPONENTS, REGISTRY, dotted, trap_kind
+# seconds importing the modules, pysnmp mostly
+IMPORT_TIME = time.time() - _imports_started
 
 ###################################################
 ###   Definitions for building a NagiosPlugin   ###
 ###################################################
 
-
 opties = {
     'host' : {'char': 'H', 'type':'string'},
     'protocol' : {'char': 'p', 'type':'int', 'default':1},
     'port' : {'char': 'P', 'type':'int', 'default':161},
+    'endpoints' : {'char': 'E', 'type':'string'},
     'community' : {'char': 'C', 'type':'string', 'default':'public'},
-    'ignore' : {'char': 'i', 'type':'string', 'default':''}
+    'user' : {'char': 'u', 'type':'string'},
+    'authprotocol' : {'char': 'a', 'type':'string', 'default':'md5'},
+    'authkey' : {'char': 'A', 'type':'string'},
+    'privkey' : {'char': 'X', 'type':'string'},
+    'ignore' : {'char': 'i', 'type':'string', 'default':''},
+    'hostfile' : {'char': 'f', 'type':'string'},
+    'concurrency' : {'char': 'n', 'type':'int', 'default':50},
+    'interval' : {'char': 'I', 'type':'int', 'default':0},
+    'retryinterval' : {'char': 'R', 'type':'int', 'default':60},
+    'subnetconcurrency' : {'char': 'N', 'type':'int', 'default':0},
+    'checkresults' : {'char': 'Q', 'type':'string'},
+    'commandfile' : {'char': 'F', 'type':'string'},
+    'service' : {'char': 'S', 'type':'string', 'default':'ServerView'},
+    'exporter' : {'char': 'x', 'type':'string'},
+    'flaps' : {'char': 'j', 'type':'int', 'default':0},
+    'snapshot' : {'char': 'o', 'type':'string'},
+    'shard' : {'char': 'G', 'type':'string'},
+    'member' : {'char': 'M', 'type':'string'},
+    'daemon' : {'char': 'D', 'type':'string'},
+    'cache' : {'char': 'd', 'type':'string'},
+    'cachettl' : {'char': 'T', 'type':'int', 'default':60},
+    'backoff' : {'char': 'b', 'type':'int', 'default':60},
+    'codec' : {'char': 'k', 'type':'string', 'default':'ber'},
+    'deep' : {'char': 'e', 'type':'int', 'default':0},
+    'state' : {'char': 's', 'type':'string'},
+    'maxage' : {'char': 'm', 'type':'int', 'default':300},
+    'traps' : {'char': 'r', 'type':'string'}
     }
 
+# rows per GETBULK request when reading the component tables
+COMPONENT_REPETITIONS = 10
+
+# seconds the results of --interval are collected per --checkresults file
+# or --commandfile write
+FLUSH_INTERVAL = 10
+
+# polls kept per host for --flaps, and seconds between --snapshot writes
+FLEET_HISTORY = 8
+SNAPSHOT_INTERVAL = 60
+
+# seconds between the heartbeats of a --shard poller, and without one
+# before the others take over its hosts
+SHARD_HEARTBEAT = 10
+SHARD_TIMEOUT = 30
+
+# what --exporter serves per target
+METRICS = [
+    ('serverview_up', 'gauge',
+     '1 when the last poll read the status of the agent'),
+    ('serverview_check_status', 'gauge',
+     'Nagios state of the last poll: 0 ok, 1 warning, 2 critical, 3 unknown'),
+    ('serverview_global_status', 'gauge',
+     'ServerView global status: 1 ok, 2 degraded, 3 error, 4 failed, '
+     '5 unknown-init'),
+    ('serverview_subsystem_status', 'gauge',
+     'Status of a subsystem, as serverview_global_status'),
+    ('serverview_snmp_requests', 'gauge',
+     'SNMP requests of the last poll, retries included'),
+    ('serverview_snmp_timeouts', 'gauge',
+     'SNMP requests of the last poll without a response in time'),
+    ('serverview_snmp_rtt_avg_seconds', 'gauge',
+     'Average round trip time of the last poll'),
+    ('serverview_snmp_rtt_max_seconds', 'gauge',
+     'Longest round trip time of the last poll'),
+    ('serverview_poll_duration_seconds', 'gauge',
+     'Seconds the last poll took'),
+    ('serverview_last_poll_timestamp_seconds', 'gauge',
+     'When the last poll finished'),
+    ]
+
 help = {
 # filename of the plugin
 'filename':
@@ -54,7 +135,19 @@ Copyright (c) 2007 Gruwier Stijn''',
 # Commandline usage
 'use' :
 '''Usage:	check_serverview.py -H host [-C community] [-p protocol] [-P port]
+		[-E host[:port][,host[:port]...]]
+		[-u user [-a md5|sha] -A authkey [-X privkey]]
 		[-i|--ignore=subsystem1[,subsystem2[,...]]]
+		[-d cachedir [-T ttl] [-b backoff]]
+		[-k ber|pysnmp] [-e pdus] [-s statedir [-m maxage]]
+	check_serverview.py -f hostfile [-n concurrency] [options]
+		[-I interval [-R retryinterval] [-N subnetconcurrency]]
+		[-Q checkresultdir | -F commandfile] [-S service]
+		[-j changes] [-o snapshotfile] [-G sharddir [-M name]]
+	check_serverview.py -f hostfile -x [address:]port [-I interval] [options]
+	check_serverview.py -D socket
+	check_serverview.py -r [address:]port -s statedir [-C community]
+		[-u user [-a md5|sha] -A authkey [-X privkey]]
 	check_serverview.py (-h|--help)
 	check_serverview.py (-V|--version)''', 
 
@@ -65,16 +158,127 @@ Copyright (c) 2007 Gruwier Stijn''',
     Connect to hostname
  -P, --port
     Connect using this udp port (default 161)
+ -E, --endpoints=HOST[:PORT],HOST[:PORT]
+    Other addresses of the same agent, a second network or a standby
+    management controller (default port --port). The requests go to the
+    address that answered last, and also to the next one when no response
+    came within the 95th percentile of its recent round trip times: the
+    first response is used. Addresses that miss two requests in a row are
+    asked last
  -p, --protocol=[1|2|3]
     Snmp version to use (default 1)
     Affects the community option
  -C, --community=COMMUNITY
-    community string with SNMPv1/v2 OR <user>:<password> with SNMPv3
-    Default: public
+    community string with SNMPv1/v2 (default: public)
+    With SNMPv3 and no --user, <user>:<authkey> still works
+ -u, --user=USER
+    SNMPv3 security name
+ -a, --authprotocol=[md5|sha]
+    SNMPv3 authentication protocol (default md5)
+ -A, --authkey=PASSPHRASE
+    SNMPv3 authentication passphrase, authNoPriv without --privkey
+ -X, --privkey=PASSPHRASE
+    SNMPv3 DES privacy passphrase, for authPriv
  -i, --ignore=SUBSYSTEM1,SUBSYSTEM2,SUBSYSTEM3
     list of subsystem names to ignore
     comma separated(do not use spaces!)
     Added this feature because I don't care about the deployment subsystem
+ -d, --cache=DIRECTORY
+    Share the results with the other checks of the same agent during the
+    --cachettl: the first check asks the agent, the others read its result
+    from DIRECTORY. Not used with --hostfile
+    With SNMPv3 the engine id, boots, time and localized keys of the agent
+    are kept there too, saving the discovery round trips of later checks
+ -T, --cachettl=SECONDS
+    Seconds a cached result is used (default 60)
+ -b, --backoff=SECONDS
+    With --cache, after 3 checks in a row without any answer from an agent
+    the next checks return the last failure at once for SECONDS, then one
+    check asks the agent again. Every time that one fails too, SECONDS
+    doubles, up to an hour. Also with --hostfile (default 60, 0 disables)
+ -k, --codec=[ber|pysnmp]
+    Encode and decode SNMPv1/v2 messages with the built-in BER codec
+    (default) or with pysnmp. SNMPv3 always uses pysnmp
+ -e, --deep=PDUS
+    When subsystems are not ok, also read their component tables
+    (temperature sensors, fans, power supplies, logical drives) in at most
+    PDUS more requests. The failed components are added to the message,
+    the temperatures, fan speeds and power supply loads to the perfdata
+    (default 0, don't)
+ -s, --state=DIRECTORY
+    Keep the result of the last full poll of every agent in DIRECTORY.
+    Within --maxage the next checks only ask the global status, subsystem
+    count and sysUpTime, and read the subsystems again when one of them
+    changed (or the agent rebooted). Also with --hostfile
+ -m, --maxage=SECONDS
+    Seconds the state of an agent is used before it is polled in full
+    again (default 300)
+ -r, --traps=[ADDRESS:]PORT
+    Keep running and receive the SNMPv1/v2c traps (--community) and SNMPv3
+    informs (--user) of the agents on udp PORT, into the --state
+    directory. While it runs, checks within --maxage of the last poll
+    answer from the state without asking the agent, unless a ServerView,
+    raid or restart trap came in since
+ -f, --hostfile=FILE
+    Check all hosts in FILE ('-' for stdin) at once, prints one result
+    line per host. Every line holds the options for one host and may start
+    with a bare hostname, missing options are taken from the commandline:
+      rx300-01 -p 2 -C s3cret
+ -n, --concurrency=NUMBER
+    Hosts checked at the same time with --hostfile (default 50)
+ -I, --interval=SECONDS
+    With --hostfile, keep checking the hosts until interrupted: the OK
+    ones every SECONDS, give or take 10%, the first checks spread over
+    SECONDS (default 0, check every host once)
+ -R, --retryinterval=SECONDS
+    Seconds between the checks of the hosts that are not OK or flap
+    between states, with --interval (default 60)
+ -N, --subnetconcurrency=NUMBER
+    Hosts of the same /24 subnet checked at the same time with --interval
+    (default 0, no limit besides --concurrency)
+ -Q, --checkresults=DIRECTORY
+    With --hostfile, write the results as passive service check results
+    into the check_result_path DIRECTORY of nagios or icinga instead of
+    printing them: one file per run, with --interval one file every 10
+    seconds with the results that came in meanwhile
+ -F, --commandfile=FILE
+    With --hostfile, write the results to the external command FILE of
+    nagios or icinga as PROCESS_SERVICE_CHECK_RESULT commands instead of
+    printing them, in as few writes as possible: with --interval the
+    results that came in during 10 seconds are written together
+ -S, --service=DESCRIPTION
+    Service description of the passive results, the host name is the one
+    in the --hostfile (default ServerView)
+ -x, --exporter=[ADDRESS:]PORT
+    Keep polling the hosts in the --hostfile like --interval (default 60)
+    and serve their last results as Prometheus metrics on http PORT:
+    /metrics for all hosts, /probe?target=HOST[:PORT] for one. Scrapes
+    are answered from memory, they never wait for snmp. With
+    --checkresults or --commandfile the results go to nagios too
+ -j, --flaps=CHANGES
+    With --interval or --exporter, keep the last 8 polls of every host and
+    leave out the subsystems whose status changed CHANGES times among
+    them, like a deployment subsystem going from ok to unknown-init and
+    back. The result names the ones flapping (default 0, don't)
+ -o, --snapshot=FILE
+    With --interval or --exporter, write the polls kept for --flaps to
+    FILE every minute and when stopped, and read them back when started
+ -G, --shard=DIRECTORY
+    With --interval or --exporter, share the hosts of the --hostfile with
+    the other pollers using DIRECTORY: every poller checks the hosts that
+    consistent hashing assigns to it. When a poller stops, or misses its
+    heartbeats for 30 seconds, the others take over its hosts; when one
+    starts, it takes a share of them
+ -M, --member=NAME
+    Name of this poller in the --shard DIRECTORY, unique and the same
+    after a restart (default the hostname)
+ -D, --daemon=SOCKET
+    Keep running and answer the checks of check_serverview_client.py on
+    unix socket SOCKET. Saves the startup of python and snmp per check,
+    snmp clients are kept per host. The checks sent hold communities and
+    passphrases: put SOCKET in a directory only the nagios user can write
+    to, like /var/run/check_serverview, and set CHECK_SERVERVIEW_SOCKET
+    to it for the client
  -w, --warning=WARNINGLEVEL
     Exit with WARNING status if a variable matches WARNINGLEVEL
     not implemented
@@ -83,7 +287,9 @@ Copyright (c) 2007 Gruwier Stijn''',
     not implemented
  -t, --timeout=SECONDS
     seconds before plugin times out (default: 25)
-    not implemented
+    Requests are sent again as long as the round trips to the agent
+    measured so far make reasonable; when the time is up the check is
+    UNKNOWN with what was read so far
  -v, --verbose=[0-]
     Set the amount of output
     not implemented
@@ -97,8 +303,17 @@ Copyright (c) 2007 Gruwier Stijn''',
 '''Bugs:	Let me know - stijn.gruwier@gmailnotforads.com
         *remove the 'notforads' substring from the address*''' }
 
-def serverview_function(options):
+def serverview_function(options, pool=None):
+    return run_task(serverview_task(options, pool=pool))
+
+def serverview_task(options, dispatcher=None, pool=None, details=None):
+    '''Coroutine behind serverview_function, returns (status, message,
+    '', perfdata) once the snmp client is set up, else (status, message)
+    With a dispatcher, many hosts can be checked at once. With a pool
+    (SnmpClientPool) the snmp client is reused by later checks. A details
+    dictionary gets what problem_list_task read'''
     # TODO: more option checks
+    start = time.time()
     ignorelist = []
     host = options['host']
     community = options['community']
@@ -107,75 +322,850 @@ def serverview_function(options):
     port = options['port']
     ignore = options['ignore']
     if not host:
-        return('UNKNOWN', '-H, --host is a required argument')
+        yield Return(('UNKNOWN', '-H, --host is a required argument'))
     if not community:
-        return('UNKNOWN', '-C, --community is a required argument')
+        yield Return(('UNKNOWN', '-C, --community is a required argument'))
     if not protocol in (1,2,3):
-        return('UNKNOWN', 'invalid protocol')
+        yield Return(('UNKNOWN', 'invalid protocol'))
     if ignore:
         ignorelist = ignore.lower().split(',')
+    cache = None
+    if options['cache'] and dispatcher is None:
+        # a blocking cache lock would stall all hosts of a dispatcher
+        try:
+            cache = ResultCache(options['cache'], options['cachettl'],
+                                lock_timeout=timeout)
+        except CacheError, e:
+            yield Return(('UNKNOWN', 'cache: %s' % e.value))
+    if not options['codec'] in ('ber', 'pysnmp'):
+        yield Return(('UNKNOWN', 'invalid codec'))
+    if options['deep'] < 0:
+        yield Return(('UNKNOWN', '-e, --deep must be 0 or more requests'))
+    breaker = None
+    if options['cache'] and options['backoff'] > 0:
+        # short locks, fine with a dispatcher
+        try:
+            breaker = CircuitBreaker(options['cache'],
+                                     backoff=options['backoff'])
+        except CacheError, e:
+            yield Return(('UNKNOWN', 'cache: %s' % e.value))
+        opened = breaker.check((host, port), timeout)
+        if opened is not None:
+            status, message, wait = opened
+            yield Return((status, '%s - agent not asked, next try in %ds' %
+                          (message, wait), '', [('time', time.time() - start,
+                          's', None, None, 0, timeout)]))
+    poll_state = None
+    if options['state']:
+        # a few small files per check, no locks: fine with a dispatcher
+        try:
+            poll_state = PollState(options['state'], options['maxage'])
+        except CacheError, e:
+            yield Return(('UNKNOWN', 'state: %s' % e.value))
+    endpoints = None
+    if options['endpoints']:
+        try:
+            endpoints = _endpoints(options['endpoints'], port)
+        except ValueError:
+            yield Return(('UNKNOWN', 'invalid endpoints %r' %
+                          options['endpoints']))
     if protocol in (1,2):
-        snmp = SnmpClient(host, protocol, community,port=port)
+        client_args = {'community': community, 'port': port,
+                       'codec': options['codec']}
+    else:
+        user, authkey = options['user'], options['authkey']
+        if not user and ':' in community:
+            # the old <user>:<password> community
+            user, authkey = community.split(':', 1)
+        if not user:
+            yield Return(('UNKNOWN', '-u, --user is a required argument for snmpv3'))
+        if not options['authprotocol'] in ('md5', 'sha'):
+            yield Return(('UNKNOWN', 'invalid authentication protocol'))
+        if options['privkey'] and not authkey:
+            yield Return(('UNKNOWN', '-X, --privkey needs -A, --authkey'))
+        client_args = {'user': user, 'authkey': authkey,
+                       'privkey': options['privkey'],
+                       'authProtocol': options['authprotocol'],
+                       'port': port}
+        if cache is not None and pool is None and endpoints is None:
+            # pooled clients keep their engine anyway
+            client_args['usm_cache'] = UsmStateCache(options['cache'])
+    if endpoints is not None:
+        client_args['endpoints'] = endpoints
+    try:
+        if pool is None:
+            snmp = SnmpClient(host, protocol, dispatcher=dispatcher,
+                              timeout=timeout, **client_args)
+        else:
+            snmp = pool.acquire(host, protocol, **client_args)
+            # the wait for the pooled client counts too
+            snmp.set_timeout(max(0, start + timeout - time.time()))
+    except SnmpBadArgumentError, e:
+        yield Return(('UNKNOWN', e.value))
+    # a pooled client gets new stats with its next timeout
+    stats = snmp.stats
+    if pool is None:
+        status, message, perfdata = yield _serverview_result(snmp,
+                    ignorelist, cache, options['deep'], poll_state, details)
     else:
-        user, key = community.split(':')
-        snmp = SnmpClient(host, protocol, community=community,port=port)
+        try:
+            status, message, perfdata = yield _serverview_result(snmp,
+                    ignorelist, cache, options['deep'], poll_state, details)
+        finally:
+            pool.release(snmp)
+    if breaker is not None and stats.requests:
+        if stats.rtts:
+            breaker.success((host, port))
+        else:
+            breaker.failure((host, port), status, message)
+    perfdata = perfdata + stats.perfdata()
+    if dispatcher is None and pool is None:
+        # a process of its own
+        perfdata.append(('time_import', IMPORT_TIME, 's', None, None, 0))
+    perfdata.append(('time', time.time() - start, 's', None, None, 0,
+                     timeout))
+    yield Return((status, message, '', perfdata))
+
+def _endpoints(value, port):
+    '''The host[:port],.. of --endpoints as a tuple of (host, port), raises
+    ValueError'''
+    endpoints = []
+    for endpoint in value.split(','):
+        host, endpoint_port = endpoint, port
+        if ':' in endpoint:
+            host, endpoint_port = endpoint.rsplit(':', 1)
+            endpoint_port = int(endpoint_port)
+        if not host:
+            raise ValueError(endpoint)
+        endpoints.append((host, endpoint_port))
+    return tuple(endpoints)
+
+def _serverview_result(snmp, ignorelist, cache=None, deep=0, poll_state=None,
+                       details=None):
+    '''Checks the subsystems with snmp client snmp, returns (status, message,
+    perfdata). With deep, the components of the failed subsystems are read
+    in at most deep more requests'''
     problem_list = []
     problem_string, subsystems_string = '', ''
     try:
-        subsystems_string, problem_list = get_problem_list(snmp, ignorelist) 
+        subsystems_string, problem_list = yield problem_list_task(snmp,
+                                    ignorelist, cache, poll_state, details)
+    except SnmpTimeoutError, e:
+        if e.partial is None:
+            yield Return(('UNKNOWN', e.value, []))
+        # the global status was read, not the failed subsystems
+        subsystems, global_status = e.partial
+        yield Return(('UNKNOWN', '%s - global status %s, failed subsystems '
+                      'not read: %s' % (e.value,
+                      STATUS.get(global_status, 'outofrange'),
+                      _subsystem_list(subsystems, ignorelist)), []))
     except SnmpError:
-        return('CRITICAL', 'network or snmp related problem - NOT a hardware problem')
+        yield Return(('CRITICAL', 'network or snmp related problem - NOT a hardware problem', []))
+    failed_components, perfdata, note = {}, [], ''
+    if problem_list and deep:
+        names = [problem[0] for problem in problem_list]
+        try:
+            if cache is None:
+                failed_components, perfdata, complete = yield component_task(
+                                                            snmp, names, deep)
+            else:
+                names.sort()
+                failed_components, perfdata, complete = cache.call(
+                    _cache_key(snmp),
+                    'components:%s:%d' % (','.join(names), deep),
+                    lambda: run_task(component_task(snmp, names, deep)))
+            if not complete:
+                note = ' - components incomplete after %d requests' % deep
+        except SnmpError, e:
+            # the subsystems are known, the check stays CRITICAL
+            note = ' - components not read: %s' % e.value
     for problem in problem_list:
         name, status, last_error = problem
-        problem_string = problem_string + '%s: %s%s - ' % (name,status,last_error)    
+        problem_string = problem_string + '%s: %s%s%s - ' % (name,status,
+                        last_error, _component_list(failed_components, name))
     problem_string = problem_string.strip('- ')
     if problem_list:
-        return('CRITICAL', problem_string)
+        yield Return(('CRITICAL', problem_string + note, perfdata))
+    else:
+        yield Return(('OK', 'All subsystems are good: %s' % subsystems_string,
+                      []))
+
+def _component_list(failed_components, name):
+    '''The failed components of subsystem name as " [name: status, ...]"'''
+    if not failed_components.get(name):
+        return ''
+    return ' [%s]' % ', '.join(['%s: %s' % component
+                                for component in failed_components[name]])
+
+def serverview_batch(plugin, options):
+    '''Checks all hosts in the --hostfile concurrently over one socket,
+    prints a result line per host, returns the highest exit code
+
+    Every line of the host file holds the options for one host, the first
+    word may be a bare hostname; options not on the line are taken from
+    the commandline, e.g.:
+        rx300-01
+        rx300-02 -p 2 -C s3cret -i deployment
+        -H 10.1.2.3 -P 1161'''
+    dispatcher = SnmpDispatcher()
+    sink = _result_sink(options)
+    exitcodes = [0]
+    def tasks():
+        for host_options in _hostfile_options(plugin, options):
+            yield host_options['host'], serverview_task(host_options,
+                                                        dispatcher)
+    def done(host, result, error):
+        exitcodes.append(_report_result(plugin, host, result, error, sink,
+                                        options['service']))
+    try:
+        dispatcher.run(tasks(), done, options['concurrency'])
+    finally:
+        if sink is not None:
+            sink.close()
+    return max(exitcodes)
+
+def serverview_schedule(plugin, options):
+    '''Keeps checking the hosts in the --hostfile, each every --interval
+    seconds while it's OK and every --retryinterval seconds when it isn't
+    or flaps, prints a result line per check. Runs until interrupted'''
+    from schau_scheduler import PollScheduler
+    dispatcher = SnmpDispatcher()
+    sink = _result_sink(options)
+    hosts = _hostfile_options(plugin, options)
+    fleet = _fleet(options)
+    snapshot = _snapshots(fleet, options)
+    def check(nr):
+        if fleet is None:
+            return serverview_task(hosts[nr], dispatcher)
+        return fleet_task(hosts[nr], fleet, dispatcher)
+    def done(nr, result, error):
+        _report_result(plugin, hosts[nr]['host'], result, error, sink,
+                       options['service'])
+        snapshot()
+    scheduler = PollScheduler(dispatcher, check, done,
+        options['interval'], options['retryinterval'],
+        options['concurrency'], options['subnetconcurrency'],
+        flush=sink and (lambda: _flush_results(sink)),
+        flush_interval=FLUSH_INTERVAL)
+    try:
+        _poll_hosts(scheduler, hosts, options, _membership(options))
+    finally:
+        snapshot(True)
+        if sink is not None:
+            sink.close()
+
+def serverview_exporter(plugin, options):
+    '''Polls the hosts in the --hostfile in the background like
+    serverview_schedule, and serves their last results as metrics on the
+    --exporter address until interrupted. With --checkresults or
+    --commandfile the results go to nagios as well'''
+    import threading
+    from schau_scheduler import PollScheduler
+    from schau_exporter import MetricsExporter
+    address, port = '', options['exporter']
+    if ':' in port:
+        address, port = port.rsplit(':', 1)
+    port = int(port)
+    exporter = MetricsExporter(METRICS)
+    dispatcher = SnmpDispatcher()
+    hosts = _hostfile_options(plugin, options)
+    fleet = _fleet(options)
+    snapshot = _snapshots(fleet, options)
+    # written from the poller thread only
+    sink = _result_sink(options)
+    # details of the polls running, by host number
+    polls = {}
+    def check(nr):
+        polls[nr] = {}
+        if fleet is None:
+            return serverview_task(hosts[nr], dispatcher, details=polls[nr])
+        return fleet_task(hosts[nr], fleet, dispatcher, polls[nr])
+    def done(nr, result, error):
+        exporter.set(_target(hosts[nr]), _metrics(plugin, hosts[nr], result,
+                                                  error, polls.pop(nr)))
+        if sink is not None:
+            _report_result(plugin, hosts[nr]['host'], result, error, sink,
+                           options['service'])
+        snapshot()
+    scheduler = PollScheduler(dispatcher, check, done,
+        options['interval'] or 60, options['retryinterval'],
+        options['concurrency'], options['subnetconcurrency'],
+        flush=sink and (lambda: _flush_results(sink)),
+        flush_interval=FLUSH_INTERVAL)
+    membership = _membership(options)
+    def poll():
+        try:
+            # a host handed to another poller is served there
+            _poll_hosts(scheduler, hosts, options, membership,
+                        lambda nr: exporter.forget(_target(hosts[nr])))
+        finally:
+            # the fleet is recorded in this thread, not thread safe
+            snapshot(True)
+            if sink is not None:
+                _flush_results(sink, True)
+    poller = threading.Thread(target=poll)
+    poller.setDaemon(True)
+    poller.start()
+    try:
+        exporter.serve((address, port))
+    finally:
+        scheduler.stop()
+        # a join without timeout can't be interrupted
+        while poller.isAlive():
+            poller.join(1)
+
+def _membership(options):
+    '''The ShardMembership of this poller in --shard, None without'''
+    if not options['shard']:
+        return None
+    from schau_shard import ShardMembership
+    return ShardMembership(options['shard'],
+                           options['member'] or socket.gethostname(),
+                           SHARD_TIMEOUT)
+
+def _poll_hosts(scheduler, hosts, options, membership=None, removed=None):
+    '''Runs scheduler on the hosts of the --hostfile until it is stopped.
+    With a ShardMembership only on the hosts assigned to this poller,
+    following the other pollers coming and going: removed(nr) is called
+    for every host taken over by another one'''
+    def add(nr):
+        subnet = None
+        if options['subnetconcurrency']:
+            subnet = _subnet(hosts[nr]['host'])
+        scheduler.add(nr, subnet)
+    if membership is None:
+        for nr in range(len(hosts)):
+            add(nr)
+        scheduler.run()
+        return
+    from schau_shard import HashRing
+    keys = ['%s:%d' % (host['host'], host['port']) for host in hosts]
+    owned, members = {}, None
+    try:
+        while not scheduler.stopped:
+            alive = membership.heartbeat()
+            if alive != members:
+                members = alive
+                ring = HashRing(members)
+                for nr in range(len(hosts)):
+                    mine = ring.owner(keys[nr]) == membership.name
+                    if mine and not nr in owned:
+                        owned[nr] = True
+                        add(nr)
+                    elif not mine and nr in owned:
+                        del owned[nr]
+                        scheduler.remove(nr)
+                        if removed is not None:
+                            removed(nr)
+            until = time.time() + SHARD_HEARTBEAT
+            scheduler.run(until)
+            # run returns at once without hosts
+            while not scheduler.stopped and time.time() < until:
+                time.sleep(min(scheduler.STOP_CHECK, until - time.time()))
+    finally:
+        membership.leave()
+
+def _target(options):
+    '''A host of the --hostfile as exporter target, with its port when it
+    isn't 161'''
+    if options['port'] != 161:
+        return '%s:%d' % (options['host'], options['port'])
+    return options['host']
+
+def fleet_task(options, fleet, dispatcher=None, details=None):
+    '''serverview_task that leaves out the subsystems flapping in fleet, a
+    FleetState, and records the poll there. A details dictionary gets
+    what problem_list_task read'''
+    key = (options['host'], options['port'])
+    flapping = []
+    if fleet.flap_changes:
+        flapping = fleet.flapping(key)
+    if flapping:
+        options = options.copy()
+        ignore = [name.lower() for name in flapping]
+        if options['ignore']:
+            ignore.append(options['ignore'])
+        options['ignore'] = ','.join(ignore)
+    if details is None:
+        details = {}
+    result = yield serverview_task(options, dispatcher, details=details)
+    rtt = None
+    if len(result) > 3:
+        for item in result[3]:
+            if item[0] == 'rtt_avg' and item[1]:
+                rtt = item[1]
+    fleet.record(key, details, rtt)
+    if flapping:
+        result = (result[0], '%s - flapping: %s' % (result[1],
+                  ','.join(flapping))) + tuple(result[2:])
+    yield Return(result)
+
+def _fleet(options):
+    '''The FleetState for --flaps and --snapshot, None without them'''
+    if not options['flaps'] and not options['snapshot']:
+        return None
+    from schau_state import FleetState
+    fleet = FleetState(FLEET_HISTORY, options['flaps'])
+    if options['snapshot']:
+        fleet.restore(options['snapshot'])
+    return fleet
+
+def _snapshots(fleet, options):
+    '''A function writing fleet to the --snapshot file once every
+    SNAPSHOT_INTERVAL seconds, or at once when called with True'''
+    written = [time.time()]
+    def snapshot(now=False):
+        if fleet is None or not options['snapshot']:
+            return
+        if now or time.time() - written[0] >= SNAPSHOT_INTERVAL:
+            fleet.snapshot(options['snapshot'])
+            written[0] = time.time()
+    return snapshot
+
+def _metrics(plugin, options, result, error, details):
+    '''The samples of a poll for MetricsExporter.set'''
+    if error is not None or not result:
+        result = ('UNKNOWN', '')
+    code = plugin.format_result(*result)[0]
+    samples = {'serverview_check_status': [({}, code)],
+               'serverview_last_poll_timestamp_seconds': [({}, time.time())]}
+    if len(result) > 3:
+        names = {'requests': 'serverview_snmp_requests',
+                 'timeouts': 'serverview_snmp_timeouts',
+                 'rtt_avg': 'serverview_snmp_rtt_avg_seconds',
+                 'rtt_max': 'serverview_snmp_rtt_max_seconds',
+                 'time': 'serverview_poll_duration_seconds'}
+        for item in result[3]:
+            if item[0] in names:
+                samples[names[item[0]]] = [({}, item[1])]
+    samples['serverview_up'] = [({}, int('global_status' in details))]
+    if not 'global_status' in details:
+        return samples
+    samples['serverview_global_status'] = [({}, details['global_status'])]
+    ignorelist = options['ignore'].lower().split(',')
+    statuses = {}
+    for name in details['subsystems'].split():
+        statuses[name] = 1
+    for name, status, last_error in details['failed']:
+        statuses[name] = status
+    names = statuses.keys()
+    names.sort()
+    samples['serverview_subsystem_status'] = [
+            ({'subsystem': name}, statuses[name]) for name in names
+            if not name.lower() in ignorelist]
+    return samples
+
+def _hostfile_options(plugin, options):
+    '''The options of every host in the --hostfile, a list'''
+    import shlex
+    if options['hostfile'] == '-':
+        hostfile = sys.stdin
     else:
-        return('OK', 'All subsystems are good: %s' % subsystems_string)
-
-def get_problem_list(snmp_client, ignorelist):
-    '''Returns a string with subsystem names, and a list of failed ones '''
-    OID_SUBSYSTEM_NAMES = '.1.3.6.1.4.1.231.2.10.2.11.2.3.0'
-    OID_GLOBAL_STATUS = '.1.3.6.1.4.1.231.2.10.2.11.2.1.0'
-    OID_SUBSYSTEM_COUNT = '.1.3.6.1.4.1.231.2.10.2.11.3.2.0'
-    OID_SUBSYSTEM_STATUS = '.1.3.6.1.4.1.231.2.10.2.11.3.1.1.3.%s'
-    OID_SUBSYSTEM_NAME = '.1.3.6.1.4.1.231.2.10.2.11.3.1.1.2.%s'
-    OID_SUBSYSTEM_LAST_ERROR = '.1.3.6.1.4.1.231.2.10.2.11.3.1.1.4.%s'
-    STATUS_NR2STRING = {1:'ok',2:'degraded',3:'error',4:'failed',5:'unknown-init'}
+        hostfile = open(options['hostfile'])
+    hosts = []
+    for line in hostfile:
+        args = shlex.split(line, comments=True)
+        if not args:
+            continue
+        if not args[0].startswith('-'):
+            args[0:1] = ['-H', args[0]]
+        hosts.append(plugin.parse_options(args, options))
+    return hosts
+
+def _result_sink(options):
+    '''The CheckResultSpool or CommandPipe of the options, None to print
+    the results'''
+    if options['checkresults']:
+        return CheckResultSpool(options['checkresults'])
+    if options['commandfile']:
+        return CommandPipe(options['commandfile'])
+    return None
+
+def _flush_results(sink, close=False):
+    '''Writes the results of the sink of a poller that keeps running, and
+    closes it when close is True. When nagios isn't reading they are kept
+    for the next time, it's said on stderr'''
+    try:
+        if close:
+            sink.close()
+        else:
+            sink.flush()
+    except EnvironmentError, e:
+        sys.stderr.write('%s: results not written, kept for the next try: '
+                         '%s\n' % (help['filename'], e))
+        sys.stderr.flush()
+
+def _report_result(plugin, host, result, error, sink=None, service=None):
+    '''Prints the result of a check as "host: nagios output", or hands it
+    to sink as the passive result of service. Returns its exit code'''
+    if error is not None:
+        result = ('UNKNOWN', 'Unhandled exception in plugin %s: %s' %
+                  (help['filename'], error))
+    if sink is not None:
+        return plugin.submit(sink, host, service, *result)
+    code, line = plugin.format_result(*result)
+    print '%s: %s' % (host, line)
+    sys.stdout.flush()
+    return code
+
+def _subnet(host):
+    '''The /24 network of a host, its name if it doesn't resolve'''
+    try:
+        return socket.gethostbyname(host).rsplit('.', 1)[0]
+    except socket.error:
+        return host
+
+def serverview_daemon(options):
+    '''Answers checks from check_serverview_client.py on the unix socket
+    --daemon until interrupted, snmp clients are kept between checks'''
+    from schau_daemon import PluginDaemon
+    pool = SnmpClientPool()
+    plugin = NagiosPlugin('SERVERVIEW',
+                          lambda options: serverview_function(options, pool),
+                          opties, help)
+    PluginDaemon(plugin, options['daemon']).serve()
+
+def serverview_traps(options):
+    '''Receives traps and informs on --traps until interrupted, and records
+    the ones about the hardware status in the --state directory'''
+    from schau_traps import TrapListener
+    if not options['state']:
+        raise EnvironmentError('-r, --traps needs -s, --state')
+    address, port = '0.0.0.0', options['traps']
+    if ':' in port:
+        address, port = port.rsplit(':', 1)
+    users = []
+    if options['user']:
+        users.append((options['user'], options['authkey'],
+                      options['privkey'], options['authprotocol']))
+    started = time.time()
+    poll_state = PollState(options['state'], options['maxage'])
+    def received(address, trap_oid, varbinds):
+        kind = trap_kind(trap_oid)
+        if kind is None:
+            return
+        # ServerView traps carry the server name and a message as strings
+        texts = [value for name, value in varbinds if isinstance(value, str)]
+        poll_state.trap(address, {'kind': kind, 'trap': dotted(trap_oid),
+                                  'message': '; '.join(texts)})
+    listener = TrapListener(received, (address, int(port)),
+                            [options['community']], users,
+                            lambda: poll_state.heartbeat(started))
+    listener.serve()
+
+def get_problem_list(snmp_client, ignorelist, cache=None, poll_state=None):
+    '''Returns a string with subsystem names, and a list of failed ones
+    With a ResultCache, the agent is only asked if no other check did
+    within the ttl of the cache. With a PollState, see subsystem_state_task'''
+    return run_task(problem_list_task(snmp_client, ignorelist, cache,
+                                      poll_state))
+
+def problem_list_task(snmp_client, ignorelist, cache=None, poll_state=None,
+                      details=None):
+    '''Coroutine version of get_problem_list. A details dictionary gets the
+    'subsystems' names, 'global_status' and the 'failed' subsystems as
+    (name, status, last error) as read, before ignoring any'''
     problem_list = []
     subsystems, global_status, subsys_status, subsys_name, subsys_last_error = '',0,0,'',''
-    subsystems = str(snmp_client.get(OID_SUBSYSTEM_NAMES)).lower()
+    if cache is None:
+        subsystems, global_status, failed = yield subsystem_state_task(
+                                                    snmp_client, poll_state)
+    else:
+        # unfiltered, checks with other --ignore options share the entry
+        subsystems, global_status, failed = cache.call(
+                        _cache_key(snmp_client), 'subsystems',
+                        lambda: run_task(subsystem_state_task(snmp_client,
+                                                              poll_state)))
+    if details is not None:
+        details['subsystems'] = subsystems
+        details['global_status'] = global_status
+        details['failed'] = failed
+    subsystems = _subsystem_list(subsystems, ignorelist)
+    for subsys_name, subsys_status, subsys_last_error in failed:
+        try:
+            subsys_status = STATUS[subsys_status]
+        except:
+            subsys_status = 'outofrange' 
+        if subsys_name.lower() in ignorelist:
+            continue
+        if subsys_last_error == '<<not supported>>':
+            subsys_last_error = ''
+        else:
+            subsys_last_error = ',%s' % subsys_last_error
+        problem_list.append((subsys_name,subsys_status,subsys_last_error))
+    yield Return((subsystems, problem_list))
+
+def _subsystem_list(subsystems, ignorelist):
+    '''The subsystem names read from the agent, without the ignored ones,
+    as a comma separated string'''
+    subsystems = subsystems.lower()
     for subsys_ignore in ignorelist:
         subsystems = subsystems.replace(subsys_ignore, '') 
     # create comma separated string
-    subsystems = ','.join(subsystems.split())
-    global_status = int(snmp_client.get(OID_GLOBAL_STATUS))
+    return ','.join(subsystems.split())
+
+def subsystem_state_task(snmp_client, poll_state=None):
+    '''Coroutine, reads the subsystem names, the global status and the
+    failed subsystems as (name, status, last error) from the agent
+
+    With a PollState holding a recent full poll of the agent, only the
+    global status, subsystem count and sysUpTime are asked: when they are
+    the same (and sysUpTime didn't go back), the last poll is returned.
+    When a trap listener ran since that poll and recorded no trap of the
+    agent, the last poll is returned without asking anything'''
+    last = None
+    if poll_state is not None:
+        key = _cache_key(snmp_client)
+        last = poll_state.load(key)
+        since = poll_state.listener_since()
+        if last is not None and since is not None and \
+           last.get('polled', 0) >= since:
+            # a trap listener was running during and since the last poll
+            trap = poll_state.last_trap(key[0])
+            if trap is None or trap['time'] < last['polled']:
+                yield Return((last['subsystems'], last['counters'][0],
+                              last['failed']))
+            last = None
+        started = time.time()
+    # the subsystem count is only needed when global status isn't ok, but
+    # asking it in the same request costs nothing
+    oids = [GLOBAL_STATUS.instance, SUBSYSTEM_COUNT.instance]
+    if poll_state is not None:
+        oids.append(SYS_UPTIME.instance)
+    if last is None:
+        oids.append(SUBSYSTEM_NAMES.instance)
+    values = yield snmp_client.get_many_task(oids)
+    global_status = int(_required(values, GLOBAL_STATUS.instance))
+    counters = _change_counters(values)
+    if last is not None and _unchanged(last['counters'], counters):
+        yield Return((last['subsystems'], global_status, last['failed']))
+    if not SUBSYSTEM_NAMES.instance in values:
+        values.update((yield snmp_client.get_many_task(
+                                            [SUBSYSTEM_NAMES.instance])))
+    subsystems = str(_required(values, SUBSYSTEM_NAMES.instance))
     if global_status == 1:
         # if global status is ok, no need to do further checks
         # NOTE: I tested this and global status was inconsistent with subsystem
         #       statusses: global was ok, deployment subsys was unknown
-        return (subsystems, problem_list)
-    counter = int(snmp_client.get(OID_SUBSYSTEM_COUNT))
-    for index in range (1, counter+1):
-        index_str = str(index)
-        subsys_status = int(snmp_client.get(OID_SUBSYSTEM_STATUS % index_str))
+        failed = []
+    else:
+        try:
+            if snmp_client.protocol == 1:
+                # no GETBULK in snmpv1, a GETNEXT walk would cost a request
+                # per subsystem while indexed GETs need two
+                counter = int(_required(values, SUBSYSTEM_COUNT.instance))
+                failed = yield _get_failed_subsystems(snmp_client, counter)
+            else:
+                failed = yield _walk_failed_subsystems(snmp_client)
+        except SnmpTimeoutError, e:
+            e.partial = (subsystems, global_status)
+            raise
+    if poll_state is not None:
+        poll_state.store(key, {'counters': counters, 'subsystems': subsystems,
+                               'failed': failed, 'polled': started})
+    yield Return((subsystems, global_status, failed))
+
+def _change_counters(values):
+    '''(global status, subsystem count, sysUpTime) from a get_many result,
+    None for the ones the agent doesn't have'''
+    counters = []
+    for scalar in (GLOBAL_STATUS, SUBSYSTEM_COUNT, SYS_UPTIME):
+        value = values.get(scalar.instance)
+        if value is not None:
+            value = int(value)
+        counters.append(value)
+    return tuple(counters)
+
+def _unchanged(last, counters):
+    '''True if the change counters of a poll are those of the last full
+    poll, sysUpTime may only have grown'''
+    global_status, count, uptime = counters
+    last_status, last_count, last_uptime = last
+    if global_status != last_status or count != last_count:
+        return False
+    if uptime is None or last_uptime is None:
+        return uptime is last_uptime
+    return uptime >= last_uptime
+
+def _cache_key(snmp_client):
+    '''Identifies the agent and credentials of snmp_client in a ResultCache'''
+    host, port = snmp_client.target.transportAddr
+    auth = snmp_client.authentication
+    if snmp_client.protocol == 3:
+        credentials = auth.securityName
+    else:
+        credentials = auth.communityName
+    return (host, port, snmp_client.protocol, credentials)
+
+def _walk_failed_subsystems(snmp_client):
+    '''Reads the subsystem table with bulk walks of the name, status and
+    last error columns, returns (name, status, last error) of the failed
+    subsystems'''
+    varbinds, complete = yield snmp_client.get_subtrees_task(
+                    SUBSYSTEM_TABLE.columns('name', 'status', 'last_error'))
+    rows = SUBSYSTEM_TABLE.rows(varbinds)
+    indexes = rows.keys()
+    indexes.sort()
+    failed = []
+    for index in indexes:
+        row = rows[index]
+        if not 'status' in row:
+            continue
+        subsys_status = int(row['status'])
+        if subsys_status != 1:
+            failed.append((
+                str(_required_column(row, SUBSYSTEM_TABLE, 'name', index)),
+                subsys_status,
+                str(_required_column(row, SUBSYSTEM_TABLE, 'last_error',
+                                     index))))
+    yield Return(failed)
+
+def _get_failed_subsystems(snmp_client, counter):
+    '''Reads the status of subsystem 1 to counter in one request and the
+    names and last errors of the failed ones in another, returns
+    (name, status, last error) of the failed subsystems'''
+    indexes = [(index,) for index in range(1, counter+1)]
+    values = yield snmp_client.get_many_task(
+                [SUBSYSTEM_TABLE.instance('status', index) for index in indexes])
+    statusses = []
+    for index in indexes:
+        subsys_status = int(_required(values,
+                                SUBSYSTEM_TABLE.instance('status', index)))
         if subsys_status != 1:
-            try:
-                subsys_status = STATUS_NR2STRING[subsys_status]
-            except:
-                subsys_status = 'outofrange' 
-            subsys_name = str(snmp_client.get(OID_SUBSYSTEM_NAME % index_str))
-            if subsys_name.lower() in ignorelist:
+            statusses.append((index, subsys_status))
+    if not statusses:
+        yield Return([])
+    details = []
+    for index, subsys_status in statusses:
+        details.append(SUBSYSTEM_TABLE.instance('name', index))
+        details.append(SUBSYSTEM_TABLE.instance('last_error', index))
+    values = yield snmp_client.get_many_task(details)
+    failed = []
+    for index, subsys_status in statusses:
+        failed.append((
+            str(_required(values, SUBSYSTEM_TABLE.instance('name', index))),
+            subsys_status,
+            str(_required(values,
+                          SUBSYSTEM_TABLE.instance('last_error', index)))))
+    yield Return(failed)
+
+def component_task(snmp_client, subsystems, max_requests):
+    '''Coroutine, walks the component tables of subsystems (names as read
+    from the agent) side by side in at most max_requests requests
+    Returns ({subsystem: [(component, status)]} of the failed components,
+    perfdata of their readings, False if max_requests wasn't enough)'''
+    # subsystems of the same kind (Environment, Environment2) share tables
+    wanted, tables = [], []
+    for name in subsystems:
+        for components in COMPONENTS.get(name.lower().rstrip('0123456789'), ()):
+            if not components.table in tables:
+                tables.append(components.table)
+                wanted.append((name, components))
+    if not wanted:
+        yield Return(({}, [], True))
+    oids = []
+    for name, components in wanted:
+        oids.extend(components.columns())
+    varbinds, complete = yield snmp_client.get_subtrees_task(oids,
+                                        COMPONENT_REPETITIONS, max_requests)
+    rows_by_table = REGISTRY.tables(varbinds)
+    failed, perfdata = {}, []
+    for name, components in wanted:
+        rows = rows_by_table.get(components.table, {})
+        indexes = rows.keys()
+        indexes.sort()
+        # designations repeat in every cabinet or controller
+        units = dict([(index[:1], True) for index in indexes])
+        for index in indexes:
+            row = rows[index]
+            label = str(row.get(components.label,
+                                '.'.join([str(arc) for arc in index])))
+            if len(units) > 1:
+                label = '%d/%s' % (index[0], label)
+            if components.value in row:
+                perfdata.append(('%s_%s' % (components.prefix, label),
+                                 int(row[components.value]), '',
+                                 _threshold(row, components.warning),
+                                 _threshold(row, components.critical)))
+            if not 'status' in row:
                 continue
-            subsys_last_error = str(snmp_client.get(OID_SUBSYSTEM_LAST_ERROR % index_str))
-            if subsys_last_error == '<<not supported>>':
-                subsys_last_error = ''
-            else:
-                subsys_last_error = ',%s' % subsys_last_error
-            problem_list.append((subsys_name,subsys_status,subsys_last_error))
-    return (subsystems, problem_list)
+            status = int(row['status'])
+            if not status in components.ok:
+                failed.setdefault(name, []).append(
+                    (label, components.statuses.get(status, 'outofrange')))
+    yield Return((failed, perfdata, complete))
+
+def _threshold(row, column):
+    '''A threshold column of a component row for perfdata, None when it's
+    missing or 0 (not set)'''
+    if column is None or not int(row.get(column, 0)):
+        return None
+    return int(row[column])
+
+def _required(values, oid):
+    '''Returns the value of oid (a tuple) from a get_many result, raises
+    SnmpNoInstanceError if the agent didn't return it'''
+    try:
+        return values[oid]
+    except KeyError:
+        raise SnmpNoInstanceError("OID %s doesn't exist" % dotted(oid))
+
+def _required_column(row, table, column, index):
+    '''Returns column from a row of Table.rows, raises
+    SnmpNoInstanceError if the agent didn't return it'''
+    try:
+        return row[column]
+    except KeyError:
+        raise SnmpNoInstanceError("OID %s doesn't exist" %
+                                  dotted(table.instance(column, index)))
 
 if __name__ == '__main__':
     plug = NagiosPlugin('SERVERVIEW', serverview_function, opties, help)
-    plug.run(debug=True)
+    options = plug.parse_options()
+    if options['daemon']:
+        try:
+            serverview_daemon(options)
+        except KeyboardInterrupt:
+            pass
+        except EnvironmentError, e:
+            plug._NAGIOS_EXIT('UNKNOWN', 'daemon: %s' % e)
+        sys.exit(0)
+    if options['traps']:
+        try:
+            serverview_traps(options)
+        except KeyboardInterrupt:
+            pass
+        except (EnvironmentError, CacheError, ValueError), e:
+            plug._NAGIOS_EXIT('UNKNOWN', 'traps: %s' % e)
+        sys.exit(0)
+    if options['checkresults'] and options['commandfile']:
+        plug._NAGIOS_EXIT('UNKNOWN', '-Q, --checkresults and -F, '
+                          '--commandfile exclude each other')
+    if options['flaps'] < 0:
+        plug._NAGIOS_EXIT('UNKNOWN', '-j, --flaps must be 0 or more changes')
+    if options['shard'] and not (options['hostfile'] and
+                                 (options['interval'] or options['exporter'])):
+        plug._NAGIOS_EXIT('UNKNOWN', '-G, --shard needs -f, --hostfile with '
+                          '-I, --interval or -x, --exporter')
+    if options['hostfile'] and options['exporter']:
+        try:
+            serverview_exporter(plug, options)
+        except KeyboardInterrupt:
+            pass
+        except (EnvironmentError, ValueError), e:
+            plug._NAGIOS_EXIT('UNKNOWN', 'exporter: %s' % e)
+        sys.exit(0)
+    if options['hostfile'] and options['interval']:
+        try:
+            serverview_schedule(plug, options)
+        except KeyboardInterrupt:
+            pass
+        except (EnvironmentError, ValueError), e:
+            plug._NAGIOS_EXIT('UNKNOWN', str(e))
+        sys.exit(0)
+    if options['hostfile']:
+        try:
+            sys.exit(serverview_batch(plug, options))
+        except EnvironmentError, e:
+            plug._NAGIOS_EXIT('UNKNOWN', str(e))
+    plug.run(debug=True, options_dict=options)
@@ -0,0 +1,103 @@
+#! /bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Thin client for a check_serverview.py --daemon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Takes the same arguments as check_serverview.py and prints the same
+output, but lets a running "check_serverview.py -D SOCKET" do the check.
+The socket is $CHECK_SERVERVIEW_SOCKET, there's no default: put it in a
+directory only the nagios user can write to, the arguments sent hold the
+communities and passphrases. A socket owned by another user (but root)
+isn't used.
+
+Without a daemon, and for --help, --version, --hostfile, --daemon and
+--traps, it runs check_serverview.py itself.'''
+
+import os
+import sys
+import stat
+import socket
+
+from schau_daemon import send_request
+
+SOCKET = os.environ.get('CHECK_SERVERVIEW_SOCKET')
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'check_serverview.py')
+# answered by check_serverview.py itself, (short, long) option names
+LOCAL_OPTIONS = (('-h', '--help'), ('-V', '--version'), ('-f', '--hostfile'),
+                 ('-D', '--daemon'), ('-r', '--traps'))
+# the options of check_serverview.py without value
+FLAGS = ('-h', '--help', '-V', '--version')
+# seconds to wait for the daemon, above the 25 seconds of check timeout
+TIMEOUT = 60
+
+def run_plugin(args):
+    os.execv(sys.executable, [sys.executable, PLUGIN] + args)
+
+def option_names(args):
+    '''The option names in args like optparse finds them: values, also
+    ones starting with -, are skipped. Long names may be abbreviated'''
+    names = []
+    nr = 0
+    while nr < len(args):
+        arg = args[nr]
+        nr = nr + 1
+        if arg == '--':
+            break
+        if arg.startswith('--'):
+            name = arg.split('=', 1)[0]
+            names.append(name)
+            if not '=' in arg and not name in FLAGS:
+                nr = nr + 1
+        elif arg.startswith('-') and len(arg) > 1:
+            name = arg[:2]
+            names.append(name)
+            if len(arg) == 2 and not name in FLAGS:
+                nr = nr + 1
+    return names
+
+def local(args):
+    '''True when check_serverview.py itself must handle args'''
+    for name in option_names(args):
+        for short, long in LOCAL_OPTIONS:
+            # --host is an option of its own, not --hostfile abbreviated
+            if name == short or name != '--host' and len(name) > 2 and \
+               long.startswith(name):
+                return True
+    return False
+
+def trusted(path):
+    '''True when path is a socket of this user or root'''
+    try:
+        status = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(status.st_mode) and \
+           status.st_uid in (os.getuid(), 0)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not SOCKET or local(args) or not trusted(SOCKET):
+        run_plugin(args)
+    try:
+        code, line = send_request(SOCKET, args, TIMEOUT)
+    except socket.timeout:
+        print 'SERVERVIEW UNKNOWN - no answer from daemon on %s' % SOCKET
+        sys.exit(3)
+    except (socket.error, ValueError):
+        # no daemon running (or it died during the check)
+        run_plugin(args)
+    print line
+    sys.exit(code)
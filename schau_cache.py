@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : On-disk result cache shared by nagios plugin processes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Caches results of snmp queries on disk, for all plugin processes
+
+Nagios often runs several checks against the same agent within seconds.
+With a ResultCache only the first process asks the agent, the others get
+its result from disk. While one process queries an agent, the others
+asking the same thing wait for it (a lock file per entry) instead of
+sending the same requests.
+
+    cache = ResultCache('/var/tmp/check_serverview', ttl=60)
+    key = ('rx300-01', 161, 2, 'public')
+    values = cache.get_many(key, snmp_client, ['.1.3.6.1.2.1.1.5.0'])
+    state = cache.call(key, 'subsystems', read_subsystems)
+
+A UsmStateCache keeps what an SnmpClient learned about an snmpv3 agent
+(engine id, boots, time and the keys localized for it), so the next
+process doesn't discover it again:
+
+    client = SnmpClient(host, 3, user='nagios', authkey='s3cret',
+                        usm_cache=UsmStateCache('/var/tmp/check_serverview'))
+
+A PollState keeps what the last full poll of an agent found, so later
+checks only ask what tells them whether anything changed:
+
+    state = PollState('/var/lib/check_serverview', max_age=300)
+    last = state.load(key)      # None when missing or older than max_age
+    state.store(key, {'global_status': 3, ...})
+
+A trap listener records the traps of every agent in the same directory,
+and shows it is alive, so the checks know when nothing happened:
+
+    state.heartbeat(started)    # every few seconds
+    state.trap('10.1.2.3', {'trap': '.1.3.6.1.4.1.231...'})
+    if state.listener_since() and not state.last_trap('10.1.2.3'): ...
+
+A CircuitBreaker remembers agents that stopped answering, so the checks
+don't wait for them one timeout after another:
+
+    breaker = CircuitBreaker('/var/tmp/check_serverview', backoff=60)
+    opened = breaker.check(key, probe_timeout=25)
+    if opened is not None:
+        status, message, wait = opened      # the failure, without asking
+    ...
+    breaker.failure(key, 'UNKNOWN', 'timeout')  # or breaker.success(key)
+
+Entries are pickled, so the cache directory must only be writable by the
+user running the checks: it is created with mode 0700 and refused when
+others can write to it.'''
+
+import os
+import time
+import stat
+import fcntl
+import errno
+import cPickle
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from schau_snmp import SnmpError, SnmpTimeoutError
+
+
+class CacheError(Exception):
+    def __init__(self, value=''):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class ResultCache(object):
+    '''Results of function calls on disk, per agent and name
+
+    * directory:    string - created if missing
+    * ttl:          integer - seconds a result is used, default 60
+    * max_entries:  integer - the oldest entries are removed above this
+                    number, default 10000
+    * max_age:      integer - entries older than this are removed,
+                    default 10 times the ttl
+    * lock_timeout: integer - seconds to wait for another process
+                    computing the same entry, default 30
+
+    SnmpErrors are cached too: a dead agent costs one timeout per ttl,
+    not one per check. Except SnmpTimeoutErrors, another check may have
+    more time.'''
+
+    def __init__(self, directory, ttl=60, max_entries=10000, max_age=None,
+                 lock_timeout=30):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_age = max_age or 10 * ttl
+        self.lock_timeout = lock_timeout
+        _check_directory(directory)
+
+    def call(self, key, name, function):
+        '''Returns the cached result of function() for agent key (a tuple
+        like (host, port, protocol, community)) and name, calls function
+        and stores its result when there's no fresh one'''
+        path = self._path(key, name)
+        found, value = self._read(path)
+        if found:
+            return self._result(value)
+        lock = open(path + '.lock', 'a')
+        try:
+            locked = self._lock(lock)
+            # another process may have stored it while we waited
+            found, value = self._read(path)
+            if not found:
+                try:
+                    value = ('value', function())
+                except SnmpTimeoutError:
+                    raise
+                except SnmpError, e:
+                    value = ('error', (e.__class__, e.value))
+                self._write(path, value)
+            if locked:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        finally:
+            lock.close()
+        self._evict()
+        return self._result(value)
+
+    def get_many(self, key, snmp_client, oids):
+        '''SnmpClient.get_many through the cache'''
+        oids = list(oids)
+        oids.sort()
+        return self.call(key, 'get:' + ','.join(oids),
+                         lambda: snmp_client.get_many(oids))
+
+    def _path(self, key, name):
+        digest = sha1(repr((key, name))).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def _result(self, value):
+        kind, value = value
+        if kind == 'error':
+            error_class, error_value = value
+            raise error_class(error_value)
+        return value
+
+    def _read(self, path):
+        '''Returns (True, value) for a fresh entry, else (False, None)'''
+        try:
+            entry = open(path, 'rb')
+        except IOError:
+            return False, None
+        try:
+            if time.time() - os.fstat(entry.fileno()).st_mtime >= self.ttl:
+                return False, None
+            try:
+                return True, cPickle.load(entry)
+            except Exception:
+                # truncated or from an incompatible version
+                return False, None
+        finally:
+            entry.close()
+
+    def _write(self, path, value):
+        _write(path, value)
+
+    def _lock(self, lock):
+        '''Waits lock_timeout seconds at most for the lock file, returns
+        False if the other process took too long'''
+        deadline = time.time() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def _evict(self):
+        '''Removes entries older than max_age and the oldest ones above
+        max_entries, at most once per ttl for all processes together'''
+        stamp = os.path.join(self.directory, '.evicted')
+        now = time.time()
+        try:
+            if now - os.stat(stamp).st_mtime < self.ttl:
+                return
+        except OSError:
+            pass
+        open(stamp, 'a').close()
+        os.utime(stamp, None)
+        entries = []
+        for filename in os.listdir(self.directory):
+            # lock, temporary, UsmStateCache and PollState files have a dot
+            if '.' in filename:
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+        entries.sort()
+        remove = len(entries) - self.max_entries
+        for mtime, path in entries:
+            if remove <= 0 and now - mtime < self.max_age:
+                break
+            remove = remove - 1
+            self._remove(path)
+
+    def _remove(self, path):
+        # the lock file goes too, unless a process is using it
+        lock = open(path + '.lock', 'a')
+        try:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            for filename in (path, path + '.lock'):
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+        finally:
+            lock.close()
+
+
+class UsmStateCache(object):
+    '''SNMPv3 state of agents on disk, for SnmpClient(usm_cache=...)
+
+    The localized keys are as good as the passphrases for that agent, the
+    files are only readable by the user running the checks. An entry is
+    forgotten when the agent doesn't accept it anymore.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        _check_directory(directory)
+
+    def load(self, key):
+        '''Returns the state stored for key, None if there's none'''
+        return _read(self._path(key))
+
+    def store(self, key, state):
+        _write(self._path(key), state)
+
+    def forget(self, key):
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            sha1(repr(key)).hexdigest() + '.usm')
+
+
+class PollState(object):
+    '''Result of the last full poll of agents on disk, for incremental checks
+
+    * directory: string - created if missing
+    * max_age:   integer - seconds a state is used, after that the agent is
+                 polled in full again, default 300
+
+    A state is a dictionary, store adds its time under 'time'. Unlike the
+    ResultCache it isn't locked: every check of an agent may write it, the
+    last one wins.'''
+
+    # seconds without heartbeat after which a trap listener counts as gone
+    LISTENER_TIMEOUT = 30
+
+    def __init__(self, directory, max_age=300):
+        self.directory = directory
+        self.max_age = max_age
+        _check_directory(directory)
+        self.heartbeat_path = os.path.join(directory, '.listener')
+
+    def load(self, key):
+        '''Returns the state of agent key, None if there's none younger than
+        max_age'''
+        state = _read(self._path(key))
+        if state is None or not 0 <= time.time() - state['time'] < self.max_age:
+            return None
+        return state
+
+    def store(self, key, state):
+        state['time'] = time.time()
+        _write(self._path(key), state)
+
+    def forget(self, key):
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def trap(self, address, trap):
+        '''Records trap (a dictionary) from the agent at address (ip
+        address), adds the time under 'time'. Only the last one is kept'''
+        trap['time'] = time.time()
+        _write(self._trap_path(address), trap)
+
+    def last_trap(self, address):
+        '''Returns the last trap recorded for address, None if there's none'''
+        return _read(self._trap_path(address))
+
+    def heartbeat(self, started):
+        '''Called by a running trap listener that started at time started'''
+        _write(self.heartbeat_path, started)
+
+    def listener_since(self):
+        '''Returns the time the trap listener started, None if none showed
+        a heartbeat within LISTENER_TIMEOUT seconds'''
+        try:
+            if time.time() - os.stat(self.heartbeat_path).st_mtime >= \
+               self.LISTENER_TIMEOUT:
+                return None
+        except OSError:
+            return None
+        return _read(self.heartbeat_path)
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            sha1(repr(key)).hexdigest() + '.state')
+
+    def _trap_path(self, address):
+        return os.path.join(self.directory,
+                            sha1(repr(address)).hexdigest() + '.trap')
+
+
+class CircuitBreaker(object):
+    '''Consecutive failures of agents on disk, shared by all checks
+
+    * directory:   string - created if missing
+    * failures:    integer - failed checks in a row that open the circuit,
+                   default 3
+    * backoff:     integer - seconds the circuit stays open the first time,
+                   default 60. Doubled every time it opens again
+    * max_backoff: integer - longest the circuit stays open, default 3600
+
+    While the circuit of an agent is open, checks return its last failure
+    without asking it. When the backoff is over one check, the probe, asks
+    the agent again; its success closes the circuit, its failure opens it
+    for twice as long. The other checks keep returning the failure until
+    the probe is done, or its timeout passed.'''
+
+    def __init__(self, directory, failures=3, backoff=60, max_backoff=3600):
+        self.directory = directory
+        self.failures = failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        _check_directory(directory)
+
+    def check(self, key, probe_timeout):
+        '''Returns None when a check may ask agent key, else (status,
+        message, seconds until the next probe) of the failure that opened
+        the circuit. A check that gets None after the backoff is the probe,
+        the others wait probe_timeout seconds for its result'''
+        path = self._path(key)
+        lock = self._lock(path)
+        try:
+            state = _read(path)
+            now = time.time()
+            if state is None or state['until'] is None:
+                return None
+            if now < state['until']:
+                status, message = state['result']
+                return status, message, int(state['until'] - now + 1)
+            state['until'] = now + probe_timeout
+            _write(path, state)
+            return None
+        finally:
+            lock.close()
+
+    def failure(self, key, status, message):
+        '''Records a check of agent key that got no answer, with its
+        result'''
+        path = self._path(key)
+        lock = self._lock(path)
+        try:
+            state = _read(path) or {'failures': 0, 'opened': 0, 'until': None}
+            state['failures'] = state['failures'] + 1
+            state['result'] = (status, message)
+            if state['failures'] >= self.failures:
+                state['until'] = time.time() + min(self.max_backoff,
+                                        self.backoff * 2 ** state['opened'])
+                state['opened'] = state['opened'] + 1
+            _write(path, state)
+        finally:
+            lock.close()
+
+    def success(self, key):
+        '''Records a check of agent key that got answers, closes its
+        circuit'''
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def _lock(self, path):
+        '''The lock file of path, locked: a few file operations, not worth
+        a timeout'''
+        lock = open(path + '.lock', 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return lock
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            sha1(repr(key)).hexdigest() + '.circuit')
+
+
+def _read(path):
+    '''Returns the unpickled content of a file, None if it's missing or
+    unreadable'''
+    try:
+        entry = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            return cPickle.load(entry)
+        except Exception:
+            return None
+    finally:
+        entry.close()
+
+def _write(path, value):
+    '''Writes a file atomically with mode 0600, readers see the old or the
+    new one'''
+    # most checks only read, they skip the import
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        entry = os.fdopen(fd, 'wb')
+        try:
+            cPickle.dump(value, entry, 2)
+        finally:
+            entry.close()
+        os.rename(temp_path, path)
+    except Exception:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+def _check_directory(directory):
+    '''Creates directory, raises CacheError if others can write to it'''
+    try:
+        os.makedirs(directory, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise CacheError('cannot create %s: %s' % (directory, e.strerror))
+    info = os.stat(directory)
+    if info.st_uid != os.geteuid() or \
+       info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise CacheError('%s is not a private directory' % directory)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Runs a NagiosPlugin as a daemon on a unix socket
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Runs the checks of a NagiosPlugin in one long running process
+
+A plugin started by nagios for every check spends most of its time
+starting python, importing its modules and setting up snmp. The daemon
+does that once and answers check requests on a unix socket, a thin
+client (see check_serverview_client.py) forwards its commandline and
+prints the answer.
+
+Protocol, one check per connection:
+    request:  the commandline arguments, each followed by a NUL byte, the
+              client then shuts down its side of the connection. A
+              connection without request is not answered
+    answer:   "<exit code>\\n<plugin output line>\\n"'''
+
+import os
+import sys
+import signal
+import socket
+import threading
+import SocketServer
+
+
+def send_request(socket_path, args, timeout=None):
+    '''Sends commandline args to the daemon on socket_path, returns
+    (exit code, output line). Raises socket.error if there's no daemon'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(''.join([arg + '\0' for arg in args]))
+        sock.shutdown(socket.SHUT_WR)
+        answer = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            answer = answer + data
+    finally:
+        sock.close()
+    code, line = answer.split('\n', 1)
+    return int(code), line.rstrip('\n')
+
+
+class _CheckHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        data = self.rfile.read()
+        if not data:
+            return
+        args = data.split('\0')[:-1]
+        code, line = self.server.check(args)
+        self.wfile.write('%d\n%s\n' % (code, line))
+
+
+def _terminate(signum, frame):
+    sys.exit(0)
+
+
+class PluginDaemon(SocketServer.ThreadingMixIn,
+                   SocketServer.UnixStreamServer):
+    '''Answers check requests for a NagiosPlugin on a unix socket
+
+    * plugin:       NagiosPlugin - parses the arguments, formats the result
+    * socket_path:  string - unix socket to listen on, a stale socket
+                    file is removed. The clients send the communities and
+                    passphrases of the checks: keep it in a directory
+                    only the nagios user can write to
+    * mode:         permissions of the socket, default 0660. It is created
+                    with them, there's no moment another user can connect
+
+    Every request is handled in its own thread, so the plugin method must
+    be thread safe. It may keep state between checks, like warm snmp
+    clients.'''
+
+    daemon_threads = True
+
+    def __init__(self, plugin, socket_path, mode=0660):
+        self.plugin = plugin
+        self.socket_path = socket_path
+        # optparse keeps its parsing state in the parser
+        self.parse_lock = threading.Lock()
+        self._remove_stale_socket()
+        umask = os.umask(0777 & ~mode)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                                   _CheckHandler)
+        finally:
+            os.umask(umask)
+
+    def check(self, args):
+        '''Runs one check for commandline args, returns (exit code, line)'''
+        self.parse_lock.acquire()
+        try:
+            try:
+                options = self.plugin.parse_options(args)
+            except SystemExit:
+                # optparse already complained on stderr of the daemon
+                return self.plugin.format_result('UNKNOWN',
+                        'invalid arguments: %s' % ' '.join(args), 'PYNAGLIB')
+        finally:
+            self.parse_lock.release()
+        status, msg, function, perfdata = self.plugin.execute(options)
+        return self.plugin.format_result(status, msg, function, perfdata)
+
+    def serve(self):
+        '''Answers requests until interrupted or terminated, then removes
+        the socket'''
+        signal.signal(signal.SIGTERM, _terminate)
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(self.socket_path)
+            except socket.error:
+                os.unlink(self.socket_path)
+                return
+        finally:
+            sock.close()
+        raise socket.error('%s: a daemon is already listening' %
+                           self.socket_path)
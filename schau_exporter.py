@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Serves metrics of many targets to Prometheus over http
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Serves the last metrics of many targets in the Prometheus text format
+(or OpenMetrics, when the scraper asks for it), from memory
+
+Whatever polls the targets hands their samples to set, scrapes never wait
+for it:
+
+    exporter = MetricsExporter([('up', 'gauge', 'Agent answered')])
+    exporter.set('rx300-01', {'up': [({}, 1)]})
+    exporter.serve(('', 9231))
+
+    GET /metrics                    all targets
+    GET /probe?target=rx300-01      one target, 404 when unknown
+
+The samples of a target are kept as one formatted string per metric
+family, a few hundred bytes per target. set replaces them at once, so a
+scrape in another thread sees the old or the new ones.'''
+
+import cgi
+import sys
+import BaseHTTPServer
+
+TEXT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+class MetricsExporter(object):
+    '''The metrics of many targets and an http server for them
+
+    * families: list of (name, type, help) - the metric families, in the
+                order they are served. type is 'gauge', 'counter', ...'''
+
+    def __init__(self, families):
+        self.families = families
+        self.index = {}
+        for nr in range(len(families)):
+            self.index[families[nr][0]] = nr
+        # target -> tuple of sample lines per family
+        self.targets = {}
+
+    def set(self, target, samples):
+        '''Replaces the samples of target, a dictionary {family name: list
+        of (labels dictionary, value)}. A target label is added'''
+        lines = [''] * len(self.families)
+        for name, values in samples.items():
+            nr = self.index[name]
+            for labels, value in values:
+                labels = [('target', target)] + labels.items()
+                lines[nr] = lines[nr] + '%s{%s} %s\n' % (name, ','.join(
+                        ['%s="%s"' % (label, _escape(label_value))
+                         for label, label_value in labels]), _value(value))
+        self.targets[target] = tuple(lines)
+
+    def forget(self, target):
+        self.targets.pop(target, None)
+
+    def render(self, targets=None, openmetrics=False):
+        '''The exposition of targets (default all), None when one of them
+        is unknown'''
+        if targets is None:
+            blocks = [lines for target, lines in self.targets.items()]
+        else:
+            blocks = []
+            for target in targets:
+                if not target in self.targets:
+                    return None
+                blocks.append(self.targets[target])
+        output = []
+        for nr in range(len(self.families)):
+            name, kind, help = self.families[nr]
+            output.append('# HELP %s %s\n# TYPE %s %s\n' % (name, help,
+                                                             name, kind))
+            for lines in blocks:
+                output.append(lines[nr])
+        if openmetrics:
+            output.append('# EOF\n')
+        return ''.join(output)
+
+    def serve(self, address):
+        '''Answers scrapes on address, (host, port), until interrupted.
+        Raises EnvironmentError when it can't listen there'''
+        class Handler(_ScrapeHandler):
+            exporter = self
+        server = _Server(address, Handler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+class _Server(BaseHTTPServer.HTTPServer):
+    '''HTTPServer that stops on ^C during a request too'''
+
+    def handle_error(self, request, client_address):
+        # SocketServer catches everything a request raises
+        if issubclass(sys.exc_info()[0], (KeyboardInterrupt, SystemExit)):
+            self.shutdown_request(request)
+            raise
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class _ScrapeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''GET /metrics and /probe?target=.. from the exporter'''
+
+    exporter = None
+
+    def do_GET(self):
+        path, query = self.path, ''
+        if '?' in path:
+            path, query = path.split('?', 1)
+        openmetrics = 'application/openmetrics-text' in \
+                      self.headers.get('Accept', '')
+        if path == '/metrics':
+            body = self.exporter.render(openmetrics=openmetrics)
+        elif path == '/probe':
+            targets = cgi.parse_qs(query).get('target')
+            if not targets:
+                self.send_error(400, 'target parameter missing')
+                return
+            body = self.exporter.render(targets, openmetrics)
+            if body is None:
+                self.send_error(404, 'unknown target')
+                return
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        if openmetrics:
+            self.send_header('Content-Type', OPENMETRICS_TYPE)
+        else:
+            self.send_header('Content-Type', TEXT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds, not worth a line each
+        pass
+
+
+def _escape(value):
+    '''A label value with backslashes, quotes and newlines escaped'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+                     .replace('\n', '\\n')
+
+def _value(value):
+    '''A sample value without exponent for small floats'''
+    if isinstance(value, float):
+        return ('%.6f' % value).rstrip('0').rstrip('.')
+    return str(value)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : The pysnmp engine behind schau_snmp, loaded when needed
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''The parts of schau_snmp that need the pysnmp engine
+
+Importing pysnmp and pyasn1 takes longer than most checks with the
+built-in BER codec, so schau_snmp only imports this module for the first
+SNMPv3 client or client with codec='pysnmp'. Use SnmpClient, not this.'''
+
+import time
+import select
+import asyncore
+
+from pysnmp import cache
+from pysnmp.entity import config
+from pysnmp.entity.rfc3413.oneliner import cmdgen
+from pysnmp.smi.error import NoSuchObjectError
+from pyasn1.error import PyAsn1Error
+# ASN.1 library, used for manipulating SNMP numbers
+from pyasn1.type.univ import Null, OctetString
+
+from schau_snmp import SnmpNoInstanceError, _Timers
+
+
+def udp_target(host, port):
+    '''The pysnmp transport target of an agent, resolves host'''
+    return cmdgen.UdpTransportTarget((host, port))
+
+def community_data(secname, community, protocol):
+    '''pysnmp credentials for snmpv1 (protocol 1) or snmpv2c'''
+    if protocol == 1:
+        return cmdgen.CommunityData(secname, community, 0)
+    return cmdgen.CommunityData(secname, community)
+
+def usm_user_data(user, authkey, privkey, authProtocol):
+    '''pysnmp credentials for snmpv3, authProtocol md5 or sha'''
+    if authkey:
+        if authProtocol == 'md5':
+            authprot = cmdgen.usmHMACMD5AuthProtocol
+        else:
+            authprot = cmdgen.usmHMACSHAAuthProtocol
+    else:
+        authprot = cmdgen.usmNoAuthProtocol
+    if privkey:
+        privprot = cmdgen.usmDESPrivProtocol
+    else:
+        privprot = cmdgen.usmNoPrivProtocol
+    return cmdgen.UsmUserData(user, authkey, privkey, authprot, privprot)
+
+
+class CommandGenerator(cmdgen.AsynCommandGenerator, _Timers):
+    '''AsynCommandGenerator that can take snmpv3 state learned earlier
+
+    pysnmp discovers the engine id, boots and time of an agent with two
+    extra round trips and hashes about 1MB per passphrase before its first
+    snmpv3 request. With the state of an earlier run none of that is needed.
+    This reaches into the engine id and timeline caches of pysnmp 4.1.
+    It also checks for timed out requests more often than once a second,
+    and handles many hosts: pysnmp caches the indexes of 256 rows per
+    configuration table, and prints the ones it drops on stdout.'''
+
+    # seconds between timeout checks, None for the pysnmp default
+    _tick = None
+    # snmp messages through the dispatcher, counted once it exists
+    _counting = False
+    bytes_sent = 0
+    # (size, arrival time) of the message received last
+    received = None
+    # rows with a cached index per configuration table
+    TABLE_CACHE = 65536
+    # tables with rows per host (and timeout) or credentials
+    CONFIG_TABLES = (('SNMP-TARGET-MIB', 'snmpTargetAddrEntry'),
+                     ('SNMP-TARGET-MIB', 'snmpTargetParamsEntry'),
+                     ('SNMP-COMMUNITY-MIB', 'snmpCommunityEntry'),
+                     ('SNMP-USER-BASED-SM-MIB', 'usmUserEntry'),
+                     ('PYSNMP-USM-MIB', 'pysnmpUsmKeyEntry'),
+                     ('PYSNMP-USM-MIB', 'pysnmpUsmSecretEntry'))
+
+    def __init__(self):
+        cmdgen.AsynCommandGenerator.__init__(self)
+        mibBuilder = self.snmpEngine.msgAndPduDsp.mibInstrumController.mibBuilder
+        for module, entry in self.CONFIG_TABLES:
+            row, = mibBuilder.importSymbols(module, entry)
+            row._MibTableRow__idToIdxCache = cache.Cache(self.TABLE_CACHE)
+            row._MibTableRow__idxToIdCache = cache.Cache(self.TABLE_CACHE)
+
+    def cfgCmdGen(self, authData, transportTarget, tagList=''):
+        known = authData in self._AsynCommandGenerator__knownAuths
+        names = cmdgen.AsynCommandGenerator.cfgCmdGen(self, authData,
+                                                transportTarget, tagList)
+        if not known and isinstance(authData, cmdgen.CommunityData):
+            # pysnmp tags the community with the target addresses, and
+            # scans all target addresses for every response it receives.
+            # Responses are matched to the requests by request-id anyway
+            mibInstrum = self.snmpEngine.msgAndPduDsp.mibInstrumController
+            snmpCommunityEntry, = mibInstrum.mibBuilder.importSymbols(
+                'SNMP-COMMUNITY-MIB', 'snmpCommunityEntry')
+            index = snmpCommunityEntry.getInstIdFromIndices(
+                authData.securityName)
+            mibInstrum.writeVars(
+                ((snmpCommunityEntry.name + (6,) + index, ''),))
+        if not self._counting and \
+           self.snmpEngine.transportDispatcher is not None:
+            self._count_messages()
+        return names
+
+    def _count_messages(self):
+        '''Counts the bytes sent, and notes the size and arrival time of
+        every message received before pysnmp decodes it'''
+        dispatcher = self.snmpEngine.transportDispatcher
+        sendMessage = dispatcher.sendMessage
+        def send(outgoingMessage, transportDomain, transportAddress):
+            self.bytes_sent = self.bytes_sent + len(outgoingMessage)
+            sendMessage(outgoingMessage, transportDomain, transportAddress)
+        dispatcher.sendMessage = send
+        receive = self.snmpEngine._SnmpEngine__receiveMessageCbFun
+        def received(transportDispatcher, transportDomain, transportAddress,
+                     wholeMsg):
+            self.received = (len(wholeMsg), time.time())
+            return receive(transportDispatcher, transportDomain,
+                           transportAddress, wholeMsg)
+        dispatcher.unregisterRecvCbFun()
+        dispatcher.registerRecvCbFun(received)
+        self._counting = True
+
+    def set_tick(self, tick):
+        '''Checks for timed out requests every tick seconds, call it after
+        the first request, when the engine has a dispatcher'''
+        dispatcher = self.snmpEngine.transportDispatcher
+        if dispatcher is None or self._tick == tick:
+            return
+        # the dispatcher polls its sockets every 0.5 seconds and calls the
+        # timer of the engine every second
+        dispatcher.timeout = tick
+        dispatcher.unregisterTimerCbFun()
+        dispatcher.registerTimerCbFun(self._timer_tick, tick)
+        self._tick = tick
+
+    def _timer_tick(self, timeNow):
+        '''Timer of the engine, after the responses already received'''
+        # the dispatcher reads one datagram per poll, with many requests
+        # underway the responses waiting in the socket would time out
+        sockets = self.snmpEngine.transportDispatcher.getSocketMap()
+        while select.select(sockets.keys(), [], [], 0)[0]:
+            asyncore.poll(0, sockets)
+        self.snmpEngine._SnmpEngine__receiveTimerTickCbFun(time.time())
+        self.run_timers()
+
+    def transport_target(self, transportAddr, timeout):
+        '''The target of a request with timeout, transportAddr resolved'''
+        return TransportTarget(transportAddr, timeout)
+
+    def asyncGetCmd(self, *args):
+        return self._request(cmdgen.AsynCommandGenerator.asyncGetCmd, args)
+
+    def asyncNextCmd(self, *args):
+        return self._request(cmdgen.AsynCommandGenerator.asyncNextCmd, args)
+
+    def asyncBulkCmd(self, *args):
+        return self._request(cmdgen.AsynCommandGenerator.asyncBulkCmd, args)
+
+    def _request(self, method, args):
+        try:
+            return method(self, *args)
+        except NoSuchObjectError:
+            raise SnmpNoInstanceError
+
+    def opened(self):
+        '''True once the engine has a dispatcher and socket'''
+        return self.snmpEngine.transportDispatcher is not None
+
+    def pending(self):
+        dispatcher = self.snmpEngine.transportDispatcher
+        return dispatcher is not None and bool(dispatcher.jobsArePending() or
+                                               dispatcher.transportsAreWorking())
+
+    def sockets(self):
+        '''Returns the sockets to wait for, readable and writable'''
+        sockets = self.snmpEngine.transportDispatcher.getSocketMap()
+        return (sockets.keys(), [fd for fd, transport in sockets.items()
+                                 if transport.writable()])
+
+    def timeout(self):
+        return self.snmpEngine.transportDispatcher.timeout
+
+    def poll(self):
+        '''One round of the dispatcher, without waiting'''
+        dispatcher = self.snmpEngine.transportDispatcher
+        asyncore.poll(0, dispatcher.getSocketMap())
+        dispatcher.handleTimerTick(time.time())
+
+    def wait(self):
+        '''Waits until all requests are answered or timed out'''
+        if self.snmpEngine.transportDispatcher is not None:
+            self.snmpEngine.transportDispatcher.runDispatcher()
+
+    def usm_state(self, authData, transportTarget):
+        '''Returns the snmpv3 state of an agent the engine talked to, as a
+        dictionary, None if not known'''
+        mp = self.snmpEngine.messageProcessingSubsystems[3]
+        engines = mp._SnmpV3MessageProcessingModel__engineIDs
+        key = (transportTarget.transportDomain, transportTarget.transportAddr)
+        if not key in engines:
+            return None
+        peer = engines[key]
+        usm = self.snmpEngine.securityModels[3]
+        timeline = usm._SnmpUSMSecurityModel__timeline
+        if not peer['securityEngineID'] in timeline:
+            return None
+        boots, engine_time, received, updated = timeline[
+                                                    peer['securityEngineID']]
+        auth_key, priv_key = self._localized_keys(peer['securityEngineID'],
+                                                  authData.securityName)
+        return {'engine_id': str(peer['securityEngineID']),
+                'context_engine_id': str(peer['contextEngineId']),
+                'context_name': str(peer['contextName']),
+                'boots': int(boots), 'time': int(engine_time),
+                'timestamp': int(updated),
+                'auth_key': auth_key, 'priv_key': priv_key}
+
+    def set_usm_state(self, authData, transportTarget, state):
+        '''Configures the user of authData for an agent with a state
+        returned by usm_state earlier, before the first request'''
+        engine_id = OctetString(state['engine_id'])
+        mibInstrum = self.snmpEngine.msgAndPduDsp.mibInstrumController
+        usmUserEntry, = mibInstrum.mibBuilder.importSymbols(
+            'SNMP-USER-BASED-SM-MIB', 'usmUserEntry')
+        pysnmpUsmKeyEntry, = mibInstrum.mibBuilder.importSymbols(
+            'PYSNMP-USM-MIB', 'pysnmpUsmKeyEntry')
+        zeroDotZero, = mibInstrum.mibBuilder.importSymbols(
+            'SNMPv2-SMI', 'zeroDotZero')
+        # the user row of the agent, as config.addV3User would add it for
+        # the local engine, but with the localized keys
+        index = usmUserEntry.getInstIdFromIndices(engine_id,
+                                                  authData.securityName)
+        mibInstrum.writeVars(((usmUserEntry.name + (13,) + index, 'destroy'),))
+        mibInstrum.writeVars(
+            ((usmUserEntry.name + (13,) + index, 'createAndGo'),
+             (usmUserEntry.name + (3,) + index, authData.securityName),
+             (usmUserEntry.name + (4,) + index, zeroDotZero.name),
+             (usmUserEntry.name + (5,) + index, authData.authProtocol),
+             (usmUserEntry.name + (8,) + index, authData.privProtocol)))
+        mibInstrum.writeVars(
+            ((pysnmpUsmKeyEntry.name + (1,) + index, state['auth_key']),
+             (pysnmpUsmKeyEntry.name + (2,) + index, state['priv_key'])))
+        known = self._AsynCommandGenerator__knownAuths
+        if not authData in known:
+            paramsName = 'p%s' % cmdgen.nextID()
+            config.addTargetParams(self.snmpEngine, paramsName,
+                            authData.securityName, authData.securityLevel)
+            known[authData] = paramsName
+        mp = self.snmpEngine.messageProcessingSubsystems[3]
+        mp._SnmpV3MessageProcessingModel__engineIDs[
+            (transportTarget.transportDomain, transportTarget.transportAddr)] = {
+            'securityEngineID': engine_id,
+            'contextEngineId': OctetString(state['context_engine_id']),
+            'contextName': OctetString(state['context_name'])}
+        # the agent clock went on since the state was saved
+        engine_time = state['time'] + int(time.time()) - state['timestamp']
+        usm = self.snmpEngine.securityModels[3]
+        usm._SnmpUSMSecurityModel__timeline[engine_id] = (
+            state['boots'], engine_time, engine_time, int(time.time()))
+
+    def _localized_keys(self, engine_id, securityName):
+        mibInstrum = self.snmpEngine.msgAndPduDsp.mibInstrumController
+        usmUserEntry, = mibInstrum.mibBuilder.importSymbols(
+            'SNMP-USER-BASED-SM-MIB', 'usmUserEntry')
+        pysnmpUsmKeyEntry, = mibInstrum.mibBuilder.importSymbols(
+            'PYSNMP-USM-MIB', 'pysnmpUsmKeyEntry')
+        index = usmUserEntry.getInstIdFromIndices(engine_id, securityName)
+        keys = []
+        for column in (1, 2):
+            key = pysnmpUsmKeyEntry.getNode(
+                    pysnmpUsmKeyEntry.name + (column,) + index).syntax
+            try:
+                keys.append(str(key) or None)
+            except PyAsn1Error:
+                # noPriv, the key has no value
+                keys.append(None)
+        return keys
+
+
+class TransportTarget(cmdgen.UdpTransportTarget):
+    '''UdpTransportTarget for one timeout, without retries
+
+    pysnmp configures a target address per transport target it sees, and
+    UdpTransportTarget compares by address only: the timeout of the first
+    request would be used for all of them. transportAddr must be resolved
+    already.'''
+    def __init__(self, transportAddr, timeout):
+        self.transportAddr = transportAddr
+        self.timeout = timeout
+        self.retries = 0
+
+    def __hash__(self): return hash((self.transportAddr, self.timeout))
+    def __cmp__(self, other):
+        return cmp((self.transportAddr, self.timeout),
+                   (getattr(other, 'transportAddr', None),
+                    getattr(other, 'timeout', None)))
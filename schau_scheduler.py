@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Polls a fleet of hosts at intervals following their health
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Keeps checking many hosts over one SnmpDispatcher, each at its own pace
+
+Hosts that are OK are checked every interval seconds, the others and the
+ones flapping between states every retry_interval seconds. Every delay
+gets some random jitter, and the first checks are spread over the
+interval, so the checks don't come in bursts. At most concurrency checks
+run at once, at most subnet_concurrency per subnet:
+
+    def check(host):
+        return SnmpClient(host, 2, 'public', dispatcher=d).get_many_task(..)
+    scheduler = PollScheduler(d, check, callback, interval=300)
+    for host in hosts:
+        scheduler.add(host, subnet=host.rsplit('.', 1)[0])
+    scheduler.run()
+
+The due checks are kept in a heap, so adding and taking one costs
+O(log hosts): one process keeps up with tens of thousands of hosts.'''
+
+import time
+import heapq
+import random
+from collections import deque
+
+# results kept per host to see it flapping, and the state changes among
+# them that make it flapping
+FLAP_HISTORY = 5
+FLAP_CHANGES = 2
+
+
+class PollScheduler(object):
+    '''Calls check(key) for every host added, again and again, and runs the
+    coroutine it returns on dispatcher. callback(key, result, error) is
+    called with every result, error is None or the exception the check
+    raised. The status of a result is its first item, 'OK' or another
+    nagios state.
+
+    * interval:           seconds between the checks of an OK host
+    * retry_interval:     seconds between the checks of the other hosts
+    * concurrency:        checks running at the same time
+    * subnet_concurrency: checks running at the same time per subnet,
+                          0 for no limit
+    * jitter:             fraction of the delay added or taken at random
+    * flush:              function called every flush_interval seconds
+                          when checks finished meanwhile, and when run
+                          returns, e.g. to write their results at once
+    * flush_interval:     seconds results are collected per flush
+
+    stop may be called from another thread, run returns within STOP_CHECK
+    seconds then.'''
+
+    STOP_CHECK = 1.0
+
+    def __init__(self, dispatcher, check, callback, interval=300,
+                 retry_interval=60, concurrency=50, subnet_concurrency=0,
+                 jitter=0.1, flush=None, flush_interval=10):
+        self.dispatcher = dispatcher
+        self.check = check
+        self.callback = callback
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.concurrency = concurrency
+        self.subnet_concurrency = subnet_concurrency
+        self.jitter = jitter
+        self.flush = flush
+        self.flush_interval = flush_interval
+        # checks finished since the last flush, and when that was
+        self.finished = 0
+        self.flushed = time.time()
+        # (due time, sequence number, key), the number keeps keys that
+        # can't be compared out of the comparison. Only the entry with the
+        # sequence number in scheduled counts, the others are left over
+        # from hosts removed or added again
+        self.queue = []
+        self.sequence = 0
+        self.scheduled = {}
+        # key -> subnet, and the last states of the host
+        self.subnets = {}
+        self.history = {}
+        # subnet -> checks running, and (key, sequence number) due but
+        # waiting for the subnet
+        self.running = {}
+        self.waiting = {}
+        self.active = 0
+        self.stopped = False
+
+    def add(self, key, subnet=None):
+        '''Schedules the checks of a host, the first one at a random moment
+        within the interval'''
+        self.subnets[key] = subnet
+        self.history[key] = []
+        self._schedule(key, time.time() + random.uniform(0, self.interval))
+
+    def remove(self, key):
+        '''Stops checking a host. A check of it that is running finishes,
+        without callback'''
+        self.history.pop(key, None)
+        self.scheduled.pop(key, None)
+
+    def delay(self, key):
+        '''Seconds until the next check of a host, following its history'''
+        history = self.history[key]
+        if not history or history[-1] != 'OK' or self.flapping(key):
+            delay = self.retry_interval
+        else:
+            delay = self.interval
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def flapping(self, key):
+        '''True when the last results of a host changed state often'''
+        history = self.history[key]
+        changes = 0
+        for nr in range(1, len(history)):
+            if history[nr] != history[nr - 1]:
+                changes = changes + 1
+        return changes >= FLAP_CHANGES
+
+    def run(self, until=None):
+        '''Runs the checks until stop is called or time until is reached,
+        None to keep running'''
+        try:
+            while not self.stopped:
+                now = time.time()
+                if until is not None and now >= until:
+                    return
+                self._start_due(now)
+                if not self.queue and not self.active:
+                    return
+                max_wait = None
+                if self.queue and self.active < self.concurrency:
+                    max_wait = max(0, self.queue[0][0] - now)
+                if until is not None and (max_wait is None or
+                                          until - now < max_wait):
+                    max_wait = until - now
+                if max_wait is None or max_wait > self.STOP_CHECK:
+                    max_wait = self.STOP_CHECK
+                if self.finished and self.flush is not None:
+                    flush_wait = max(0, self.flushed + self.flush_interval -
+                                        now)
+                    if max_wait is None or flush_wait < max_wait:
+                        max_wait = flush_wait
+                if not self.dispatcher.step(max_wait) and max_wait:
+                    time.sleep(max_wait)
+                if time.time() - self.flushed >= self.flush_interval:
+                    self._flush()
+        finally:
+            self._flush()
+
+    def _flush(self):
+        '''Hands the results since the last flush to flush'''
+        if self.finished and self.flush is not None:
+            self.flush()
+        self.finished = 0
+        self.flushed = time.time()
+
+    def stop(self):
+        '''Makes run return, now and when called again. The checks running
+        are left unfinished'''
+        self.stopped = True
+
+    def _schedule(self, key, due):
+        self.sequence = self.sequence + 1
+        self.scheduled[key] = self.sequence
+        heapq.heappush(self.queue, (due, self.sequence, key))
+
+    def _start_due(self, now):
+        '''Starts the checks that are due, as far as the limits allow'''
+        while self.queue and self.active < self.concurrency and \
+              self.queue[0][0] <= now:
+            due, sequence, key = heapq.heappop(self.queue)
+            if self.scheduled.get(key) != sequence:
+                continue
+            subnet = self.subnets[key]
+            if self.subnet_concurrency and \
+               self.running.get(subnet, 0) >= self.subnet_concurrency:
+                self.waiting.setdefault(subnet, deque()).append((key,
+                                                                 sequence))
+                continue
+            self._start(key)
+
+    def _start(self, key):
+        del self.scheduled[key]
+        subnet = self.subnets[key]
+        self.active = self.active + 1
+        self.running[subnet] = self.running.get(subnet, 0) + 1
+        try:
+            coroutine = self.check(key)
+        except Exception, e:
+            self._finished(key, None, e)
+            return
+        self.dispatcher.start(key, coroutine, self._finished)
+
+    def _finished(self, key, result, error):
+        subnet = self.subnets[key]
+        self.active = self.active - 1
+        self.running[subnet] = self.running[subnet] - 1
+        if key in self.history:
+            status = 'UNKNOWN'
+            if error is None and result:
+                status = result[0]
+            history = self.history[key]
+            history.append(status)
+            del history[:-FLAP_HISTORY]
+            self._schedule(key, time.time() + self.delay(key))
+            self.finished = self.finished + 1
+            self.callback(key, result, error)
+        # the subnet has room again, and so has the whole: hosts that were
+        # due before any in the queue go first
+        waiting = self.waiting.get(subnet)
+        while waiting:
+            key, sequence = waiting.popleft()
+            if self.scheduled.get(key) == sequence:
+                self._start(key)
+                break
+        if waiting is not None and not waiting:
+            del self.waiting[subnet]
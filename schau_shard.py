@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Shares the hosts to poll among several pollers
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Shares the hosts of a host file among the pollers that are running
+
+Every poller has a name and keeps a file with that name in a directory
+all of them can write to (a local one, or NFS for pollers on several
+machines). Touching it is the heartbeat, the pollers whose file wasn't
+touched for timeout seconds are gone:
+
+    membership = ShardMembership('/var/lib/check_serverview/shard', 'poller1')
+    ring = HashRing(membership.heartbeat())     # ['poller1', 'poller2']
+    mine = [host for host in hosts if ring.owner(host) == 'poller1']
+    ...
+    membership.leave()
+
+The hosts are assigned by consistent hashing: every poller owns replicas
+points on a ring of md5 hashes, and a host belongs to the first point at
+or after its own hash. When a poller comes or goes only the hosts of its
+points move, about one in the number of pollers; the others stay where
+they are.'''
+
+import os
+import errno
+import bisect
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+# extension of the membership files
+MEMBER_SUFFIX = '.member'
+
+
+class HashRing(object):
+    '''Consistent hashing of keys (strings) to members (names)
+
+    * replicas: points per member, more spread the keys more evenly'''
+
+    def __init__(self, members, replicas=100):
+        points = []
+        for member in members:
+            for nr in range(replicas):
+                points.append((_hash('%s#%d' % (member, nr)), member))
+        points.sort()
+        self.points = [point for point, member in points]
+        self.members = [member for point, member in points]
+
+    def owner(self, key):
+        '''The member key belongs to, None without members'''
+        if not self.points:
+            return None
+        nr = bisect.bisect_left(self.points, _hash(key))
+        return self.members[nr % len(self.points)]
+
+
+class ShardMembership(object):
+    '''The pollers sharing directory, this one is name
+
+    * timeout: seconds without heartbeat after which a poller is gone
+
+    The age of the files is measured by the clock of the file system, the
+    clocks of the pollers don't matter. Raises EnvironmentError when the
+    directory can't be used, ValueError for a name that isn't a file name'''
+
+    def __init__(self, directory, name, timeout=30):
+        if not name or os.sep in name or name.startswith('.'):
+            raise ValueError('invalid poller name %r' % name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.name = name
+        self.timeout = timeout
+        self.path = os.path.join(directory, name + MEMBER_SUFFIX)
+
+    def heartbeat(self):
+        '''Tells the others this poller is alive, returns the names of the
+        pollers alive, this one included, sorted'''
+        open(self.path, 'a').close()
+        os.utime(self.path, None)
+        now = os.stat(self.path).st_mtime
+        members = [self.name]
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(MEMBER_SUFFIX) or \
+               filename == self.name + MEMBER_SUFFIX:
+                continue
+            try:
+                touched = os.stat(os.path.join(self.directory,
+                                               filename)).st_mtime
+            except OSError:
+                # left meanwhile
+                continue
+            if now - touched <= self.timeout:
+                members.append(filename[:-len(MEMBER_SUFFIX)])
+        members.sort()
+        return members
+
+    def leave(self):
+        '''Tells the others this poller stops, they take over its hosts
+        with their next heartbeat'''
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def _hash(value):
+    '''A point on the ring, the first 64 bits of the md5 of value'''
+    return long(md5(value).hexdigest()[:16], 16)
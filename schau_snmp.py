@@ -36,11 +36,23 @@
       python setup install
  '''
  
-from pysnmp.entity.rfc3413.oneliner import cmdgen
-from pysnmp.smi.error import NoSuchObjectError
-from pyasn1.error import PyAsn1Error
-# ASN.1 library, used for manipulating SNMP numbers
-from pyasn1.type.univ import ObjectIdentifier, Null
+import sys
+import time
+import errno
+import types
+import random
+import select
+import socket
+# threading costs an import of collections and heapq, the locks are these
+import thread
+
+# small, the engine and pyasn1 are imported by _pysnmp when needed
+from pysnmp.proto import errind
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 
 class SnmpError(Exception):
@@ -55,6 +67,692 @@ class SnmpNoInstanceError(SnmpError):
 class SnmpBadArgumentError(SnmpError):
     pass
 
+class SnmpTimeoutError(SnmpError):
+    '''The timeout of the client ran out before all requests were answered
+    Code gathering results in steps may set partial to what it had so far'''
+    def __init__(self, value='', partial=None):
+        SnmpError.__init__(self, value)
+        self.partial = partial
+
+
+# errorIndication of a request that wasn't sent or retried anymore because
+# the timeout of its client ran out
+class TimeoutBudgetUsed(errind.ErrorIndication): pass
+timeoutBudgetUsed = TimeoutBudgetUsed('timeout of the client ran out')
+
+
+class SnmpStats(object):
+    '''What the requests of an SnmpClient cost, since its last set_timeout
+
+    * requests:       PDUs sent, retries included
+    * retries:        PDUs sent again after a timeout or error indication
+    * timeouts:       PDUs without response in time
+    * hedges:         PDUs also sent to another endpoint of the agent
+                      because the first one was slow to answer
+    * bytes_sent,
+      bytes_received: size of the snmp messages
+    * rtts:           seconds from request to response, per response
+    * setup:          seconds creating the engine and preparing requests
+                      (configuration, snmpv3 key hashing, encoding)
+    * wait:           seconds waiting for the network
+    * decode:         seconds pysnmp took for the responses received'''
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.rtts = []
+        self.setup = 0.0
+        self.wait = 0.0
+        self.decode = 0.0
+
+    def perfdata(self):
+        '''The counters as NagiosPlugin perfdata'''
+        rtt_avg, rtt_max = 0.0, 0.0
+        if self.rtts:
+            rtt_avg = sum(self.rtts) / len(self.rtts)
+            rtt_max = max(self.rtts)
+        return [('requests', self.requests, '', None, None, 0),
+                ('retries', self.retries, '', None, None, 0),
+                ('timeouts', self.timeouts, '', None, None, 0),
+                ('hedges', self.hedges, '', None, None, 0),
+                ('bytes_sent', self.bytes_sent, 'B', None, None, 0),
+                ('bytes_received', self.bytes_received, 'B', None, None, 0),
+                ('rtt_avg', rtt_avg, 's', None, None, 0),
+                ('rtt_max', rtt_max, 's', None, None, 0),
+                ('time_setup', self.setup, 's', None, None, 0),
+                ('time_wait', self.wait, 's', None, None, 0),
+                ('time_decode', self.decode, 's', None, None, 0)]
+
+
+class Return(object):
+    '''Yielded by a coroutine to hand a result to its caller'''
+    def __init__(self, value=None):
+        self.value = value
+
+class SnmpRequest(object):
+    '''One GET, GETNEXT or GETBULK request, yielded by coroutines
+
+    The coroutine gets the response back from yield:
+    (errorIndication, errorStatus, errorIndex, varBinds), for GETNEXT and
+    GETBULK varBinds is a list of rows'''
+    def __init__(self, client, command, oids, max_repetitions=0):
+        self.client = client
+        self.command = command
+        self.oids = oids
+        self.max_repetitions = max_repetitions
+
+
+class _Task(object):
+    '''Steps a coroutine and the coroutines it yields
+
+    Coroutines are generators that yield SnmpRequests, other coroutines
+    (their Return value is sent back) and finally a Return.'''
+
+    def __init__(self, coroutine):
+        self.stack = [coroutine]
+        self.result = None
+        self.error = None
+
+    def step(self, response=None, error=None):
+        '''Sends response (or throws error, an exc_info tuple) into the
+        coroutine, returns the next SnmpRequest or None when finished'''
+        value = response
+        while self.stack:
+            coroutine = self.stack[-1]
+            try:
+                if error is not None:
+                    yielded = coroutine.throw(*error)
+                    error = None
+                else:
+                    yielded = coroutine.send(value)
+            except StopIteration:
+                self.stack.pop()
+                value = None
+                continue
+            except Exception:
+                self.stack.pop()
+                error = sys.exc_info()
+                continue
+            if isinstance(yielded, Return):
+                self.stack.pop()
+                coroutine.close()
+                value = yielded.value
+            elif isinstance(yielded, types.GeneratorType):
+                self.stack.append(yielded)
+                value = None
+            else:
+                return yielded
+        self.result = value
+        self.error = error
+        return None
+
+def run_task(coroutine):
+    '''Runs a coroutine to the end, waiting for every request in turn.
+    Returns its result, exceptions are raised'''
+    task = _Task(coroutine)
+    request = task.step()
+    while request is not None:
+        try:
+            response = request.client._wait(request)
+        except Exception:
+            request = task.step(error=sys.exc_info())
+        else:
+            request = task.step(response)
+    if task.error:
+        raise task.error[0], task.error[1], task.error[2]
+    return task.result
+
+
+def _pysnmp():
+    '''Returns the schau_pysnmp module, importing it and with it the pysnmp
+    engine and pyasn1 on first use. The clients with the built-in codec
+    don't need them'''
+    global _NO_VALUE
+    import schau_pysnmp
+    _NO_VALUE = (schau_pysnmp.Null, _NoValue)
+    return schau_pysnmp
+
+
+class _Target(object):
+    '''Address, timeout and retries of a request of the built-in codec,
+    like the UdpTransportTarget of pysnmp. transportAddr is resolved'''
+    def __init__(self, transportAddr, timeout=1, retries=0):
+        self.transportAddr = transportAddr
+        self.timeout = timeout
+        self.retries = retries
+
+
+class _Endpoint(object):
+    '''An address of the agent of an SnmpClient, and how it answered
+
+    * target:   _Target or pysnmp target of the address, resolved
+    * rtts:     seconds of its last samples responses
+    * failures: requests in a row it didn't answer in time'''
+    def __init__(self, target, samples):
+        self.target = target
+        self.samples = samples
+        self.rtts = []
+        self.failures = 0
+
+    def answered(self, rtt):
+        self.failures = 0
+        self.rtts.append(rtt)
+        del self.rtts[:-self.samples]
+
+
+class _Timers(object):
+    '''Functions a command generator calls later, when it is polled: the
+    hedged requests of the clients with several endpoints'''
+
+    timers = None
+
+    def call_later(self, delay, function):
+        '''Calls function() in delay seconds, returns the timer to cancel'''
+        if self.timers is None:
+            self.timers = []
+        timer = [time.time() + delay, function]
+        self.timers.append(timer)
+        return timer
+
+    def cancel(self, timer):
+        '''Stops a timer of call_later that didn't run yet'''
+        for nr in range(len(self.timers or ())):
+            if self.timers[nr] is timer:
+                del self.timers[nr]
+                return
+
+    def next_timer(self):
+        '''Seconds until the next timer runs, None without timers'''
+        if not self.timers:
+            return None
+        return max(0, min([timer[0] for timer in self.timers]) - time.time())
+
+    def run_timers(self):
+        '''Runs the timers that are due'''
+        if not self.timers:
+            return
+        now = time.time()
+        for timer in [timer for timer in self.timers if timer[0] <= now]:
+            self.cancel(timer)
+            timer[1]()
+
+
+class _CommunityData(object):
+    '''The credentials of an snmpv1 (mpModel 0) or snmpv2c request of the
+    built-in codec, like the CommunityData of pysnmp'''
+    def __init__(self, securityName, communityName, mpModel=1):
+        self.securityName = securityName
+        self.communityName = communityName
+        self.mpModel = mpModel
+
+
+# BER tags of the SNMPv1/v2c messages the built-in codec handles
+_BER_INTEGER = 0x02
+_BER_OCTET_STRING = 0x04
+_BER_OID = 0x06
+_BER_SEQUENCE = 0x30
+_BER_GET = 0xa0
+_BER_NEXT = 0xa1
+_BER_RESPONSE = 0xa2
+_BER_BULK = 0xa5
+# Counter32, Gauge32, TimeTicks and Counter64, unsigned integers
+_BER_UNSIGNED = (0x41, 0x42, 0x43, 0x46)
+
+
+class _NoValue(object):
+    '''Null and the snmpv2 exceptions, as decoded by the built-in codec'''
+    def __init__(self, name):
+        self.name = name
+    def __repr__(self):
+        return self.name
+
+_BER_NO_VALUES = {0x05: _NoValue('null'),
+                  0x80: _NoValue('noSuchObject'),
+                  0x81: _NoValue('noSuchInstance'),
+                  0x82: _NoValue('endOfMibView')}
+# a varbind without value, from the built-in codec or, once _pysnmp loaded
+# it, from pysnmp
+_NO_VALUE = (_NoValue,)
+
+
+class _BerError(ValueError):
+    pass
+
+def _ber_tlv(tag, content):
+    length = len(content)
+    if length < 0x80:
+        return chr(tag) + chr(length) + content
+    octets = ''
+    while length:
+        octets = chr(length & 0xff) + octets
+        length = length >> 8
+    return chr(tag) + chr(0x80 | len(octets)) + octets + content
+
+def _ber_integer(value):
+    octets = []
+    while True:
+        octets.insert(0, chr(value & 0xff))
+        if -0x80 <= value < 0x80:
+            break
+        value = value >> 8
+    return _ber_tlv(_BER_INTEGER, ''.join(octets))
+
+def _ber_oid(oid):
+    '''Encodes an oid tuple, checked by SnmpClient._oids'''
+    octets = []
+    for arc in (oid[0] * 40 + oid[1],) + oid[2:]:
+        if arc < 0x80:
+            octets.append(chr(arc))
+            continue
+        chunk = [chr(arc & 0x7f)]
+        arc = arc >> 7
+        while arc:
+            chunk.insert(0, chr(0x80 | arc & 0x7f))
+            arc = arc >> 7
+        octets.extend(chunk)
+    return _ber_tlv(_BER_OID, ''.join(octets))
+
+def _ber_request(version, community, tag, request_id, field2, field3, oids):
+    '''Encodes a request message, with Null values. field2 and field3 are
+    error-status and error-index, or non-repeaters and max-repetitions
+    for GETBULK'''
+    varbinds = ''.join([_ber_tlv(_BER_SEQUENCE, _ber_oid(oid) + '\x05\x00')
+                        for oid in oids])
+    pdu = _ber_tlv(tag, _ber_integer(request_id) + _ber_integer(field2) +
+                   _ber_integer(field3) + _ber_tlv(_BER_SEQUENCE, varbinds))
+    return _ber_tlv(_BER_SEQUENCE, _ber_integer(version) +
+                    _ber_tlv(_BER_OCTET_STRING, community) + pdu)
+
+def _ber_header(data, offset, end):
+    '''Returns (tag, start, end) of the content of the element at offset'''
+    tag = ord(data[offset])
+    length = ord(data[offset + 1])
+    offset = offset + 2
+    if length & 0x80:
+        size = length & 0x7f
+        if not 0 < size <= 4:
+            raise _BerError('unsupported length')
+        length = 0
+        for octet in data[offset:offset + size]:
+            length = length << 8 | ord(octet)
+        offset = offset + size
+    if offset + length > end:
+        raise _BerError('truncated message')
+    return tag, offset, offset + length
+
+def _ber_unsigned(data, start, end):
+    value = 0
+    for octet in data[start:end]:
+        value = value << 8 | ord(octet)
+    return value
+
+def _ber_value(tag, data, start, end):
+    '''Decodes the content of an element into a python value'''
+    if tag == _BER_INTEGER:
+        value = _ber_unsigned(data, start, end)
+        if end > start and ord(data[start]) & 0x80:
+            value = value - (1 << 8 * (end - start))
+        return value
+    if tag in _BER_UNSIGNED:
+        return _ber_unsigned(data, start, end)
+    if tag == _BER_OID:
+        arcs = []
+        arc = 0
+        for octet in data[start:end]:
+            octet = ord(octet)
+            arc = arc << 7 | octet & 0x7f
+            if not octet & 0x80:
+                arcs.append(arc)
+                arc = 0
+        if not arcs:
+            raise _BerError('empty oid')
+        if arcs[0] < 80:
+            return (arcs[0] // 40, arcs[0] % 40) + tuple(arcs[1:])
+        return (2, arcs[0] - 80) + tuple(arcs[1:])
+    if tag in _BER_NO_VALUES:
+        return _BER_NO_VALUES[tag]
+    # OCTET STRING, IpAddress, Opaque and what else an agent may send
+    return data[start:end]
+
+def _ber_response(data):
+    '''Decodes a response message, returns (version, community, request id,
+    error status, error index, [(oid tuple, value)]), raises _BerError'''
+    try:
+        tag, start, end = _ber_header(data, 0, len(data))
+        if tag != _BER_SEQUENCE:
+            raise _BerError('not a message')
+        fields = []
+        for expected in (_BER_INTEGER, _BER_OCTET_STRING, _BER_RESPONSE):
+            tag, start, field_end = _ber_header(data, start, end)
+            if tag != expected:
+                raise _BerError('not a response')
+            fields.append((start, field_end))
+            start = field_end
+        version = _ber_value(_BER_INTEGER, data, *fields[0])
+        community = data[fields[1][0]:fields[1][1]]
+        start, end = fields[2]
+        values = []
+        for expected in (_BER_INTEGER, _BER_INTEGER, _BER_INTEGER,
+                         _BER_SEQUENCE):
+            tag, start, field_end = _ber_header(data, start, end)
+            if tag != expected:
+                raise _BerError('malformed pdu')
+            if tag == _BER_INTEGER:
+                values.append(_ber_value(tag, data, start, field_end))
+                start = field_end
+        request_id, error_status, error_index = values
+        end = field_end
+        varbinds = []
+        while start < end:
+            tag, start, varbind_end = _ber_header(data, start, end)
+            tag, name_start, name_end = _ber_header(data, start, varbind_end)
+            if tag != _BER_OID:
+                raise _BerError('malformed varbind')
+            name = _ber_value(tag, data, name_start, name_end)
+            tag, start, value_end = _ber_header(data, name_end, varbind_end)
+            varbinds.append((name, _ber_value(tag, data, start, value_end)))
+            start = varbind_end
+    except IndexError:
+        raise _BerError('truncated message')
+    return version, community, request_id, error_status, error_index, varbinds
+
+
+class _BerRequest(object):
+    '''A request of a _BerCommandGenerator waiting for its response'''
+    def __init__(self, tag, message, authData, transportTarget, width, cbInfo):
+        self.tag = tag
+        self.message = message
+        self.community = authData.communityName
+        self.address = transportTarget.transportAddr
+        self.timeout = transportTarget.timeout
+        self.retries = transportTarget.retries
+        self.width = width
+        self.cbInfo = cbInfo
+        self.deadline = None
+
+
+class _BerCommandGenerator(_Timers):
+    '''Sends SNMPv1/v2c GET, GETNEXT and GETBULK requests with the built-in
+    BER codec, over a udp socket of its own
+
+    Takes the asyncGetCmd, asyncNextCmd and asyncBulkCmd calls of a
+    schau_pysnmp.CommandGenerator for CommunityData, and calls back the
+    same way.
+    Without pysnmp engine there's no mib to load and no asn.1 object per
+    varbind: the values are python ints (INTEGER, Counter32, Gauge32,
+    TimeTicks, Counter64), strings (OCTET STRING, IpAddress, Opaque) and
+    oid tuples, Null and the snmpv2 exceptions are _NoValues.'''
+
+    bytes_sent = 0
+    # (size, arrival time) of the message received last
+    received = None
+
+    def __init__(self):
+        self.socket = None
+        # request id -> _BerRequest
+        self.requests = {}
+        self.request_id = random.randrange(1, 0x7fffffff)
+
+    def asyncGetCmd(self, authData, transportTarget, varNames, cbInfo):
+        return self._request(_BER_GET, authData, transportTarget, 0, 0,
+                             varNames, cbInfo)
+
+    def asyncNextCmd(self, authData, transportTarget, varNames, cbInfo):
+        return self._request(_BER_NEXT, authData, transportTarget, 0, 0,
+                             varNames, cbInfo)
+
+    def asyncBulkCmd(self, authData, transportTarget, nonRepeaters,
+                     maxRepetitions, varNames, cbInfo):
+        return self._request(_BER_BULK, authData, transportTarget,
+                             nonRepeaters, maxRepetitions, varNames, cbInfo)
+
+    def _request(self, tag, authData, transportTarget, field2, field3,
+                 varNames, cbInfo):
+        if self.socket is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setblocking(0)
+        request_id = self.request_id
+        self.request_id = request_id % 0x7fffffff + 1
+        message = _ber_request(authData.mpModel, authData.communityName,
+                               tag, request_id, field2, field3, varNames)
+        # the rows of a GETBULK response, after the non-repeaters
+        width = len(varNames) - min(field2, len(varNames))
+        request = _BerRequest(tag, message, authData, transportTarget,
+                              width, cbInfo)
+        self.requests[request_id] = request
+        self._transmit(request)
+        return request_id
+
+    def _transmit(self, request):
+        request.deadline = time.time() + request.timeout
+        try:
+            self.socket.sendto(request.message, request.address)
+        except socket.error:
+            # like pysnmp, the request times out
+            pass
+        self.bytes_sent = self.bytes_sent + len(request.message)
+
+    def transport_target(self, transportAddr, timeout):
+        '''The target of a request with timeout, transportAddr resolved'''
+        return _Target(transportAddr, timeout)
+
+    def set_tick(self, tick):
+        '''Timeouts are checked at the deadline of every request anyway'''
+        pass
+
+    def opened(self):
+        return self.socket is not None
+
+    def uncfgCmdGen(self):
+        '''Closes the socket, pending requests are dropped'''
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self.requests = {}
+        self.timers = []
+
+    def pending(self):
+        return bool(self.requests)
+
+    def sockets(self):
+        '''Returns the sockets to wait for, readable and writable'''
+        return [self.socket], []
+
+    def timeout(self):
+        '''Seconds until the next request times out, or timer runs'''
+        if not self.requests:
+            return None
+        deadline = min([request.deadline for request in self.requests.values()])
+        timeout = max(0, deadline - time.time())
+        timer = self.next_timer()
+        if timer is not None:
+            timeout = min(timeout, timer)
+        return timeout
+
+    def poll(self):
+        '''Handles the responses received and the requests timed out, without
+        waiting'''
+        while self.socket is not None:
+            try:
+                data, address = self.socket.recvfrom(65535)
+            except socket.error:
+                break
+            self._receive(data, address)
+        now = time.time()
+        for request_id, request in self.requests.items():
+            if request.deadline > now or request_id not in self.requests:
+                continue
+            if request.retries:
+                request.retries = request.retries - 1
+                self._transmit(request)
+                continue
+            del self.requests[request_id]
+            cbFun, cbCtx = request.cbInfo
+            cbFun(request_id, errind.requestTimedOut, 0, 0, [], cbCtx)
+        self.run_timers()
+
+    def wait(self):
+        '''Waits until all requests are answered or timed out'''
+        _run_generators([self])
+
+    def _receive(self, data, address):
+        self.received = (len(data), time.time())
+        try:
+            version, community, request_id, errorStatus, errorIndex, \
+                varBinds = _ber_response(data)
+        except _BerError:
+            # pysnmp drops what it can't decode too
+            return
+        request = self.requests.get(request_id)
+        if request is None or request.address != address or \
+           request.community != community:
+            return
+        del self.requests[request_id]
+        errorIndication = None
+        if request.tag == _BER_GET:
+            varBindTable = varBinds
+        elif request.tag == _BER_NEXT:
+            varBindTable = [varBinds]
+        elif request.width:
+            varBindTable = [varBinds[nr:nr + request.width]
+                            for nr in range(0, len(varBinds), request.width)]
+        else:
+            varBindTable = []
+        if request.tag != _BER_GET and not errorStatus and not varBinds:
+            errorIndication = errind.emptyResponse
+        cbFun, cbCtx = request.cbInfo
+        cbFun(request_id, errorIndication, errorStatus, errorIndex,
+              varBindTable, cbCtx)
+
+
+def _run_generators(generators):
+    '''Runs the requests of several command generators until all are
+    answered or timed out, waiting on all their sockets at once'''
+    while _step_generators(generators):
+        pass
+
+def _step_generators(generators, max_wait=None):
+    '''Waits at most max_wait seconds (None: no limit) on the sockets of
+    several command generators and handles what came in or timed out.
+    Returns False, without waiting, when no requests are pending'''
+    active = [generator for generator in generators if generator.pending()]
+    if not active:
+        return False
+    readable, writable, timeouts = [], [], []
+    for generator in active:
+        sockets = generator.sockets()
+        readable.extend(sockets[0])
+        writable.extend(sockets[1])
+        timeout = generator.timeout()
+        if timeout is not None:
+            timeouts.append(timeout)
+    if max_wait is not None:
+        timeouts.append(max_wait)
+    try:
+        select.select(readable, writable, [], min(timeouts or [None]))
+    except select.error, e:
+        if e.args[0] != errno.EINTR:
+            raise
+    for generator in active:
+        generator.poll()
+    return True
+
+
+class SnmpDispatcher(object):
+    '''Runs coroutines for many SnmpClients concurrently
+
+    Clients created with SnmpClient(..., dispatcher=d) share one pysnmp
+    engine and one udp socket, pysnmp matches the responses to the
+    requests by request-id. Clients with codec='ber' share a socket of
+    their own. Example:
+        d = SnmpDispatcher()
+        tasks = [(host, SnmpClient(host, 2, 'public', dispatcher=d)
+                  .get_many_task(['.1.3.6.1.2.1.1.5.0'])) for host in hosts]
+        d.run(tasks, callback)'''
+
+    def __init__(self):
+        # command generator class -> the one shared by the clients
+        self.generators = {}
+        # address -> _Endpoint, the round trips and failures of an agent
+        # address are kept for the clients of later checks
+        self.endpoints = {}
+
+    def generator(self, generator_class):
+        '''Returns the command generator of generator_class for a client'''
+        if not generator_class in self.generators:
+            self.generators[generator_class] = generator_class()
+        return self.generators[generator_class]
+
+    def endpoint(self, target, samples):
+        '''Returns the _Endpoint of target for a client'''
+        if not target.transportAddr in self.endpoints:
+            self.endpoints[target.transportAddr] = _Endpoint(target, samples)
+        return self.endpoints[target.transportAddr]
+
+    def run(self, tasks, callback, concurrency=50):
+        '''Runs tasks, an iterable of (key, coroutine), with at most
+        concurrency of them waiting for a response at the same time.
+        callback(key, result, error) is called when a task finishes,
+        error is None or the exception it raised.'''
+        tasks = iter(tasks)
+        state = {'active': 0, 'starting': False}
+        def finished(key, result, error):
+            state['active'] = state['active'] - 1
+            callback(key, result, error)
+            start()
+        def start():
+            # tasks that finish without a request would recurse otherwise
+            if state['starting']:
+                return
+            state['starting'] = True
+            while state['active'] < concurrency:
+                try:
+                    key, coroutine = tasks.next()
+                except StopIteration:
+                    break
+                state['active'] = state['active'] + 1
+                self.start(key, coroutine, finished)
+            state['starting'] = False
+        start()
+        self.wait()
+
+    def start(self, key, coroutine, callback):
+        '''Starts coroutine without waiting for it: it runs until its first
+        request, step or wait handle the responses. callback(key, result,
+        error) is called when it finishes, maybe before start returns'''
+        task = _Task(coroutine)
+        def advance(response=None, error=None):
+            request = task.step(response, error)
+            while request is not None:
+                try:
+                    request.client._send(request, lambda *response:
+                                         advance(response))
+                    return
+                except Exception:
+                    request = task.step(error=sys.exc_info())
+            if task.error:
+                callback(key, None, task.error[1])
+            else:
+                callback(key, task.result, None)
+        advance()
+
+    def step(self, max_wait=None):
+        '''Handles the responses and timeouts of the requests underway,
+        waiting at most max_wait seconds (None: no limit) for one. Returns
+        False, without waiting, when no request is underway'''
+        return _step_generators(self.generators.values(), max_wait)
+
+    def wait(self):
+        '''Waits until all requests sent through the dispatcher finished'''
+        if len(self.generators) == 1:
+            self.generators.values()[0].wait()
+        else:
+            _run_generators(self.generators.values())
+
 
 class SnmpClient(object):
     '''Simple Snmpv1/2/3 Client class
@@ -73,63 +771,274 @@ class SnmpClient(object):
         * privkey:      string  - snmpv3 encrytion key, default None
     Other arguments:
         * port          integer - default 163
+        * timeout       number  - seconds all requests of the client may
+                                  take together, None (default) for no
+                                  limit. See set_timeout
+        * dispatcher    SnmpDispatcher - run requests concurrently with the
+                                  other clients of this dispatcher
+        * usm_cache     object with load(key), store(key, state) and
+                        forget(key) methods, like schau_cache.UsmStateCache.
+                        Keeps the snmpv3 engine id, boots, time and localized
+                        keys of the agent between runs, so a v3 client
+                        doesn't need discovery round trips and key hashing.
+                        Not used with a dispatcher
+        * codec         string  - 'pysnmp' (default) or 'ber': snmpv1/v2c
+                                  requests go through the built-in BER
+                                  codec instead of the pysnmp engine, which
+                                  starts and decodes much faster. The values
+                                  are python ints, strings and oid tuples
+                                  instead of pyasn1 objects. snmpv3 always
+                                  uses pysnmp
+        * endpoints     list of other addresses of the same agent, hostnames
+                        or (host, port). Every request goes to the healthiest
+                        address, and to the next one too when it isn't
+                        answered within the usual round trip times of the
+                        first: the first response is used. Without
+                        usm_cache
     The privacy protocol used is DES (only protocol implemented)
 
     Supplied methods
         * get
+        * get_many
+        * get_columns
+        * get_subtrees
+        * walk
         * get_table
+        * get_dict
+    Every method except walk and get_dict has a coroutine version with a
+    _task suffix, to check many hosts at once with a SnmpDispatcher.
+    The requests are counted and timed in the stats attribute, an SnmpStats.
     
     SNMPv1 example:
        s = SnmpClient('netappa1', 1, community='password')
     SNMPv3 authNoPriv example:
        s = SnmpClient('jay1', 3, user='snmpuser', authkey='password')
-       s.get('1.3.6.1.2.1.1.1.0')'''
+       s.get('1.3.6.1.2.1.1.1.0')
+    SNMPv3 authPriv example:
+       s = SnmpClient('jay1', 3, user='snmpuser', authkey='password',
+                      privkey='secret', authProtocol='sha')'''
+
+    # snmp error-status values handled by the client
+    ERROR_TOOBIG = 1
+    ERROR_NOSUCHNAME = 2
+    # request timeouts in seconds (rfc2988): before the first response,
+    # and the limits of srtt + 4 * rttvar once round trips are measured
+    INITIAL_RTO = 1.0
+    MIN_RTO = 0.2
+    MAX_RTO = 5.0
+    # a request is sent at most 1 + RETRIES times, like pysnmp does
+    RETRIES = 5
+    # seconds between timeout checks, pysnmp checks once a second
+    TICK = 0.05
+    # with several endpoints: the percentile of the round trips of an
+    # endpoint after which a request goes to the next one too, the round
+    # trips kept per endpoint and needed for it, and the requests in a row
+    # an endpoint doesn't answer before the others go first
+    HEDGE_PERCENTILE = 0.95
+    HEDGE_SAMPLES = 32
+    HEDGE_MIN_SAMPLES = 5
+    UNHEALTHY = 2
 
     def __init__(self, host, protocol,community=None, secname='test-agent',
                 user=None, authkey=None, privkey=None, timeout=None, port=161,
-                authProtocol='md5'):
+                authProtocol='md5', dispatcher=None, usm_cache=None,
+                codec='pysnmp', endpoints=None):
         errortext = self._validate_input(host, protocol, community, secname,
-                    user, authkey, privkey,timeout, port, authProtocol)
+                    user, authkey, privkey,timeout, port, authProtocol, codec,
+                    endpoints)
         if errortext:
             raise SnmpBadArgumentError(errortext)
-        # for oid conversions
-        self.oid_converter = ObjectIdentifier()
         self.protocol = protocol
-        self.timeout = timeout
-        self.target = cmdgen.UdpTransportTarget((host, port))
-        if protocol is 1:
-            self.authentication = cmdgen.CommunityData(secname, community, 0)
-        elif protocol is 2:
-            self.authentication = cmdgen.CommunityData(secname, community)
-        elif protocol is 3:
-            if privkey:
-                privprot = cmdgen.usmD
-            else:
-                privprot = cmdgen.usmNoPrivProtocol
-            if authkey:
-                if authProtocol == 'md5':
-                    authprot = cmdgen.usmHMACMD5AuthProtocol
-                else:
-                    authprot = cmdgen.usmHMACSHAAuthProtocol
-            else:
-                authprot = cmdgen.usmNoAuthProtocol
-            if privkey:
-                privprot = cmdgen.usmDESPrivProtocol
+        # smoothed round trip time and its variation, None until measured
+        self.srtt = None
+        self.rttvar = None
+        self.set_timeout(timeout)
+        # largest number of varbinds the agent accepted in one request,
+        # 0 means no limit known yet
+        self.max_varbinds = 0
+        setup = time.time()
+        if dispatcher is not None and protocol in (1, 2):
+            # an engine sends the community configured last for a security
+            # name, the other clients of the dispatcher may use another one
+            secname = '%s-%s' % (secname[:23],
+                                 sha1(community).hexdigest()[:8])
+        if codec == 'ber' and protocol in (1, 2):
+            resolve = lambda host, port: _Target((socket.gethostbyname(host),
+                                                  port))
+            self.authentication = _CommunityData(secname, community,
+                                                 protocol - 1)
+            generator_class = _BerCommandGenerator
+        else:
+            engine = _pysnmp()
+            resolve = engine.udp_target
+            if protocol is 3:
+                self.authentication = engine.usm_user_data(user, authkey,
+                                                    privkey, authProtocol)
             else:
-                privprot = cmdgen.usmNoPrivProtocol
-            self.authentication = cmdgen.UsmUserData(user, authkey, privkey,
-                                                    authprot, privprot)
-        self.snmpclient = cmdgen.CommandGenerator()
+                self.authentication = engine.community_data(secname,
+                                                    community, protocol)
+            generator_class = engine.CommandGenerator
+        self.target = resolve(host, port)
+        targets = [self.target]
+        for endpoint in endpoints or ():
+            if not isinstance(endpoint, tuple):
+                endpoint = (endpoint, port)
+            targets.append(resolve(*endpoint))
+        if len(targets) == 1:
+            self.endpoints = [_Endpoint(self.target, self.HEDGE_SAMPLES)]
+        elif dispatcher is None:
+            self.endpoints = [_Endpoint(target, self.HEDGE_SAMPLES)
+                              for target in targets]
+        else:
+            # the clients of later checks start from what these learned
+            self.endpoints = [dispatcher.endpoint(target, self.HEDGE_SAMPLES)
+                              for target in targets]
+        self.dispatcher = dispatcher
+        if dispatcher is None:
+            self.snmpclient = generator_class()
+        else:
+            # share the engine and socket of the dispatcher
+            self.snmpclient = dispatcher.generator(generator_class)
+        self.usm_cache = None
+        if protocol is 3 and usm_cache is not None and dispatcher is None \
+           and len(self.endpoints) == 1:
+            self.usm_cache = usm_cache
+            self.usm_key = (self.target.transportAddr, user, authProtocol,
+                            bool(privkey), sha1('%s\0%s' % (authkey,
+                                                privkey)).hexdigest())
+            self._load_usm_state()
+        self.stats.setup = time.time() - setup
+
+    def close(self):
+        '''Closes the socket of the client, unless it belongs to a
+        dispatcher. The client opens a new one when used again'''
+        if self.dispatcher is None and self.snmpclient.opened():
+            self.snmpclient.uncfgCmdGen()
+            self.snmpclient = self.snmpclient.__class__()
+
+    def set_timeout(self, timeout):
+        '''Gives the requests from now on timeout seconds together, None for
+        no limit
+
+        Every request waits for a response as long as the round trips to
+        the agent measured so far make reasonable, and is sent again up to
+        RETRIES times, but none waits past the timeout: then the method
+        raises SnmpTimeoutError. Pooled clients get a new timeout per
+        check.
+        The requests within this timeout are counted in a new SnmpStats,
+        the stats attribute.'''
+        self.timeout = timeout
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+        self.stats = SnmpStats()
+
+    def _rto(self):
+        '''Seconds to wait for a response before sending a request again'''
+        if self.srtt is None:
+            return self.INITIAL_RTO
+        rto = self.srtt + 4 * self.rttvar
+        return min(max(rto, self.MIN_RTO), self.MAX_RTO)
+
+    def _measured(self, rtt):
+        '''Updates the round trip estimates with a response (rfc2988)'''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def _ranked_endpoints(self):
+        '''The endpoints in the order given, the unhealthy ones last. An
+        unhealthy one gets requests again when the others are slow, and
+        is healthy again with its first response'''
+        healthy = [endpoint for endpoint in self.endpoints
+                   if endpoint.failures < self.UNHEALTHY]
+        return healthy + [endpoint for endpoint in self.endpoints
+                          if endpoint.failures >= self.UNHEALTHY]
+
+    def _hedge_delay(self, endpoint):
+        '''Seconds to wait for a response of endpoint before sending the
+        request to the next one too: the HEDGE_PERCENTILE of its recent
+        round trips, half the retransmission timeout until enough of them
+        are measured'''
+        rtts = sorted(endpoint.rtts)
+        if len(rtts) < self.HEDGE_MIN_SAMPLES:
+            return self._rto() / 2
+        nr = int(self.HEDGE_PERCENTILE * (len(rtts) - 1) + 0.5)
+        return max(rtts[nr], self.TICK)
+
+    def _request_timeout(self, now):
+        '''Timeout for a request sent now, within the deadline. Rounded down
+        to steps of about 20%, pysnmp configures a target per value.
+        Returns None if there's no time left for a request'''
+        timeout = self._rto()
+        if self.deadline is not None:
+            left = self.deadline - now
+            # no time left for a round trip
+            if left < max(self.TICK, self.srtt or self.MIN_RTO):
+                return None
+            timeout = min(timeout, left)
+        step = self.TICK
+        while step * 1.2 <= timeout:
+            step = step * 1.2
+        return round(step, 2)
+
+    def _error(self, errorIndication):
+        '''The exception for a response with errorIndication'''
+        if errorIndication is timeoutBudgetUsed:
+            reached = 'timeout reached'
+            if self.timeout is not None:
+                reached = 'timeout of %gs reached' % round(self.timeout, 1)
+            return SnmpTimeoutError('%s, %d of %d requests answered' %
+                    (reached, len(self.stats.rtts), self.stats.requests))
+        return SnmpError(errorIndication)
+
+    def _load_usm_state(self):
+        '''Configures the engine with the cached snmpv3 state, if any'''
+        self.usm_state = self.usm_cache.load(self.usm_key)
+        if self.usm_state is not None:
+            self.snmpclient.set_usm_state(self.authentication, self.target,
+                                          self.usm_state)
+
+    def _check_usm_state(self, errorIndication):
+        '''Saves the snmpv3 state after a response, or forgets it when the
+        agent didn't accept it. Returns True if the request must be sent
+        again with a new engine'''
+        if not errorIndication:
+            state = self.snmpclient.usm_state(self.authentication, self.target)
+            if state is not None and (self.usm_state is None or
+                                      state['boots'] != self.usm_state['boots']):
+                self.usm_cache.store(self.usm_key, state)
+                self.usm_state = state
+            return False
+        if self.usm_state is None:
+            return False
+        # engine id changed, agent rebooted or keys changed: start over.
+        # After a timeout the request is retried on the new engine anyway
+        self.usm_cache.forget(self.usm_key)
+        self.usm_state = None
+        self.snmpclient.uncfgCmdGen()
+        self.snmpclient = self.snmpclient.__class__()
+        return not isinstance(errorIndication, errind.RequestTimedOut)
 
     def _validate_input(self, host,protocol, community, secname, user, authkey,
-                        privkey, timeout, port, authProtocol):
+                        privkey, timeout, port, authProtocol, codec,
+                        endpoints=None):
         '''Validates arguments, returns False if valid, else error message'''
         if not protocol in (1,2,3):
             return 'unknown protocol version'
+        if not codec in ('pysnmp', 'ber'):
+            return 'unknown codec'
         if not type(port) is int:
             return 'port must be an integer'
         if (port < 0) or (port >= 2**16):
             return 'port must be >= 0 and < 2^16'
+        for endpoint in endpoints or ():
+            if isinstance(endpoint, tuple) and \
+               (not type(endpoint[1]) is int or not 0 <= endpoint[1] < 2**16):
+                return 'endpoint ports must be integers >= 0 and < 2^16'
         if protocol in (1,2):
             if not community:
                 return 'community is a required argument for snmpv1/2'
@@ -139,31 +1048,163 @@ class SnmpClient(object):
            if authkey:
                if not authProtocol in ('md5', 'sha'):
                    return 'unknown authentication protocol'
+           # rfc3414 asks for at least 8 characters, pysnmp enforces it
+           for key in (authkey, privkey):
+               if key is not None and len(key) < 8:
+                   return 'snmpv3 keys must be at least 8 characters'
         return False
 
+    def _send(self, request, callback, retry=0):
+        '''Sends request, callback(errorIndication, errorStatus, errorIndex,
+        varBinds) is called from the dispatcher with the response
+
+        The request is sent again after a timeout or error indication,
+        errorIndication is timeoutBudgetUsed when the timeout of the client
+        ran out. With several endpoints it is also sent to the next one
+        when the first doesn't answer within _hedge_delay, the first
+        response is used and the other one only measured.'''
+        start = time.time()
+        timeout = self._request_timeout(start)
+        if timeout is None:
+            callback(timeoutBudgetUsed, 0, 0, [])
+            return
+        stats = self.stats
+        endpoints = self._ranked_endpoints()
+        # endpoints waiting for a response, the hedge timer
+        state = {'underway': [], 'done': False, 'hedge': None, 'sent': None}
+        def response(endpoint, sent, errorIndication, errorStatus,
+                     errorIndex, varBinds):
+            now = time.time()
+            decode = 0.0
+            if isinstance(errorIndication, errind.RequestTimedOut):
+                stats.timeouts = stats.timeouts + 1
+                endpoint.failures = endpoint.failures + 1
+            elif self.snmpclient.received is not None:
+                # the message pysnmp just decoded
+                size, arrived = self.snmpclient.received
+                stats.bytes_received = stats.bytes_received + size
+                decode = now - arrived
+            if not errorIndication:
+                endpoint.answered(now - sent)
+            stats.decode = stats.decode + decode
+            state['underway'].remove(endpoint)
+            if state['done'] or errorIndication and state['underway']:
+                # answered already, or the other endpoint still may
+                return
+            state['done'] = True
+            if state['hedge'] is not None:
+                self.snmpclient.cancel(state['hedge'])
+            stats.wait = stats.wait + now - state['sent'] - decode
+            if self.usm_cache is not None and \
+               self._check_usm_state(errorIndication):
+                self._send(request, callback, retry)
+                return
+            if isinstance(errorIndication, errind.RequestTimedOut) and \
+               self.deadline is not None and \
+               self.deadline - time.time() < self.TICK:
+                errorIndication = timeoutBudgetUsed
+            elif errorIndication and retry < self.RETRIES:
+                # like pysnmp, which answers the reports of the snmpv3
+                # discovery this way too
+                self._send(request, callback, retry + 1)
+                return
+            elif not errorIndication:
+                stats.rtts.append(now - sent)
+                self._measured(now - sent)
+            callback(errorIndication, errorStatus, errorIndex, varBinds)
+        def send(endpoint):
+            began = time.time()
+            target = self.snmpclient.transport_target(
+                                endpoint.target.transportAddr, timeout)
+            bytes_sent = self.snmpclient.bytes_sent
+            def endpoint_response(sendRequestHandle, errorIndication,
+                                  errorStatus, errorIndex, varBinds, cbCtx):
+                response(endpoint, sent, errorIndication, errorStatus,
+                         errorIndex, varBinds)
+                # returning nothing stops pysnmp from walking on by itself
+            cbInfo = (endpoint_response, None)
+            if request.command == 'get':
+                self.snmpclient.asyncGetCmd(self.authentication, target,
+                                            request.oids, cbInfo)
+            elif request.command == 'next':
+                self.snmpclient.asyncNextCmd(self.authentication, target,
+                                             request.oids, cbInfo)
+            else:
+                self.snmpclient.asyncBulkCmd(self.authentication, target,
+                                             0, request.max_repetitions,
+                                             request.oids, cbInfo)
+            state['underway'].append(endpoint)
+            # after the snmpv3 key hashing of a new engine
+            sent = time.time()
+            if state['sent'] is None:
+                state['sent'] = sent
+            stats.setup = stats.setup + sent - began
+            stats.requests = stats.requests + 1
+            stats.bytes_sent = stats.bytes_sent + \
+                               self.snmpclient.bytes_sent - bytes_sent
+        def hedge():
+            state['hedge'] = None
+            stats.hedges = stats.hedges + 1
+            send(endpoints[1])
+        send(endpoints[0])
+        if retry:
+            stats.retries = stats.retries + 1
+        if len(endpoints) > 1:
+            delay = self._hedge_delay(endpoints[0])
+            if delay < timeout:
+                state['hedge'] = self.snmpclient.call_later(delay, hedge)
+        self.snmpclient.set_tick(self.TICK)
+
+    def _wait(self, request):
+        '''Sends request and waits for the response'''
+        response = []
+        self._send(request, lambda *args: response.extend(args))
+        while not response:
+            if len(self.endpoints) > 1:
+                # not for the hedged request that lost as well
+                _step_generators([self.snmpclient])
+            else:
+                # the request may be sent again on a new engine
+                self.snmpclient.wait()
+        return tuple(response)
+
+    def _oids(self, oids):
+        '''Dotted strings -> tuples of numerics, raises SnmpBadArgumentError'''
+        result = []
+        for oid in oids:
+            try:
+                if not isinstance(oid, tuple):
+                    oid = oid.strip('.').split('.')
+                oid = tuple([int(arc) for arc in oid])
+            except (ValueError, TypeError, AttributeError):
+                raise SnmpBadArgumentError('Invalid OID format')
+            # the first two arcs are encoded in one
+            if len(oid) < 2 or not 0 <= oid[0] <= 2 or min(oid) < 0 or \
+               (oid[0] < 2 and oid[1] >= 40):
+                raise SnmpBadArgumentError('Invalid OID format')
+            result.append(oid)
+        return result
+
     def get(self, oid, bulk=False):
         '''Get the value for the oid, raises SnmpError
         
-        Return value is always a string'''
+        Return value is always a string
+        With bulk=True the whole subtree under oid is read, and returned as
+        a dictionary {oid tuple: value}'''
+        if bulk:
+            return dict(self.walk(oid))
+        return run_task(self.get_task(oid))
+
+    def get_task(self, oid):
+        '''Coroutine version of get, for SnmpDispatcher'''
         # Dotted string -> tuple of numerics OID conversion
-        try:
-            oid = self.oid_converter.prettyIn(oid)
-        except PyAsn1Error:
-            raise SnmpBadArgumentError('Invalid OID format')
-        try:
-            if bulk:
-                result = self.snmpclient.bulkCmd(self.authentication,
-                                                self.target, 0, 25, oid)
-            else:
-                result = self.snmpclient.getCmd(self.authentication,
-                                                self.target, oid)
-        except NoSuchObjectError:
-            raise SnmpNoInstanceError
+        [oid] = self._oids([oid])
+        result = yield SnmpRequest(self, 'get', [oid])
         errorIndication, errorStatus, errorIndex, varBinds = result
         # can't get anything from this SNMP agent:
         # network or authorization problem
         if errorIndication:
-            raise SnmpError(errorIndication)
+            raise self._error(errorIndication)
         else:
             # problem with this specific OID
             if errorStatus:
@@ -171,44 +1212,220 @@ class SnmpClient(object):
                                                 varBinds[int(errorIndex)-1]) )
             # no problems, we got the value
             else:
-                resultdict = {}
                 for row in varBinds:
-                    if bulk:
-                        [(name, val)] = row
-                        resultdict[name]=val
-                        return resultdict
-                    else:
-                        name, val = row
-                        if isinstance(val, Null):
-                            raise SnmpNoInstanceError("OID doesn't exist")
-                        return val
-                        
+                    name, val = row
+                    if isinstance(val, _NO_VALUE):
+                        raise SnmpNoInstanceError("OID doesn't exist")
+                    yield Return(val)
+
+    def get_many(self, oids):
+        '''Get the values for a list of oids, raises SnmpError
+
+        All oids are packed in as few GET requests as possible. When the
+        agent answers tooBig the request is split in two and retried,
+        the smaller size is remembered for the next calls.
+        Returns a dictionary {oid: value}, oids that don't exist on the
+        agent are left out. The oids may be dotted strings or tuples of
+        integers, the keys are the oids as given'''
+        return run_task(self.get_many_task(oids))
+
+    def get_many_task(self, oids):
+        '''Coroutine version of get_many, for SnmpDispatcher'''
+        pending = [zip(oids, self._oids(oids))]
+        results = {}
+        while pending:
+            batch = pending.pop()
+            if self.max_varbinds and len(batch) > self.max_varbinds:
+                pending.append(batch[self.max_varbinds:])
+                batch = batch[:self.max_varbinds]
+            if not batch:
+                continue
+            result = yield SnmpRequest(self, 'get',
+                                       [oid for name, oid in batch])
+            errorIndication, errorStatus, errorIndex, varBinds = result
+            if errorIndication:
+                raise self._error(errorIndication)
+            errorStatus = int(errorStatus)
+            if errorStatus == self.ERROR_TOOBIG and len(batch) > 1:
+                # the response doesn't fit in one packet, split the request
+                half = len(batch) // 2
+                self.max_varbinds = half
+                pending.append(batch[half:])
+                pending.append(batch[:half])
+            elif errorStatus == self.ERROR_NOSUCHNAME and self.protocol == 1 \
+                 and 0 < int(errorIndex) <= len(batch):
+                # snmpv1 fails the whole request for one unknown oid,
+                # drop that one and ask the others again
+                del batch[int(errorIndex)-1]
+                pending.append(batch)
+            elif errorStatus:
+                raise SnmpError('%s at %s' % (errorStatus,
+                                batch[int(errorIndex)-1][0]))
+            else:
+                for (name, oid), (rname, val) in zip(batch, varBinds):
+                    # snmpv2 noSuchObject/noSuchInstance are Null subclasses
+                    if not isinstance(val, _NO_VALUE):
+                        results[name] = val
+        yield Return(results)
+
+    def _walk_task(self, columns, max_repetitions, sink, max_requests=None):
+        '''Coroutine that pages through the subtrees of columns (oid tuples)
+        side by side, with GETBULK or with GETNEXT under snmpv1, raises
+        SnmpError
+
+        Calls sink(column number, oid tuple, value) for every varbind.
+        Every column continues from the last oid it returned, so truncated
+        responses and columns of unequal length are handled.
+        Returns True, or False when it stopped after max_requests requests
+        before the end of the subtrees.'''
+        active = range(len(columns))
+        last = list(columns)
+        requests = 0
+        while active:
+            if max_requests is not None and requests >= max_requests:
+                yield Return(False)
+            requests = requests + 1
+            oids = [last[nr] for nr in active]
+            if self.protocol == 1:
+                result = yield SnmpRequest(self, 'next', oids)
+            else:
+                repetitions = max_repetitions
+                if self.max_varbinds:
+                    repetitions = min(repetitions,
+                                      max(1, self.max_varbinds // len(oids)))
+                result = yield SnmpRequest(self, 'bulk', oids, repetitions)
+            errorIndication, errorStatus, errorIndex, varBindTable = result
+            if errorIndication:
+                raise self._error(errorIndication)
+            errorStatus = int(errorStatus)
+            if errorStatus == self.ERROR_TOOBIG and self.protocol != 1 \
+               and repetitions > 1:
+                # fewer rows per request
+                self.max_varbinds = (repetitions // 2) * len(oids)
+                continue
+            if errorStatus == self.ERROR_NOSUCHNAME and self.protocol == 1 \
+               and 0 < int(errorIndex) <= len(oids):
+                # snmpv1 end of mib for one of the columns
+                del active[int(errorIndex)-1]
+                continue
+            if errorStatus:
+                raise SnmpError('%s at %s' % (errorStatus,
+                                oids[(int(errorIndex)-1) % len(oids)]))
+            if not varBindTable:
+                break
+            finished = []
+            for row in varBindTable:
+                for nr, (name, val) in zip(active, row):
+                    if nr in finished:
+                        continue
+                    name = tuple(name)
+                    column = columns[nr]
+                    # endOfMibView, or a bulk response ran past the column
+                    if isinstance(val, _NO_VALUE) or len(name) <= len(column) \
+                       or name[:len(column)] != column:
+                        finished.append(nr)
+                        continue
+                    if name <= last[nr]:
+                        raise SnmpError('OID not increasing at %s' % (name,))
+                    last[nr] = name
+                    sink(nr, name, val)
+            active = [nr for nr in active if nr not in finished]
+        yield Return(True)
+
+    def get_columns(self, oids, max_repetitions=16):
+        '''Walks several table columns at once, raises SnmpError
+
+        With snmpv2 and 3 the columns are read with GETBULK requests that
+        each return up to max_repetitions rows, with snmpv1 every GETNEXT
+        request returns one row of all the columns.
+        Returns a dictionary {column oid: {index: value}}, the index is the
+        part of the oid after the column, as a dotted string'''
+        return run_task(self.get_columns_task(oids, max_repetitions))
+
+    def get_columns_task(self, oids, max_repetitions=16):
+        '''Coroutine version of get_columns, for SnmpDispatcher'''
+        columns = self._oids(oids)
+        table = {}
+        for oid in oids:
+            table[oid] = {}
+        def sink(nr, name, val):
+            index = '.'.join([str(x) for x in name[len(columns[nr]):]])
+            table[oids[nr]][index] = val
+        yield self._walk_task(columns, max_repetitions, sink)
+        yield Return(table)
+
+    def get_subtrees(self, oids, max_repetitions=16, max_requests=None):
+        '''Walks the subtrees under oids side by side like get_columns,
+        raises SnmpError
+
+        Returns (varbinds, complete): the list of (oid tuple, value) as
+        received, without converting the oids, for callers that map them
+        themselves (see serverview_mib.Registry). complete is False when
+        the walk stopped after max_requests requests.'''
+        return run_task(self.get_subtrees_task(oids, max_repetitions,
+                                               max_requests))
+
+    def get_subtrees_task(self, oids, max_repetitions=16, max_requests=None):
+        '''Coroutine version of get_subtrees, for SnmpDispatcher'''
+        varbinds = []
+        complete = yield self._walk_task(self._oids(oids), max_repetitions,
+                        lambda nr, name, val: varbinds.append((name, val)),
+                        max_requests)
+        yield Return((varbinds, complete))
+
+    def walk(self, oid, max_repetitions=25):
+        '''Walks the subtree under oid, raises SnmpError
+
+        Generator, yields (oid tuple, value) in oid order as the responses
+        come in. snmpv2 and 3 fetch up to max_repetitions varbinds per
+        GETBULK request, snmpv1 walks with GETNEXT. Only one page of
+        varbinds is held in memory at a time.
+        Example:
+            for name, value in s.walk('.1.3.6.1.2.1.1'):
+                print name, value'''
+        page = []
+        task = _Task(self._walk_task(self._oids([oid]), max_repetitions,
+                            lambda nr, name, val: page.append((name, val))))
+        request = task.step()
+        while request is not None:
+            try:
+                response = self._wait(request)
+            except Exception:
+                request = task.step(error=sys.exc_info())
+            else:
+                request = task.step(response)
+            for varbind in page:
+                yield varbind
+            del page[:]
+        if task.error:
+            raise task.error[0], task.error[1], task.error[2]
 
     def get_table(self, oid):
         '''This method accepts the oid of the table ENTRY and returns a 
-        dictionary containing the table. Currently only works with snmpv2 and3'''
+        dictionary containing the table: {column: {row: value}}
+        Columns are integers, rows are integers for tables with a single
+        index and tuples for tables with a composite index.'''
+        return run_task(self.get_table_task(oid))
+
+    def get_table_task(self, oid):
+        '''Coroutine version of get_table, for SnmpDispatcher'''
         # explanation http://dartware.com/support/faqs/snmpfaqs.html#table
         table = {}
-        parent = self.oid_converter.prettyIn(oid)
-        parent = ObjectIdentifier(parent)
-        if self.protocol in (2,3):
-            raw = self.get(oid, bulk=True)
-            for child in raw:
-                if not parent.isPrefixOf(child):
-                    continue
-                nrs = child.prettyPrint().split('.')
-                rij = int(nrs.pop())
-                kolom = int(nrs.pop())
-                try:
-                    table[kolom][rij]= raw[child]
-                except:
-                    table[kolom] = {}
-                    table[kolom][rij]= raw[child]
-            return table
-        elif protocol is 1:
-            # TODO implement with  SNMPVv1 getnext
-            pass
-            
+        [entry] = self._oids([oid])
+        parent = len(entry)
+        def sink(nr, name, val):
+            kolom = name[parent]
+            rij = name[parent+1:]
+            if len(rij) == 1:
+                rij = rij[0]
+            try:
+                table[kolom][rij]= val
+            except KeyError:
+                table[kolom] = {}
+                table[kolom][rij]= val
+        yield self._walk_task([entry], 25, sink)
+        yield Return(table)
+
     def get_dict(self, oid_dict):
         '''Accepts a dictionary like this: 
         {'oidname1': '.1.2.3.4.5', 'oidname2':'.1.2.3.4.6'}
@@ -216,14 +1433,177 @@ class SnmpClient(object):
         retrieved. Only the retrieved oid's will be returned
         Returns False if an SNMP error occured (other than not being able to
         retrieve a value)'''
+        return run_task(self.get_dict_task(oid_dict))
+
+    def get_dict_task(self, oid_dict):
+        '''Coroutine version of get_dict, for SnmpDispatcher'''
         results = {}
+        try:
+            values = yield self.get_many_task(oid_dict.values())
+        except SnmpError:
+            yield Return(False)
         for name in oid_dict:
-            try:
-                x = self.get(oid_dict[name])
-            except SnmpNoInstanceError:
-                continue 
-            except:
-                return False
-            else:
-                results[name] = x
-        return results
+            if oid_dict[name] in values:
+                results[name] = values[oid_dict[name]]
+        yield Return(results)
+
+
+class AsyncSnmpClient(SnmpClient):
+    '''Snmpv1/2/3 client whose methods are coroutines
+
+    Takes the same arguments as SnmpClient and raises the same errors, but
+    get, get_many, get_columns, walk, get_table and get_dict return
+    coroutines: generators to be yielded from another coroutine, which
+    receives the result, or to be run with run_task or an SnmpDispatcher.
+    Unless a dispatcher is given, all AsyncSnmpClients share one
+    dispatcher, so the requests to all hosts go out over one udp socket
+    and pysnmp matches the responses by request-id.
+
+    Example, the system name of many hosts at once:
+        def sysname(client):
+            value = yield client.get('.1.3.6.1.2.1.1.5.0')
+            yield Return(str(value))
+        clients = [AsyncSnmpClient(host, 2, 'public') for host in hosts]
+        def done(client, name, error):
+            print client.host, name or error
+        AsyncSnmpClient.run([(c, sysname(c)) for c in clients], done, 500)'''
+
+    _shared_dispatcher = None
+
+    def __init__(self, host, protocol, community=None, secname='test-agent',
+                 user=None, authkey=None, privkey=None, timeout=None, port=161,
+                 authProtocol='md5', dispatcher=None, codec='pysnmp',
+                 endpoints=None):
+        if dispatcher is None:
+            dispatcher = self.shared_dispatcher()
+        SnmpClient.__init__(self, host, protocol, community, secname, user,
+                            authkey, privkey, timeout, port, authProtocol,
+                            dispatcher, codec=codec, endpoints=endpoints)
+        self.host = host
+
+    def shared_dispatcher(cls):
+        '''Returns the dispatcher shared by all AsyncSnmpClients'''
+        if cls._shared_dispatcher is None:
+            AsyncSnmpClient._shared_dispatcher = SnmpDispatcher()
+        return cls._shared_dispatcher
+    shared_dispatcher = classmethod(shared_dispatcher)
+
+    def run(cls, tasks, callback, concurrency=50):
+        '''Runs (key, coroutine) tasks on the shared dispatcher, see
+        SnmpDispatcher.run'''
+        cls.shared_dispatcher().run(tasks, callback, concurrency)
+    run = classmethod(run)
+
+    def get(self, oid):
+        '''Coroutine, returns the value of oid'''
+        return self.get_task(oid)
+
+    def get_many(self, oids):
+        '''Coroutine, returns {oid: value} for the oids that exist'''
+        return self.get_many_task(oids)
+
+    def get_columns(self, oids, max_repetitions=16):
+        '''Coroutine, returns {column oid: {index: value}}'''
+        return self.get_columns_task(oids, max_repetitions)
+
+    def get_subtrees(self, oids, max_repetitions=16, max_requests=None):
+        '''Coroutine, returns ([(oid tuple, value)], complete) of the
+        subtrees'''
+        return self.get_subtrees_task(oids, max_repetitions, max_requests)
+
+    def walk(self, oid, max_repetitions=25, sink=None):
+        '''Coroutine, walks the subtree under oid
+
+        Calls sink(oid tuple, value) for every varbind as the responses come
+        in and returns None, without a sink it returns the list of
+        (oid tuple, value). The arguments are in the order of
+        SnmpClient.walk, pass sink by name'''
+        if not isinstance(max_repetitions, (int, long)):
+            raise SnmpBadArgumentError('max_repetitions must be an integer, '
+                                       'pass sink by name')
+        return self._sink_walk_task(oid, max_repetitions, sink)
+
+    def _sink_walk_task(self, oid, max_repetitions, sink):
+        '''Coroutine behind walk'''
+        varbinds = None
+        if sink is None:
+            varbinds = []
+            sink = lambda name, val: varbinds.append((name, val))
+        yield self._walk_task(self._oids([oid]), max_repetitions,
+                              lambda nr, name, val: sink(name, val))
+        yield Return(varbinds)
+
+    def get_table(self, oid):
+        '''Coroutine, returns the table under the ENTRY oid as
+        {column: {row: value}}'''
+        return self.get_table_task(oid)
+
+    def get_dict(self, oid_dict):
+        '''Coroutine, returns {name: value} for {name: oid}'''
+        return self.get_dict_task(oid_dict)
+
+
+class SnmpClientPool(object):
+    '''Keeps SnmpClients for reuse by long running programs
+
+    A pooled client keeps its pysnmp engine, socket and what it learned
+    about the agent (snmpv3 engine id, varbind limit) between checks.
+    Threads take a client with acquire and give it back with release, a
+    client is used by one thread at a time. Clients that weren't used for
+    max_idle seconds are closed.
+        pool = SnmpClientPool()
+        client = pool.acquire('rx300-01', 2, community='public')
+        try:
+            client.get('.1.3.6.1.2.1.1.5.0')
+        finally:
+            pool.release(client)'''
+
+    def __init__(self, max_idle=600):
+        self.max_idle = max_idle
+        self.lock = thread.allocate_lock()
+        # key -> [client, lock, last used]
+        self.clients = {}
+
+    def acquire(self, host, protocol, **kwargs):
+        '''Returns a client for the SnmpClient arguments, waits while
+        another thread is using it'''
+        items = kwargs.items()
+        items.sort()
+        key = (host, protocol, tuple(items))
+        self.lock.acquire()
+        try:
+            self._expire()
+            if not key in self.clients:
+                client = SnmpClient(host, protocol, **kwargs)
+                client.pool_entry = [client, thread.allocate_lock(), 0]
+                self.clients[key] = client.pool_entry
+            entry = self.clients[key]
+            # not idle, even while waiting for the lock
+            entry[2] = time.time()
+        finally:
+            self.lock.release()
+        entry[1].acquire()
+        return entry[0]
+
+    def release(self, client):
+        '''Gives a client returned by acquire back to the pool'''
+        client.pool_entry[2] = time.time()
+        client.pool_entry[1].release()
+
+    def close(self):
+        '''Closes the clients that are not in use'''
+        self.lock.acquire()
+        try:
+            self._expire(0)
+        finally:
+            self.lock.release()
+
+    def _expire(self, max_idle=None):
+        if max_idle is None:
+            max_idle = self.max_idle
+        now = time.time()
+        for key, (client, lock, used) in self.clients.items():
+            if now - used >= max_idle and lock.acquire(False):
+                del self.clients[key]
+                client.close()
+                lock.release()
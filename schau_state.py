@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Keeps the recent polls of a fleet of agents in memory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''The last polls of many agents, for a poller that keeps running
+
+Every poll of an agent is recorded with the details problem_list_task
+fills in: the global status and the status of every subsystem, with the
+time and round trip time of the poll. Only the last history polls are
+kept, and a subsystem whose status changed flap_changes times among them
+is flapping:
+
+    fleet = FleetState(history=8, flap_changes=3)
+    fleet.restore('/var/lib/check_serverview/fleet')
+    fleet.record(('rx300-01', 161), details, rtt=0.004)
+    fleet.flapping(('rx300-01', 161))        # ['Deployment']
+    fleet.snapshot('/var/lib/check_serverview/fleet')
+
+Everything is kept as small integers in arrays, without python objects
+per poll: the global status, time and round trip time (in milliseconds)
+of all agents in array columns with a ring of history entries per agent,
+the subsystem statuses in a byte ring per subsystem of the agent. The
+subsystem names are numbered once for the whole fleet. An agent costs a
+few hundred bytes with the default history, a snapshot writes the arrays
+as they are.
+
+Status 0 means not read: the agent didn't answer, or had no such
+subsystem at the time.'''
+
+import os
+import sys
+import time
+import marshal
+from array import array
+
+# first bytes of a snapshot file, and the version of its layout
+SNAPSHOT_MAGIC = 'SVFLEET1'
+
+
+class _Agent(object):
+    '''What is kept per agent besides its row in the columns
+
+    * row:      number of the agent in the columns
+    * layout:   tuple of the numbers of its subsystem names, shared by the
+                agents with the same subsystems
+    * statuses: array of bytes, a ring of history statuses per subsystem
+                in layout order'''
+
+    __slots__ = ('row', 'layout', 'statuses')
+
+    def __init__(self, row, layout, statuses):
+        self.row = row
+        self.layout = layout
+        self.statuses = statuses
+
+
+class FleetState(object):
+    '''The last history polls of every agent, by key (e.g. (host, port))
+
+    * history:      polls kept per agent, at most 255
+    * flap_changes: status changes among them that make a subsystem
+                    flapping
+
+    Not thread safe, record and snapshot from the same thread.'''
+
+    def __init__(self, history=8, flap_changes=3):
+        if not 0 < history < 256:
+            raise ValueError('history must be 1 to 255 polls')
+        self.history = history
+        self.flap_changes = flap_changes
+        self.agents = {}
+        # subsystem names and their numbers, and the layouts in use
+        self.names = []
+        self.name_numbers = {}
+        self.layouts = {}
+        self._clear()
+
+    def _clear(self):
+        # a ring of history entries per row: global status, time in
+        # seconds, round trip time in milliseconds (0 unknown)
+        self.global_statuses = array('B')
+        self.times = array('I')
+        self.rtts = array('H')
+        # per row: ring slot of the next poll, polls recorded up to history
+        self.positions = array('B')
+        self.counts = array('B')
+
+    def __len__(self):
+        return len(self.agents)
+
+    def record(self, key, details, rtt=None, when=None):
+        '''Records a poll of an agent. details is the dictionary of
+        problem_list_task, empty when the agent didn't answer. rtt in
+        seconds, when defaults to now'''
+        agent = self.agents.get(key)
+        if agent is None:
+            agent = self._add(key)
+        row, history = agent.row, self.history
+        position = self.positions[row]
+        slot = row * history + position
+        self.global_statuses[slot] = min(int(details.get('global_status',
+                                                         0)), 255)
+        self.times[slot] = int(when or time.time())
+        if rtt is None:
+            self.rtts[slot] = 0
+        else:
+            self.rtts[slot] = max(1, min(int(rtt * 1000 + 0.5), 65535))
+        if 'subsystems' in details:
+            statuses = {}
+            for name in details['subsystems'].split():
+                statuses[name] = 1
+            for name, status, last_error in details['failed']:
+                statuses[name] = max(1, min(int(status), 255))
+            layout = self._layout(statuses.keys())
+            if layout != agent.layout:
+                self._relayout(agent, layout)
+            for nr in range(len(layout)):
+                agent.statuses[nr * history + position] = \
+                        statuses[self.names[layout[nr]]]
+        else:
+            for nr in range(len(agent.layout)):
+                agent.statuses[nr * history + position] = 0
+        self.positions[row] = (position + 1) % history
+        if self.counts[row] < history:
+            self.counts[row] = self.counts[row] + 1
+
+    def flapping(self, key):
+        '''The names of the subsystems of an agent that are flapping'''
+        agent = self.agents.get(key)
+        if agent is None:
+            return []
+        flapping = []
+        for nr in range(len(agent.layout)):
+            changes, last = 0, 0
+            for status in self._ring(agent.statuses, nr, agent.row):
+                if not status:
+                    # not read, no change
+                    continue
+                if last and status != last:
+                    changes = changes + 1
+                last = status
+            if changes >= self.flap_changes:
+                flapping.append(self.names[agent.layout[nr]])
+        return flapping
+
+    def polls(self, key):
+        '''The recorded polls of an agent, oldest first, as (time, global
+        status, rtt in seconds or None)'''
+        agent = self.agents.get(key)
+        if agent is None:
+            return []
+        row = agent.row
+        return zip(self._ring(self.times, row, row),
+                   self._ring(self.global_statuses, row, row),
+                   [rtt and rtt / 1000.0 or None
+                    for rtt in self._ring(self.rtts, row, row)])
+
+    def subsystem_statuses(self, key):
+        '''{name: statuses of the recorded polls, oldest first} of an agent'''
+        agent = self.agents.get(key)
+        if agent is None:
+            return {}
+        statuses = {}
+        for nr in range(len(agent.layout)):
+            statuses[self.names[agent.layout[nr]]] = self._ring(
+                                            agent.statuses, nr, agent.row)
+        return statuses
+
+    def snapshot(self, path):
+        '''Writes all of it to file path, atomically'''
+        # only the pollers that keep running write snapshots
+        import tempfile
+        agents = [(key, agent.row, agent.layout, agent.statuses.tostring())
+                  for key, agent in self.agents.items()]
+        data = (self.history, _platform(), self.names, agents,
+                self.global_statuses.tostring(), self.times.tostring(),
+                self.rtts.tostring(), self.positions.tostring(),
+                self.counts.tostring())
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                         prefix='.tmp')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(SNAPSHOT_MAGIC)
+                marshal.dump(data, f)
+            finally:
+                f.close()
+            os.rename(temp_path, path)
+        except Exception:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def restore(self, path):
+        '''Replaces the state by a snapshot, returns the number of agents
+        restored. A missing snapshot, or one of another version or history,
+        restores nothing. Raises EnvironmentError if it can't be read'''
+        try:
+            f = open(path, 'rb')
+        except IOError, e:
+            if e.errno == 2:
+                return 0
+            raise
+        try:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                return 0
+            try:
+                data = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return 0
+        finally:
+            f.close()
+        history, platform, names, agents = data[:4]
+        if history != self.history or platform != _platform():
+            return 0
+        self.names = list(names)
+        self.name_numbers = {}
+        for nr in range(len(self.names)):
+            self.name_numbers[self.names[nr]] = nr
+        self._clear()
+        columns = (self.global_statuses, self.times, self.rtts,
+                   self.positions, self.counts)
+        for column, string in zip(columns, data[4:]):
+            column.fromstring(string)
+        self.agents, self.layouts = {}, {}
+        for key, row, layout, statuses in agents:
+            layout = self.layouts.setdefault(tuple(layout), tuple(layout))
+            self.agents[key] = _Agent(row, layout, array('B', statuses))
+        return len(self.agents)
+
+    def _add(self, key):
+        '''A new agent, with its rows in the columns'''
+        agent = _Agent(len(self.positions), (), array('B'))
+        history = self.history
+        self.global_statuses.extend(array('B', [0]) * history)
+        self.times.extend(array('I', [0]) * history)
+        self.rtts.extend(array('H', [0]) * history)
+        self.positions.append(0)
+        self.counts.append(0)
+        self.agents[key] = agent
+        return agent
+
+    def _layout(self, names):
+        '''The shared layout tuple of subsystem names'''
+        numbers = []
+        for name in names:
+            if not name in self.name_numbers:
+                self.name_numbers[name] = len(self.names)
+                self.names.append(name)
+            numbers.append(self.name_numbers[name])
+        numbers.sort()
+        numbers = tuple(numbers)
+        return self.layouts.setdefault(numbers, numbers)
+
+    def _relayout(self, agent, layout):
+        '''Gives an agent other subsystems, the rings of the ones it keeps
+        are kept'''
+        history = self.history
+        statuses = array('B', [0]) * (history * len(layout))
+        for nr in range(len(layout)):
+            if layout[nr] in agent.layout:
+                old = agent.layout.index(layout[nr]) * history
+                statuses[nr * history:(nr + 1) * history] = \
+                        agent.statuses[old:old + history]
+        agent.layout = layout
+        agent.statuses = statuses
+
+    def _ring(self, column, nr, row):
+        '''The entries of ring nr of a column (or the statuses of an agent)
+        for the agent on row, oldest first'''
+        history = self.history
+        count, position = self.counts[row], self.positions[row]
+        base = nr * history
+        return [column[base + (position - count + entry) % history]
+                for entry in range(count)]
+
+
+def _platform():
+    '''The byte order and integer size of the arrays as written'''
+    return (sys.byteorder, array('I').itemsize)
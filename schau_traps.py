@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : Receives snmp traps and informs for nagios plugins
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Receives SNMPv1/v2c traps and SNMPv3 informs on a udp port
+
+The notifications are handed to a function as they come in, with the
+address of the agent that sent them:
+
+    def received(address, trap_oid, varbinds):
+        print address, trap_oid
+    listener = TrapListener(received, ('0.0.0.0', 162), ['public'],
+                            [('nagios', 's3cret', None, 'md5')])
+    listener.serve()
+
+pysnmp decodes the messages and answers the informs. snmpv1 traps are
+handed over like snmpv2 notifications, with the trap oid made of the
+enterprise and specific trap number as in RFC 2576 (pysnmp 4.1 fails to
+convert them with the pyasn1 versions around). Octet strings and
+integers are handed over as python strings and integers.'''
+
+from pyasn1.type import univ
+from pysnmp.entity import engine, config
+from pysnmp.entity.rfc3413 import ntfrcv
+from pysnmp.carrier.asynsock.dgram import udp
+from pysnmp.carrier.error import CarrierError
+from pysnmp.proto.api import v1
+
+# snmpTrapOID.0 and snmpTrapAddress.0 of SNMPv2-MIB and SNMP-COMMUNITY-MIB
+SNMP_TRAP_OID = (1, 3, 6, 1, 6, 3, 1, 1, 4, 1, 0)
+SNMP_TRAP_ADDRESS = (1, 3, 6, 1, 6, 3, 18, 1, 3, 0)
+# the generic snmpv1 traps are snmpTraps.1 (coldStart) to .6
+SNMP_TRAPS = (1, 3, 6, 1, 6, 3, 1, 1, 5)
+ENTERPRISE_SPECIFIC = 6
+
+
+class _NotificationReceiver(ntfrcv.NotificationReceiver):
+    '''Hands snmpv1 trap PDUs to v1_handler(snmpEngine, stateReference,
+    PDU) instead of converting them, the others go the pysnmp way'''
+
+    def __init__(self, snmpEngine, cbFun, v1_handler):
+        ntfrcv.NotificationReceiver.__init__(self, snmpEngine, cbFun)
+        self.v1_handler = v1_handler
+
+    def processPdu(self, snmpEngine, messageProcessingModel, *args):
+        if messageProcessingModel == 0:
+            # unconfirmed, nothing to answer
+            PDU, stateReference = args[-3], args[-1]
+            self.v1_handler(snmpEngine, stateReference, PDU)
+        else:
+            ntfrcv.NotificationReceiver.processPdu(self, snmpEngine,
+                                                   messageProcessingModel,
+                                                   *args)
+
+
+class TrapListener(object):
+    '''Calls handler(address, trap oid tuple, varbinds) for every trap or
+    inform received, varbinds is a list of (oid tuple, value)
+
+    * address:      (host, port) to listen on, default ('0.0.0.0', 162)
+    * communities:  community strings accepted in snmpv1/v2c traps
+    * users:        (user, authkey, privkey, authProtocol) accepted in
+                    snmpv3 informs, authProtocol 'md5' or 'sha'
+    * tick:         function called every interval seconds, e.g. to show
+                    the listener is alive
+
+    The address of an snmpv1 trap is its agent-addr, else the address the
+    notification came from. Raises EnvironmentError when it can't listen
+    on address.'''
+
+    def __init__(self, handler, address=('0.0.0.0', 162),
+                 communities=('public',), users=(), tick=None, interval=10):
+        self.handler = handler
+        self.engine = engine.SnmpEngine()
+        try:
+            transport = udp.UdpTransport().openServerMode(address)
+        except CarrierError, e:
+            raise EnvironmentError(str(e))
+        config.addSocketTransport(self.engine, udp.domainName, transport)
+        for nr in range(len(communities)):
+            config.addV1System(self.engine, 'trap-%d' % nr, communities[nr])
+        for user, authkey, privkey, authProtocol in users:
+            if not authkey:
+                config.addV3User(self.engine, user)
+                continue
+            if authProtocol == 'sha':
+                authprot = config.usmHMACSHAAuthProtocol
+            else:
+                authprot = config.usmHMACMD5AuthProtocol
+            if privkey:
+                config.addV3User(self.engine, user, authprot, authkey,
+                                 config.usmDESPrivProtocol, privkey)
+            else:
+                config.addV3User(self.engine, user, authprot, authkey)
+        self.receiver = _NotificationReceiver(self.engine, self._received,
+                                              self._received_v1)
+        if tick is not None:
+            self.engine.transportDispatcher.registerTimerCbFun(
+                lambda now: tick(), interval)
+
+    def serve(self):
+        '''Receives notifications until interrupted'''
+        dispatcher = self.engine.transportDispatcher
+        dispatcher.jobStarted(1)
+        try:
+            dispatcher.runDispatcher()
+        finally:
+            dispatcher.closeDispatcher()
+
+    def _received(self, snmpEngine, stateReference, contextEngineId,
+                  contextName, varBinds, cbCtx):
+        address = self._source(snmpEngine, stateReference)
+        trap_oid = None
+        varbinds = []
+        for name, value in varBinds:
+            name = tuple(name)
+            if name == SNMP_TRAP_OID:
+                trap_oid = tuple([int(arc) for arc in value])
+            elif name == SNMP_TRAP_ADDRESS:
+                address = _ip_address(value) or address
+            else:
+                varbinds.append((name, value))
+        if trap_oid is not None:
+            self._deliver(address, trap_oid, varbinds)
+
+    def _received_v1(self, snmpEngine, stateReference, pdu):
+        address = _ip_address(v1.apiTrapPDU.getAgentAddr(pdu)) or \
+                  self._source(snmpEngine, stateReference)
+        generic = int(v1.apiTrapPDU.getGenericTrap(pdu))
+        if generic == ENTERPRISE_SPECIFIC:
+            enterprise = [int(arc) for arc in v1.apiTrapPDU.getEnterprise(pdu)]
+            trap_oid = tuple(enterprise) + \
+                       (0, int(v1.apiTrapPDU.getSpecificTrap(pdu)))
+        else:
+            trap_oid = SNMP_TRAPS + (generic + 1,)
+        self._deliver(address, trap_oid,
+                      [(tuple(name), value) for name, value in
+                       v1.apiTrapPDU.getVarBinds(pdu)])
+
+    def _source(self, snmpEngine, stateReference):
+        '''The ip address a notification came from'''
+        transportDomain, transportAddress = \
+                snmpEngine.msgAndPduDsp.getTransportInfo(stateReference)
+        return transportAddress[0]
+
+    def _deliver(self, address, trap_oid, varbinds):
+        values = []
+        for name, value in varbinds:
+            if isinstance(value, univ.OctetString):
+                value = str(value)
+            elif isinstance(value, univ.Integer):
+                value = int(value)
+            values.append((name, value))
+        self.handler(address, trap_oid, values)
+
+
+def _ip_address(value):
+    '''An IpAddress value as a dotted string, None for 0.0.0.0'''
+    address = '.'.join([str(ord(octet)) for octet in str(value)])
+    if address == '0.0.0.0':
+        return None
+    return address
@@ -16,10 +16,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
-from optparse import OptionParser
+import time
+import errno
+import fcntl
+import select
+import signal
+from optparse import OptionParser, Values
 
 class NagiosPlugin(object):
+    # seconds a run_many task may take beyond its --timeout
+    TIMEOUT_GRACE = 1
+
     def __init__(self, label, plugin_method, extra_options, help):
         self.NAGIOS_RET_CODES = {
             'OK':0,
@@ -43,16 +52,22 @@ class NagiosPlugin(object):
         self._add_options(self.standard_options)
         self._add_options(self.extra_options)
 
-    def run(self, debug = False):
-        options_dict = {}
-        (options_object, args) = self.optparser.parse_args()
-        for opt in self.standard_options.keys() + self.extra_options.keys():
-            if hasattr(options_object, opt):
-                options_dict[opt] = getattr(options_object, opt)
+    def run(self, debug = False, options_dict=None):
+        if options_dict is None:
+            options_dict = self.parse_options()
+        status, msg, function, perfdata = self.execute(options_dict, debug)
+        self._NAGIOS_EXIT(status,msg,function,perfdata)
+
+    def execute(self, options_dict, debug = False):
+        '''Calls the plugin method, returns (status, msg, function, perfdata)
+        Unlike run it doesn't print or exit, for programs running many checks'''
         # Call plugin method specified by the user of this class
+        perfdata = None
         try:
             retvals = self.plugin_method(options_dict)
-            if len(retvals) == 3:
+            if len(retvals) == 4:
+                status, msg, function, perfdata = retvals
+            elif len(retvals) == 3:
                 status, msg, function = retvals
             elif len(retvals) == 2:
                 status, msg = retvals
@@ -66,7 +81,157 @@ class NagiosPlugin(object):
                 status = 'UNKNOWN'
                 msg = 'Unhandled exception in plugin %s' % self.help['filename']
                 function = 'PYNAGLIB'
-        self._NAGIOS_EXIT(status,msg,function)
+                perfdata = None
+        return status, msg, function, perfdata
+
+    def run_many(self, tasks, workers=10, timeout=None, processes=False):
+        '''Runs the plugin method for many option sets at once, without
+        printing or exiting. Yields a CheckResult per task as it finishes
+
+        * tasks:     iterable of (key, options), options a dictionary (the
+                     missing options get their defaults) or a list of
+                     commandline arguments
+        * workers:   tasks running at the same time
+        * timeout:   seconds a task may take, default the --timeout of its
+                     options plus TIMEOUT_GRACE: the plugin method gets to
+                     report its own timeout first
+        * processes: run the tasks in worker processes instead of threads
+
+        A task that takes too long is UNKNOWN. A worker process running it
+        is killed and replaced, a thread can't be: it runs on in the
+        background and its result is dropped. Worker processes are forked
+        once and run task after task.
+            for result in plugin.run_many([(host, ['-H', host])
+                                           for host in hosts], workers=20):
+                print result.key, plugin.format_result(result.status,
+                    result.message, result.function, result.perfdata)[1]'''
+        if processes:
+            pool = _ProcessWorkers(self.execute)
+        else:
+            pool = _ThreadWorkers(self.execute)
+        defaults = self.parse_options([])
+        tasks = iter(tasks)
+        # task number -> (key, start, deadline)
+        running = {}
+        nr = 0
+        try:
+            while True:
+                while len(running) < workers:
+                    try:
+                        key, options = tasks.next()
+                    except StopIteration:
+                        break
+                    start = time.time()
+                    try:
+                        options = self._task_options(options, defaults)
+                    except SystemExit:
+                        # optparse printed why on stderr
+                        yield CheckResult(key, 'UNKNOWN', 'invalid options',
+                                          'PYNAGLIB', None, 0.0)
+                        continue
+                    seconds = timeout
+                    if seconds is None and options.get('timeout'):
+                        seconds = options['timeout'] + self.TIMEOUT_GRACE
+                    deadline = None
+                    if seconds is not None:
+                        deadline = start + seconds
+                    running[nr] = (key, start, deadline)
+                    pool.start(nr, options)
+                    nr = nr + 1
+                if not running:
+                    break
+                deadlines = [deadline for key, start, deadline
+                             in running.values() if deadline is not None]
+                wait = None
+                if deadlines:
+                    wait = max(0, min(deadlines) - time.time())
+                for done, result in pool.wait(wait):
+                    if not done in running:
+                        # timed out meanwhile
+                        continue
+                    key, start, deadline = running.pop(done)
+                    status, msg, function, perfdata = result
+                    yield CheckResult(key, status, msg, function, perfdata,
+                                      time.time() - start)
+                now = time.time()
+                for late, (key, start, deadline) in running.items():
+                    if deadline is None or deadline > now:
+                        continue
+                    del running[late]
+                    pool.abandon(late)
+                    yield CheckResult(key, 'UNKNOWN', 'timeout of %gs '
+                                      'reached' % round(deadline - start, 1),
+                                      'PYNAGLIB', None, now - start, True)
+        finally:
+            pool.close()
+
+    def _task_options(self, options, defaults):
+        '''The options dictionary of a run_many task, raises SystemExit when
+        they can't be parsed'''
+        if isinstance(options, dict):
+            task_options = defaults.copy()
+            task_options.update(options)
+            return task_options
+        return self.parse_options(list(options))
+
+    def parse_options(self, args=None, defaults=None):
+        '''Parses args (default: the commandline) into an options dictionary
+        Options missing from args are taken from the defaults dictionary'''
+        options_dict = {}
+        if defaults is None:
+            values = None
+        else:
+            values = Values(defaults)
+        (options_object, args) = self.optparser.parse_args(args, values)
+        for opt in self.standard_options.keys() + self.extra_options.keys():
+            if hasattr(options_object, opt):
+                options_dict[opt] = getattr(options_object, opt)
+        return options_dict
+
+    def format_result(self, status, msg, function='', perfdata=None):
+        '''Returns (exit code, output line) for a plugin result'''
+        status = status.upper()
+        if not status in self.NAGIOS_RET_CODES:
+            status = 'UNKNOWN'
+        # nagios takes everything after a | for perfdata
+        msg = msg.replace('|', '/')
+        if function:
+            line = '%s %s - %s' % (function, status, msg)
+        else:
+            line = '%s %s - %s' % (self.label, status, msg)
+        if perfdata:
+            line = '%s | %s' % (line, self.format_perfdata(perfdata))
+        return self.NAGIOS_RET_CODES[status], line
+
+    def submit(self, sink, host, service, status, msg, function='',
+               perfdata=None):
+        '''Hands a result to sink, a CheckResultSpool or CommandPipe, as
+        the passive check result of service on host instead of printing
+        it. Returns the exit code'''
+        code, line = self.format_result(status, msg, function, perfdata)
+        sink.add(host, service, code, line)
+        return code
+
+    def format_perfdata(self, perfdata):
+        '''Returns perfdata as 'label'=value[UOM];[warn];[crit];[min];[max]
+        items, from a list of (label, value[, uom[, warn[, crit[, min[,
+        max]]]]]) tuples. None leaves a field empty'''
+        items = []
+        for item in perfdata:
+            label, value = item[:2]
+            uom = ''
+            if len(item) > 2 and item[2]:
+                uom = item[2]
+            if [char for char in " '=" if char in label]:
+                label = "'%s'" % label.replace("'", "''")
+            fields = [_perfdata_value(value) + uom]
+            for limit in item[3:]:
+                if limit is None:
+                    fields.append('')
+                else:
+                    fields.append(_perfdata_value(limit))
+            items.append('%s=%s' % (label, ';'.join(fields).rstrip(';')))
+        return ' '.join(items)
 
     def _test_options(self):
         #help (h) and version (V) are also standard/reserved options
@@ -120,15 +285,319 @@ class NagiosPlugin(object):
         print self.help['filename'] +' '+ self.help['version']
         sys.exit(self.NAGIOS_RET_CODES['UNKNOWN'])
 
-    def _NAGIOS_EXIT(self, status, msg, function=''):
-        status = status.upper()
-        if not status in self.NAGIOS_RET_CODES:
-            status = 'UNKNOWN'
-        if function:
-            print '%s %s - %s' % (function, status, msg)
+    def _NAGIOS_EXIT(self, status, msg, function='', perfdata=None):
+        code, line = self.format_result(status, msg, function, perfdata)
+        print line
+        sys.exit(code)
+
+
+def _perfdata_value(value):
+    '''Formats a number without exponent, nagios doesn't parse those'''
+    if isinstance(value, float):
+        return ('%.6f' % value).rstrip('0').rstrip('.')
+    return str(value)
+
+
+class CheckResult(object):
+    '''A result of NagiosPlugin.run_many
+
+    * key:       the key of the task
+    * status:    'OK', 'WARNING', 'CRITICAL' or 'UNKNOWN'
+    * message, function, perfdata: as the plugin method returned them,
+                 NagiosPlugin.format_result makes the output line
+    * duration:  seconds the task took
+    * timed_out: True when the task was given up after its timeout'''
+
+    def __init__(self, key, status, message, function, perfdata, duration,
+                 timed_out=False):
+        self.key = key
+        self.status = status
+        self.message = message
+        self.function = function
+        self.perfdata = perfdata
+        self.duration = duration
+        self.timed_out = timed_out
+
+
+class _ThreadWorkers(object):
+    '''Runs the tasks of run_many in a thread each'''
+
+    def __init__(self, execute):
+        # threads only for the programs that use them
+        import thread
+        import Queue
+        self.execute = execute
+        self.start_thread = thread.start_new_thread
+        self.results = Queue.Queue()
+        self.empty = Queue.Empty
+
+    def start(self, nr, options):
+        self.start_thread(self._run, (nr, options))
+
+    def _run(self, nr, options):
+        self.results.put((nr, self.execute(options)))
+
+    def wait(self, timeout):
+        '''The (task number, result) of the tasks that finished, waits at
+        most timeout seconds (None: no limit) for one'''
+        try:
+            finished = [self.results.get(True, timeout)]
+        except self.empty:
+            return []
+        while True:
+            try:
+                finished.append(self.results.get(False))
+            except self.empty:
+                return finished
+
+    def abandon(self, nr):
+        '''The thread can't be stopped, its result is left alone'''
+        pass
+
+    def close(self):
+        pass
+
+
+class _ProcessWorkers(object):
+    '''Runs the tasks of run_many in worker processes, one task at a time
+    each, over a pipe per process'''
+
+    def __init__(self, execute):
+        import multiprocessing
+        self.multiprocessing = multiprocessing
+        self.execute = execute
+        # task number -> (process, connection) running it, and the ones
+        # waiting for a task
+        self.busy = {}
+        self.idle = []
+
+    def start(self, nr, options):
+        if self.idle:
+            worker = self.idle.pop()
         else:
-            print '%s %s - %s' % (self.label, status, msg)
-        sys.exit(self.NAGIOS_RET_CODES[status])
+            connection, child_connection = self.multiprocessing.Pipe()
+            process = self.multiprocessing.Process(target=_process_worker,
+                                args=(self.execute, child_connection))
+            # stopped with the program, whatever it is doing
+            process.daemon = True
+            process.start()
+            child_connection.close()
+            worker = (process, connection)
+        worker[1].send((nr, options))
+        self.busy[nr] = worker
+
+    def wait(self, timeout):
+        '''The (task number, result) of the tasks that finished, waits at
+        most timeout seconds (None: no limit) for one'''
+        connections = {}
+        for nr, worker in self.busy.items():
+            connections[worker[1].fileno()] = nr
+        try:
+            ready = select.select(connections.keys(), [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        finished = []
+        for fd in ready:
+            nr = connections[fd]
+            worker = self.busy.pop(nr)
+            try:
+                finished.append(worker[1].recv())
+            except EOFError:
+                # the process died, it is replaced by the next task
+                worker[0].join()
+                worker[1].close()
+                finished.append((nr, ('UNKNOWN', 'worker process died',
+                                      'PYNAGLIB', None)))
+                continue
+            self.idle.append(worker)
+        return finished
+
+    def abandon(self, nr):
+        '''Kills the process running task nr'''
+        process, connection = self.busy.pop(nr)
+        process.terminate()
+        process.join()
+        connection.close()
+
+    def close(self):
+        '''Stops the idle processes, kills the busy ones'''
+        for process, connection in self.idle:
+            connection.send(None)
+            connection.close()
+            process.join()
+        for nr in self.busy.keys():
+            self.abandon(nr)
+        self.idle = []
+
+def _process_worker(execute, connection):
+    '''Runs the tasks a _ProcessWorkers sends over connection, until None'''
+    # the program running the workers handles ^C and stops them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        nr, options = task
+        connection.send((nr, execute(options)))
+
+
+class CheckResultSpool(object):
+    '''Passive check results for the check result path of nagios or icinga
+    (check_result_path in nagios.cfg)
+
+    add collects results, flush writes them all in one file: a temporary
+    file renamed to cXXXXXX, then the cXXXXXX.ok that tells nagios it is
+    complete. Nagios reads it with its next check result reaper run.
+    When that fails the results are kept for the next flush, the last
+    MAX_BACKLOG of them.'''
+
+    MAX_BACKLOG = 10000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.results = []
+
+    def add(self, host, service, code, output, start=None, finish=None):
+        '''Collects the result of service on host, with its exit code and
+        output line. start and finish default to now'''
+        finish = finish or time.time()
+        self.results.append((host, service, code, output, start or finish,
+                             finish))
+        del self.results[:-self.MAX_BACKLOG]
+
+    def flush(self):
+        '''Writes the results collected into one check result file. Raises
+        EnvironmentError when it can't, the results are kept'''
+        if not self.results:
+            return
+        lines = ['### Passive Check Result File ###',
+                 'file_time=%d' % time.time(), '']
+        for host, service, code, output, start, finish in self.results:
+            lines.extend(['### Nagios Service Check Result ###',
+                          '# Time: %s' % time.ctime(finish),
+                          'host_name=%s' % host,
+                          'service_description=%s' % service,
+                          'check_type=1', 'check_options=0',
+                          'scheduled_check=0', 'reschedule_check=0',
+                          'latency=0.0', 'start_time=%f' % start,
+                          'finish_time=%f' % finish, 'early_timeout=0',
+                          'exited_ok=1', 'return_code=%d' % code,
+                          'output=%s' % _escape_output(output), ''])
+        # only needed here, checks that print their result skip the import
+        import tempfile
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            entry = os.fdopen(fd, 'w')
+            try:
+                entry.write('\n'.join(lines))
+            finally:
+                entry.close()
+            # a name nagios looks for, it skips files without .ok
+            path_fd, path = tempfile.mkstemp(dir=self.directory, prefix='c')
+            os.close(path_fd)
+            os.rename(temp_path, path)
+        except Exception:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+        open(path + '.ok', 'w').close()
+        self.results = []
+
+    def close(self):
+        '''Writes the results collected, like flush'''
+        self.flush()
+
+
+class CommandPipe(object):
+    '''Passive check results for the external command file of nagios or
+    icinga, as PROCESS_SERVICE_CHECK_RESULT commands
+
+    add collects the commands, flush writes them in as few writes as
+    possible. A write of at most PIPE_BUF bytes to a fifo isn't mixed with
+    the writes of other processes, so every write ends at the end of a
+    command and longer outputs are cut. flush raises EnvironmentError when
+    no nagios reads the pipe, or the reader went away: the commands not
+    written are kept for the next flush, the last MAX_BACKLOG of them, and
+    the pipe is opened again then.'''
+
+    # bytes written to a fifo at once, 512 at least by POSIX
+    PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+    MAX_BACKLOG = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.commands = []
+        self.fd = None
+
+    def add(self, host, service, code, output, start=None, finish=None):
+        '''Collects the result of service on host, with its exit code and
+        output line'''
+        command = '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (
+                  finish or time.time(), host, service, code,
+                  _escape_output(output))
+        if len(command) > self.PIPE_BUF:
+            command = command[:self.PIPE_BUF - 1] + '\n'
+        self.commands.append(command)
+        del self.commands[:-self.MAX_BACKLOG]
+
+    def flush(self):
+        '''Writes the commands collected, PIPE_BUF bytes at most at a time.
+        Raises EnvironmentError when the pipe fails, see the class'''
+        if not self.commands:
+            return
+        # commands written, a write of at most PIPE_BUF is all or nothing
+        written = 0
+        try:
+            if self.fd is None:
+                # without a reader the open fails instead of waiting
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+                fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+            chunk = ''
+            for nr in range(len(self.commands)):
+                command = self.commands[nr]
+                if len(chunk) + len(command) > self.PIPE_BUF:
+                    self._write(chunk)
+                    written = nr
+                    chunk = ''
+                chunk = chunk + command
+            self._write(chunk)
+        except EnvironmentError:
+            del self.commands[:written]
+            self._close()
+            raise
+        self.commands = []
+
+    def close(self):
+        '''Flushes the commands collected and closes the pipe'''
+        try:
+            self.flush()
+        finally:
+            self._close()
+
+    def _close(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+    def _write(self, data):
+        while data:
+            data = data[os.write(self.fd, data):]
+
+
+def _escape_output(output):
+    '''A plugin output on one line, newlines as \\n like nagios expects'''
+    return output.replace('\\', '\\\\').replace('\n', '\\n')
 	
 
 if  __name__ == '__main__':
@@ -151,6 +620,8 @@ if  __name__ == '__main__':
     ##          a) the status, one of "OK", "UNKNOWN", "CRITICAL", "WARNING"
     ##          b) an output string (shouldn't contain a newline)
     ##        [ c) a label to replace the default plugin name ]
+    ##        [ d) perfdata, a list of (label, value[, uom[, warn[, crit
+    ##             [, min[, max]]]]]) tuples, printed after a | ]
     ##
     ##
     ##
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# Author       : Stijn Gruwier <stijn.gruwier@notforadsgmail.com>
+# Description  : The ServerView snmp objects used by check_serverview
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Registry of the ServerView objects, compiled to oid tuples on import
+
+The scalars and tables of the ServerView status mib (global status and
+subsystem table) and of the server control and raid mibs (temperature,
+fan, power supply and logical drive tables) are declared once below. Their
+oids are tuples of integers, ready for SnmpClient, and every returned
+varbind is mapped back to its object by a prefix trie, without formatting
+or parsing dotted strings:
+
+    values = client.get_many([GLOBAL_STATUS.instance])
+    status = values[GLOBAL_STATUS.instance]
+    columns = SUBSYSTEM_TABLE.columns('name', 'status')
+    varbinds, complete = client.get_subtrees(columns)
+    rows = SUBSYSTEM_TABLE.rows(varbinds)   # {(1,): {'name': .., ..}}
+    REGISTRY.lookup(name)                   # (SUBSYSTEM_TABLE, 'status', (1,))
+
+COMPONENTS tells which component tables describe a subsystem, and how
+their rows are reported, trap_kind which notifications change what a
+check would find.'''
+
+# status of the subsystems and of the server as a whole
+STATUS = {1: 'ok', 2: 'degraded', 3: 'error', 4: 'failed', 5: 'unknown-init'}
+
+
+def compile_oid(oid):
+    '''Dotted string -> tuple of integers'''
+    return tuple([int(arc) for arc in oid.strip('.').split('.')])
+
+def dotted(oid):
+    '''Tuple of integers -> dotted string, for messages'''
+    return '.' + '.'.join([str(arc) for arc in oid])
+
+def trap_kind(oid):
+    '''The kind of a notification by its trap oid (a tuple), see TRAPS.
+    None for the ones that don't concern the hardware status'''
+    for length in range(len(oid), 0, -1):
+        if oid[:length] in TRAPS:
+            return TRAPS[oid[:length]]
+    return None
+
+
+class Registry(object):
+    '''Prefix trie over the oids of scalars and table columns
+
+    Every node is a dictionary {arc: child node}, the node of a registered
+    oid also holds (object, column, oid length) under the key None.'''
+
+    def __init__(self):
+        self.root = {}
+        # name -> Scalar or Table
+        self.objects = {}
+
+    def add(self, obj):
+        '''Registers a Scalar or Table, returns it'''
+        obj.registry = self
+        for column, oid in obj.registered_oids():
+            node = self.root
+            for arc in oid:
+                node = node.setdefault(arc, {})
+            node[None] = (obj, column, len(oid))
+        self.objects[obj.name] = obj
+        return obj
+
+    def lookup(self, oid):
+        '''Returns (object, column, index tuple) for the oid of an instance,
+        the column is None for a scalar. None if the oid isn't registered'''
+        node = self.root
+        found = None
+        for arc in oid:
+            node = node.get(arc)
+            if node is None:
+                break
+            if None in node:
+                found = node[None]
+        if found is None:
+            return None
+        obj, column, length = found
+        return obj, column, tuple(oid[length:])
+
+    def tables(self, varbinds):
+        '''Sorts (oid tuple, value) varbinds into the rows of their tables,
+        returns {Table: {index tuple: {column: value}}}'''
+        tables = {}
+        for name, value in varbinds:
+            found = self.lookup(name)
+            if found is None or found[1] is None:
+                continue
+            table, column, index = found
+            rows = tables.setdefault(table, {})
+            if index in rows:
+                rows[index][column] = value
+            else:
+                rows[index] = {column: value}
+        return tables
+
+
+class Scalar(object):
+    '''A scalar object, instance is the oid of its value'''
+
+    def __init__(self, name, oid):
+        self.name = name
+        self.oid = compile_oid(oid)
+        self.instance = self.oid + (0,)
+
+    def registered_oids(self):
+        return [(None, self.oid)]
+
+
+class Table(object):
+    '''A table by the oid of its entry and its columns {name: number}'''
+
+    def __init__(self, name, entry, columns):
+        self.name = name
+        self.entry = compile_oid(entry)
+        self.column_oids = {}
+        for column, number in columns.items():
+            self.column_oids[column] = self.entry + (number,)
+        # set when registered
+        self.registry = None
+
+    def registered_oids(self):
+        return self.column_oids.items()
+
+    def column(self, column):
+        return self.column_oids[column]
+
+    def columns(self, *columns):
+        '''The oids of columns, in that order'''
+        return [self.column_oids[column] for column in columns]
+
+    def instance(self, column, index):
+        '''The oid of column in the row with index, a tuple'''
+        return self.column_oids[column] + index
+
+    def rows(self, varbinds):
+        '''Sorts (oid tuple, value) varbinds of this table into rows,
+        returns {index tuple: {column: value}}. Other varbinds are left
+        out'''
+        return self.registry.tables(varbinds).get(self, {})
+
+
+class Components(object):
+    '''How the rows of a component table are reported
+
+    * table:     Table
+    * prefix:    string - kind of component, starts the perfdata labels
+    * label:     column naming the component
+    * statuses:  dictionary - status column value -> name
+    * ok:        status values that are not a problem
+    * value:     column with a reading for perfdata, None for none
+    * warning,
+      critical:  columns with the thresholds of the reading, None for none'''
+
+    def __init__(self, table, prefix, label, statuses, ok, value=None,
+                 warning=None, critical=None):
+        self.table = table
+        self.prefix = prefix
+        self.label = label
+        self.statuses = statuses
+        self.ok = ok
+        self.value = value
+        self.warning = warning
+        self.critical = critical
+
+    def columns(self):
+        '''The oids of the columns to read'''
+        names = [self.label, 'status']
+        for name in (self.value, self.warning, self.critical):
+            if name is not None:
+                names.append(name)
+        return self.table.columns(*names)
+
+
+REGISTRY = Registry()
+
+# mib-2 system group
+SYS_UPTIME = REGISTRY.add(Scalar('sys_uptime', '.1.3.6.1.2.1.1.3'))
+
+# ServerView status mib
+GLOBAL_STATUS = REGISTRY.add(Scalar('global_status',
+                                    '.1.3.6.1.4.1.231.2.10.2.11.2.1'))
+GLOBAL_MESSAGE = REGISTRY.add(Scalar('global_message',
+                                     '.1.3.6.1.4.1.231.2.10.2.11.2.2'))
+SUBSYSTEM_NAMES = REGISTRY.add(Scalar('subsystem_names',
+                                      '.1.3.6.1.4.1.231.2.10.2.11.2.3'))
+SUBSYSTEM_COUNT = REGISTRY.add(Scalar('subsystem_count',
+                                      '.1.3.6.1.4.1.231.2.10.2.11.3.2'))
+SUBSYSTEM_TABLE = REGISTRY.add(Table('subsystem',
+        '.1.3.6.1.4.1.231.2.10.2.11.3.1.1',
+        {'index': 1, 'name': 2, 'status': 3, 'last_error': 4}))
+
+# server control mib: environment and power supplies
+TEMPERATURE_TABLE = REGISTRY.add(Table('temperature',
+        '.1.3.6.1.4.1.231.2.10.2.2.10.5.1.1',
+        {'unit': 1, 'index': 2, 'designation': 3, 'status': 5, 'current': 6,
+         'warning': 7, 'critical': 8}))
+FAN_TABLE = REGISTRY.add(Table('fan',
+        '.1.3.6.1.4.1.231.2.10.2.2.10.5.2.1',
+        {'unit': 1, 'index': 2, 'designation': 3, 'status': 5, 'speed': 6}))
+POWER_SUPPLY_TABLE = REGISTRY.add(Table('power_supply',
+        '.1.3.6.1.4.1.231.2.10.2.2.10.6.2.1',
+        {'unit': 1, 'index': 2, 'designation': 3, 'status': 5, 'load': 6,
+         'nominal': 7}))
+
+# raid mib: mass storage
+LOGICAL_DRIVE_TABLE = REGISTRY.add(Table('logical_drive',
+        '.1.3.6.1.4.1.231.2.49.1.6.2.1',
+        {'controller': 1, 'index': 2, 'name': 3, 'status': 4}))
+
+TEMPERATURE_STATUS = {1: 'unknown', 2: 'not-available', 3: 'ok',
+                      4: 'sensor-failed', 5: 'failed', 6: 'warning-toohot',
+                      7: 'critical-toohot', 8: 'normal', 9: 'warning'}
+FAN_STATUS = {1: 'unknown', 2: 'disabled', 3: 'ok', 4: 'failed',
+              5: 'prefailure-predicted', 6: 'redundant-fan-failed',
+              7: 'not-manageable', 8: 'not-present'}
+POWER_SUPPLY_STATUS = {1: 'unknown', 2: 'not-present', 3: 'ok', 4: 'failed',
+                       5: 'ac-fail', 6: 'dc-fail', 7: 'critical-temperature',
+                       8: 'not-manageable', 9: 'fan-failure-predicted',
+                       10: 'fan-failure', 11: 'power-safe-mode',
+                       12: 'non-redundant-dc-fail',
+                       13: 'non-redundant-ac-fail'}
+LOGICAL_DRIVE_STATUS = {1: 'unknown', 2: 'online', 3: 'degraded',
+                        4: 'offline', 5: 'rebuilding', 6: 'verifying',
+                        7: 'initializing', 8: 'morphing',
+                        9: 'partial-degraded'}
+
+# notifications of the ServerView and raid agents and restarts of the
+# agent, by oid prefix (snmpv1 traps converted as in RFC 2576)
+TRAPS = {
+    compile_oid('.1.3.6.1.4.1.231.2.10.2'): 'serverview',
+    compile_oid('.1.3.6.1.4.1.231.2.49'): 'raid',
+    compile_oid('.1.3.6.1.6.3.1.1.5.1'): 'coldStart',
+    compile_oid('.1.3.6.1.6.3.1.1.5.2'): 'warmStart',
+    }
+
+# subsystem name (lowercase, without number) -> its component tables
+COMPONENTS = {
+    'environment': (
+        Components(TEMPERATURE_TABLE, 'temp', 'designation',
+                   TEMPERATURE_STATUS, (2, 3, 8), value='current',
+                   warning='warning', critical='critical'),
+        Components(FAN_TABLE, 'fan', 'designation', FAN_STATUS,
+                   (2, 3, 7, 8), value='speed')),
+    'powersupply': (
+        Components(POWER_SUPPLY_TABLE, 'psu', 'designation',
+                   POWER_SUPPLY_STATUS, (2, 3, 8), value='load'),),
+    'massstorage': (
+        Components(LOGICAL_DRIVE_TABLE, 'drive', 'name',
+                   LOGICAL_DRIVE_STATUS, (2, 6, 7, 8)),),
+    }